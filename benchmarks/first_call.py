@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Measures the latency of the first triggered write in a new backend, with and
+without calling copiste_warmup() first (as a connection pooler would, as its
+connect query).
+
+Each run opens a new connection, thus a new backend, and times its first
+single-row insert into a table bound to a function which does nothing (Noop).
+
+Runs against the functional tests platform (see README), usage :
+
+    $ python -m benchmarks.first_call [runs]
+"""
+import os
+import sys
+import time
+
+os.environ['COPISTE_SETTINGS_MODULE'] = 'tests.settings_testenv'
+from copiste.settings import SETTINGS
+del os.environ['COPISTE_SETTINGS_MODULE']
+
+import psycopg2
+
+import copiste.binding
+import copiste.functions.base
+import copiste.sql
+
+DBNAME = 'copiste_bench'
+
+def first_insert(db_settings, warmup):
+    """ Times the first insert of a new backend
+
+    @returns a (warm-up time, insert time) tuple, in seconds
+    """
+    con = psycopg2.connect(**db_settings)
+    cur = con.cursor()
+    try:
+        start = time.time()
+        if warmup:
+            cur.execute('SELECT {}()'.format(
+                    copiste.functions.base.WARMUP_FUNCTION))
+        warmup_time = time.time() - start
+
+        start = time.time()
+        cur.execute("INSERT INTO bench_table VALUES (1, 'user@bench.tld')")
+        insert_time = time.time() - start
+        con.rollback()
+        return warmup_time, insert_time
+    finally:
+        con.close()
+
+def median(values):
+    return sorted(values)[len(values) / 2]
+
+
+if __name__ == '__main__':
+    try:
+        runs = int(sys.argv[1])
+    except IndexError:
+        runs = 20
+
+    management_con = psycopg2.connect(**SETTINGS.DB)
+    management_con.set_isolation_level(0)
+    management_cur = management_con.cursor()
+    management_cur.execute('CREATE DATABASE '+DBNAME)
+
+    db_settings = SETTINGS.DB.copy()
+    db_settings['database'] = DBNAME
+    con = psycopg2.connect(**db_settings)
+    try:
+        cur = con.cursor()
+        cur.execute('CREATE LANGUAGE plpythonu')
+        cur.execute('CREATE TABLE bench_table (id INT, mail VARCHAR(100))')
+        function = copiste.functions.base.Noop()
+        trigger = copiste.sql.WriteTrigger('bench_table', 'bench')
+        copiste.binding.Bind(trigger, function).install(con)
+        cur.execute(copiste.functions.base.PlPythonFunction.sql_install_warmup(
+                [function]))
+        con.commit()
+
+        for label, warmup in (('cold', False), ('warm', True)):
+            timings = [first_insert(db_settings, warmup) for i in range(runs)]
+            print '{:<6} warm-up {:>8.2f}ms first insert {:>8.2f}ms'.format(
+                label,
+                median([w for w, _ in timings]) * 1000,
+                median([i for _, i in timings]) * 1000)
+    finally:
+        con.close()
+        management_cur.execute('DROP DATABASE '+DBNAME)
+        management_con.close()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Measures the peak memory of the control host while loading initial data
+(copiste init), on a generated table.
+
+Each measure runs in a process of its own, and reports its peak resident set
+size : first for reading the whole table at once (as initial_sync() used to),
+then for Bind.initial_sync() itself, which leaves the rows in the database.
+The function is a Noop, only the client side is measured.
+
+Runs against the functional tests platform (see README), usage :
+
+    $ python -m benchmarks.init_memory [rows] [chunk size]
+"""
+import os
+import resource
+import subprocess
+import sys
+import time
+
+os.environ['COPISTE_SETTINGS_MODULE'] = 'tests.settings_testenv'
+from copiste.settings import SETTINGS
+del os.environ['COPISTE_SETTINGS_MODULE']
+
+import psycopg2
+
+import copiste.binding
+import copiste.functions.base
+import copiste.sql
+
+DBNAME = 'copiste_bench'
+
+def db_settings():
+    settings = SETTINGS.DB.copy()
+    settings['database'] = DBNAME
+    return settings
+
+def make_binding():
+    trigger = copiste.sql.WriteTrigger('bench_table', 'bench')
+    return copiste.binding.Bind(trigger, copiste.functions.base.Noop())
+
+def measure(mode, chunk_size):
+    """ Runs in the child process
+
+    @returns a (peak RSS in kB, elapsed time in seconds) tuple
+    """
+    con = psycopg2.connect(**db_settings())
+    start = time.time()
+    if mode == 'fetchall':
+        cur = con.cursor()
+        cur.execute('SELECT * FROM bench_table')
+        for row in cur.fetchall():
+            pass
+    else:
+        make_binding().initial_sync(con, chunk_size=chunk_size)
+    elapsed = time.time() - start
+    con.rollback()
+    con.close()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, elapsed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        print '{} {}'.format(*measure(sys.argv[2], int(sys.argv[3])))
+        sys.exit(0)
+
+    try:
+        rows = int(sys.argv[1])
+    except IndexError:
+        rows = 2000000
+    try:
+        chunk_size = int(sys.argv[2])
+    except IndexError:
+        chunk_size = 5000
+
+    management_con = psycopg2.connect(**SETTINGS.DB)
+    management_con.set_isolation_level(0)
+    management_cur = management_con.cursor()
+    management_cur.execute('CREATE DATABASE '+DBNAME)
+
+    con = psycopg2.connect(**db_settings())
+    try:
+        cur = con.cursor()
+        cur.execute('CREATE LANGUAGE plpythonu')
+        cur.execute('CREATE TABLE bench_table (id INT PRIMARY KEY, mail VARCHAR(100))')
+        cur.execute("INSERT INTO bench_table SELECT i, 'user' || i || "+
+                    "'@bench.tld' FROM generate_series(1, %s) i", [rows])
+        make_binding().install(con)
+        con.commit()
+
+        print '{} rows, chunks of {}'.format(rows, chunk_size)
+        for mode in ('fetchall', 'init'):
+            out = subprocess.check_output(
+                [sys.executable, '-m', 'benchmarks.init_memory', '--child',
+                 mode, str(chunk_size)])
+            peak, elapsed = out.split()
+            print '{:<9} peak RSS {:>8.1f}MB {:>8.1f}s'.format(
+                mode, int(peak) / 1024., float(elapsed))
+    finally:
+        con.close()
+        management_cur.execute('DROP DATABASE '+DBNAME)
+        management_con.close()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Measures the per-row overhead of the stored stub, by timing inserts into a
+table bound to a function which does nothing (Noop).
+
+The "before" figure uses the stub as it was before decoded args and
+function instances got cached per backend (a SQL query, a base64/marshal
+decoding and an instanciation on each row).
+
+Runs against the functional tests platform (see README), usage :
+
+    $ python -m benchmarks.trigger_overhead [rows]
+"""
+import os
+import sys
+import time
+
+os.environ['COPISTE_SETTINGS_MODULE'] = 'tests.settings_testenv'
+from copiste.settings import SETTINGS
+del os.environ['COPISTE_SETTINGS_MODULE']
+
+import psycopg2
+
+import copiste.binding
+import copiste.functions.base
+import copiste.sql
+
+DBNAME = 'copiste_bench'
+
+LEGACY_STUB = """
+CREATE FUNCTION {func_name}()
+RETURNS TRIGGER
+AS
+$$
+  import copiste
+  import copiste.functions.base
+  import marshal
+  sql_pyargs = "SELECT data FROM copiste_pyargs WHERE funcname = '{func_name}'"
+  pyargs_marshalled = plpy.execute(sql_pyargs)[0]['data']
+  pyargs = marshal.loads(pyargs_marshalled.decode('base64'))
+  f = copiste.functions.base.Noop(**pyargs)
+  return f.call(TD, plpy)
+$$
+LANGUAGE plpythonu SECURITY DEFINER;
+"""
+
+class LegacyNoop(copiste.functions.base.Noop):
+    def sql_install(self):
+        return LEGACY_STUB.format(func_name=self.func_name())
+
+    def pymodule_name(self):
+        return 'base'
+
+
+def time_inserts(con, function, rows):
+    """ Installs function on a fresh table and times rows inserts.
+
+    @returns the elapsed time, in seconds
+    """
+    cur = con.cursor()
+    cur.execute('DROP TABLE IF EXISTS bench_table')
+    cur.execute('CREATE TABLE bench_table (id INT, mail VARCHAR(100))')
+    trigger = copiste.sql.WriteTrigger('bench_table', 'bench')
+    copiste.binding.Bind(trigger, function).install(con)
+    con.commit()
+
+    start = time.time()
+    cur.execute(
+        "INSERT INTO bench_table SELECT i, 'user'||i||'@bench.tld' "+
+        "FROM generate_series(1, %s) AS i", [rows])
+    elapsed = time.time() - start
+    con.rollback()
+    return elapsed
+
+
+if __name__ == '__main__':
+    try:
+        rows = int(sys.argv[1])
+    except IndexError:
+        rows = 10000
+
+    management_con = psycopg2.connect(**SETTINGS.DB)
+    management_con.set_isolation_level(0)
+    management_cur = management_con.cursor()
+    management_cur.execute('CREATE DATABASE '+DBNAME)
+
+    db_settings = SETTINGS.DB.copy()
+    db_settings['database'] = DBNAME
+    con = psycopg2.connect(**db_settings)
+    try:
+        con.cursor().execute('CREATE LANGUAGE plpythonu')
+        con.commit()
+        for label, function in (
+                ('before (no cache)', LegacyNoop()),
+                ('after (cached)', copiste.functions.base.Noop())):
+            elapsed = time_inserts(con, function, rows)
+            print '{:<20} {:>8} rows {:>8.3f}s {:>8.1f}us/row'.format(
+                label, rows, elapsed, elapsed / rows * 1e6)
+    finally:
+        con.close()
+        management_cur.execute('DROP DATABASE '+DBNAME)
+        management_con.close()
@@ -1,21 +1,374 @@
+import hashlib
+import random
+import re
+import time
+
+import psycopg2
+
+import copiste.functions.base
+import copiste.sql
+import copiste.stats
+
+# checkpoints of "copiste init", one row per range of a table
+PROGRESS_TABLE = 'copiste_init_progress'
+
+def sql_create_progress_table():
+    return ('CREATE TABLE IF NOT EXISTS {} ('+
+            'funcname TEXT NOT NULL, part INT NOT NULL, '+
+            'lower TEXT[], upper TEXT[], last TEXT[], '+
+            'rows BIGINT NOT NULL DEFAULT 0, '+
+            'done BOOLEAN NOT NULL DEFAULT false, '+
+            'updated TIMESTAMP NOT NULL DEFAULT now(), '+
+            'PRIMARY KEY (funcname, part));').format(PROGRESS_TABLE)
+
+def sql_drop_progress_table():
+    return 'DROP TABLE IF EXISTS {}'.format(PROGRESS_TABLE)
+
+# first PostgreSQL version reading ctid ranges by TID range scans
+TID_RANGE_SCAN_VERSION = 140000
+
+# names of the triggers created by a sql_enable() sentence
+_CREATED_TRIGGER = re.compile(r'CREATE (?:CONSTRAINT )?TRIGGER (\S+) ')
+
+def _as_text(columns):
+    return ', '.join(['{}::text'.format(c) for c in columns])
+
+def _to_text(bound):
+    """ A range bound, as stored in the progress table """
+    if bound is None:
+        return None
+    if isinstance(bound, tuple):
+        return list(bound)
+    return [str(bound)]
+
+def _from_text(bound, keyed):
+    if bound is None:
+        return None
+    if keyed:
+        return tuple(bound)
+    return int(bound[0])
+
 class DoesNotExist(Exception):
     pass
 
+def installed_state(con):
+    """ Reads what copiste installed, with a single catalog query
+
+    @returns a dict giving, for each installed function name, a (triggers,
+             args) tuple : see Bind.sql_reload().
+    """
+    cur = con.cursor()
+    cur.execute(
+        copiste.functions.base.PlPythonFunction.sql_create_pyargs_table() +
+        "SELECT t.tgname, t.tgrelid::regclass::text, "+
+        "obj_description(t.oid, 'pg_trigger'), p.proname, a.data "+
+        "FROM pg_trigger t JOIN pg_proc p ON p.oid = t.tgfoid "+
+        "LEFT JOIN copiste_pyargs a ON a.funcname = p.proname "+
+        "WHERE p.proname LIKE 'copiste\\_\\_%' AND NOT t.tgisinternal")
+    state = {}
+    for name, table, comment, func_name, args in cur.fetchall():
+        triggers, _ = state.setdefault(func_name, ({}, args))
+        triggers[(table, name)] = comment
+    return state
+
+def apply(con, bindings, locks=None):
+    """ Updates the installed bindings to match the given ones : installs
+    the new ones, reloads the changed ones (see Bind.reload()) and uninstalls
+    those which are not given anymore, along with the warm-up function.
+
+    What is installed is read with a single query, and the DDL sent at once,
+    touching only the tables of changed bindings. The caller commits.
+
+    @param locks a LockRetry : the DDL of each binding is then sent apart,
+                 through it, and committed as soon as it succeeds
+    @returns a list of (binding or removed function name, action) tuples,
+             action being "installed", "reinstalled", "reloaded", "unchanged",
+             "removed", or "locked" if its tables could not be locked.
+    """
+    state = installed_state(con)
+    functions = {}
+    for func_name, (triggers, _) in state.items():
+        for _, name in triggers:
+            functions[name] = func_name
+
+    # (binding or function name, action, tables, sql)
+    changes = []
+    for binding in bindings:
+        installed_name = None
+        for name in (binding.trigger.db_names() +
+                     binding.capture_trigger().db_names()):
+            installed_name = installed_name or functions.get(name)
+        if installed_name is None or installed_name not in state:
+            changes.append((binding, 'installed', binding.trigger.table,
+                            binding.sql_install()))
+            continue
+        binding.function.set_uuid(
+            binding.function.extract_uuid(installed_name))
+        triggers, args = state.pop(installed_name)
+        action, binding_sql = binding.sql_reload(installed_name, triggers, args)
+        # the binding may have moved to another table
+        tables = ', '.join(sorted(set(
+                    [binding.trigger.table] + [t for t, _ in triggers])))
+        changes.append((binding, action, tables, binding_sql))
+
+    for func_name, (triggers, _) in sorted(state.items()):
+        sql = ['DROP TRIGGER IF EXISTS {} ON {}'.format(name, table)
+               for table, name in sorted(triggers)]
+        sql += ['DROP FUNCTION {}()'.format(func_name),
+                "DELETE FROM copiste_pyargs WHERE funcname = '{}'".format(
+                    func_name)]
+        tables = ', '.join(sorted(set([t for t, _ in triggers])))
+        changes.append((func_name, 'removed', tables, sql))
+
+    actions, sql, warm = [], [], []
+    cur = con.cursor()
+    for what, action, tables, change_sql in changes:
+        done = True
+        if locks is None:
+            sql += change_sql
+        elif change_sql:
+            done = locks.run(tables, cur.execute, ';\n'.join(change_sql))
+        # new bindings which could not be installed have no function
+        if isinstance(what, Bind) and (done or action != 'installed'):
+            warm.append(what.function)
+        actions.append((what, done and action or 'locked'))
+
+    PlPythonFunction = copiste.functions.base.PlPythonFunction
+    if warm:
+        sql.append(PlPythonFunction.sql_install_warmup(warm))
+    else:
+        sql.append(PlPythonFunction.sql_uninstall_warmup())
+    cur.execute(';\n'.join(sql))
+    return actions
+
+# SQLSTATE of a lock which could not be taken within lock_timeout
+LOCK_NOT_AVAILABLE = '55P03'
+
+class LockRetry(object):
+    """ Runs DDL which locks a table without stalling its traffic
+
+    Each run happens in a transaction of its own, with a short lock_timeout :
+    waiting for a lock held by a long query would otherwise queue every
+    query of the table behind the DDL. Runs which time out are retried, after
+    a random wait (doubled at each try, up to max_backoff), until the
+    deadline ; tables which could then not be locked are listed in failed.
+
+    As locks are only released at commit, the transaction is committed
+    before each run and after it succeeds : no lock taken on another table
+    is held while waiting.
+    """
+    def __init__(self, con, lock_timeout=2000, deadline=60, backoff=0.5,
+                 max_backoff=10, sleep=time.sleep):
+        """
+        @param con          a psycopg2 connection
+        @param lock_timeout max time to wait for a lock, in milliseconds
+        @param deadline     max time to spend on a table, in seconds
+        @param backoff      max wait before the first retry, in seconds
+        @param max_backoff  max wait between two tries, in seconds
+        """
+        self.con = con
+        self.lock_timeout = lock_timeout
+        self.deadline = deadline
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.failed = []
+
+    def run(self, table, method, *args):
+        """ Calls method(*args), which runs DDL on table, and commits it.
+
+        What the current transaction did before is committed first. Errors
+        other than lock timeouts are raised.
+
+        @returns whether it succeeded : otherwise the changes are rolled back,
+                 and table is listed in failed.
+        """
+        self.con.commit()
+        cur = self.con.cursor()
+        started = time.time()
+        backoff = self.backoff
+        while True:
+            cur.execute('SET LOCAL lock_timeout = {:d}'.format(
+                    self.lock_timeout))
+            try:
+                method(*args)
+            except psycopg2.Error, e:
+                self.con.rollback()
+                if e.pgcode != LOCK_NOT_AVAILABLE:
+                    raise
+            else:
+                self.con.commit()
+                return True
+
+            wait = random.uniform(0, backoff)
+            if time.time() + wait - started > self.deadline:
+                self.failed.append(table)
+                return False
+            self.sleep(wait)
+            backoff = min(backoff * 2, self.max_backoff)
+
 class Bind:
     """ A bind is an association between a trigger and a function.
     """
-    def __init__(self, trigger, function):
+    def __init__(self, trigger, function, options={}, phase=None):
+        """
+        @param options function options, stored with its args :
+               - profile : profile one call out of that number
+               - ldap_idle_timeout : (LDAP functions) close the LDAP
+                 connection once unused for that many seconds
+               - ldap_window : (LDAP functions) max number of LDAP writes
+                 pending at once, when handling a batch of changes
+               - ldap_cache_size : (LDAP functions) max number of LDAP
+                 entries cached during a transaction, 0 disables the cache
+        @param phase the init phase of the binding, see init_phase()
+        """
         self.trigger = trigger
+        self.phase = phase
         self.function = function
+        self.function.options.update(options)
+
+    def install(self, con, capture=False):
+        """Store the trigger and the function inside the db
+
+        @param capture install the capture trigger instead of the binding one,
+                       see capture_trigger()
+        """
+        con.cursor().execute(';\n'.join(self.sql_install(capture)))
+
+    def sql_install(self, capture=False):
+        """
+        @returns the list of SQL sentences installing the binding
+        """
+        sql = [self.function.sql_create_pyargs_table(),
+               copiste.stats.sql_create_stats_table(),
+               copiste.stats.sql_create_profiles_table(),
+               sql_create_progress_table(),
+               self.function.sql_insert_args(),
+               self.function.sql_install()]
+        if capture:
+            trigger = self.capture_trigger()
+            return (sql + trigger.sql_requirements() +
+                    [self.sql_enable_trigger(trigger)])
+        return sql + self.sql_enable()
 
-    def install(self, con):
-        """Store the trigger and the function inside the db"""
+    def enable_trigger(self, con):
+        con.cursor().execute(';\n'.join(self.sql_enable()))
+
+    def sql_enable(self):
+        """
+        @returns the list of SQL sentences creating the triggers, commented
+                 with their digest
+        """
+        sql = self.trigger.sql_requirements() + [self.sql_enable_trigger()]
+        created = []
+        for name in _CREATED_TRIGGER.findall(sql[-1]):
+            # created in alternative branches, see StatementWriteTrigger
+            if not name in created:
+                created.append(name)
+        if created:
+            sql.append(self.trigger.sql_comment(
+                    created, self.trigger_digest()))
+        return sql
+
+    def capture_trigger(self):
+        """ The trigger queueing the changes of the table while it is loaded
+        by "copiste init --online", named after the binding one.
+        """
+        return copiste.sql.QueueWriteTrigger(
+            self.trigger.table, '{}__capture'.format(self.trigger.name))
+
+    def switch_capture(self, con):
+        """ Replaces the capture trigger by the binding one, in the current
+        transaction.
+        """
+        con.cursor().execute(self.capture_trigger().sql_disable())
+        self.enable_trigger(con)
+
+    def sql_enable_trigger(self, trigger=None):
+        return (trigger or self.trigger).sql_enable(
+            self.function.func_name(), events=self.function.handled_events(),
+            columns=self.function.sql_columns())
+
+    def trigger_digest(self):
+        """ A digest of the trigger definition, stored as the SQL triggers
+        comment, to tell if they have to be recreated on reload.
+        """
+        return hashlib.md5(self.sql_enable_trigger()).hexdigest()
+
+    def installed_triggers(self, con):
+        """
+        @returns a dict giving the comment of each installed SQL trigger
+        """
         cur = con.cursor()
-        pg_funcname = self.function.func_name()
-        cur.execute(self.function.sql_create_pyargs_table())
-        cur.execute(self.function.sql_insert_args())
-        cur.execute(self.function.sql_install())
-        cur.execute(self.trigger.sql_enable(pg_funcname))
+        cur.execute("SELECT tgname, obj_description(oid, 'pg_trigger') "+
+                    "FROM pg_trigger WHERE tgrelid = %s::regclass "+
+                    "AND tgname = ANY(%s)",
+                    [self.trigger.table, self.trigger.db_names()])
+        return dict(cur.fetchall())
+
+    def reload(self, con):
+        """ Updates the installed binding, dropping its triggers only if their
+        definition changed.
+
+        If only the function args changed, they are rewritten and the
+        function replaced : its stub embeds a digest of the args, running
+        backends thus reload the function and its args on their next call,
+        no lock is taken on the table.
+
+        @returns what was done : "installed", "reinstalled", "reloaded" or
+                 "unchanged".
+        """
+        try:
+            installed_name = self.load_function(con)
+        except DoesNotExist:
+            self.install(con)
+            return 'installed'
+
+        cur = con.cursor()
+        cur.execute('SELECT data FROM copiste_pyargs WHERE funcname = %s',
+                    [installed_name])
+        row = cur.fetchone()
+        # on any table, the binding may have moved
+        triggers, _ = installed_state(con).get(installed_name, ({}, None))
+        action, sql = self.sql_reload(installed_name, triggers,
+                                      row and row[0])
+        if sql:
+            cur.execute(';\n'.join(sql))
+        return action
+
+    def sql_reload(self, installed_name, triggers, args):
+        """ Tells how to update the installed binding, see reload()
+
+        The function has to be loaded (see load_function()).
+
+        @param installed_name the name of the installed function
+        @param triggers       a dict giving the comment of each installed SQL
+                              trigger calling it, by (table, name)
+        @param args           its stored args, if any
+        @returns a ("reinstalled", "reloaded" or "unchanged", list of SQL
+                 sentences) tuple
+        """
+        digests = set(triggers.values())
+        if (digests != set([self.trigger_digest()]) or
+            installed_name != self.function.func_name()):
+            # same transaction : no change is missed while the trigger is
+            # recreated.
+            # every trigger calling the function, wherever it is, for it to be
+            # dropped
+            sql = [self.trigger.sql_disable()]
+            sql += ['DROP TRIGGER IF EXISTS {} ON {}'.format(name, table)
+                    for table, name in sorted(triggers)
+                    if (table != self.trigger.table or
+                        name not in self.trigger.db_names())]
+            sql += ['DROP FUNCTION {}()'.format(installed_name),
+                    "DELETE FROM copiste_pyargs WHERE funcname = '{}'".format(
+                        installed_name)]
+            return 'reinstalled', sql + self.sql_install()
+
+        if args and hashlib.md5(args).hexdigest() == self.function.args_key():
+            return 'unchanged', []
+        return 'reloaded', [self.function.sql_update_args(),
+                            self.function.sql_install(replace=True)]
 
     def uninstall(self, con):
         """Remove the trigger and the function from the db"""
@@ -23,29 +376,311 @@ class Bind:
 
         cur = con.cursor()
         cur.execute(self.trigger.sql_disable())
+        cur.execute(self.capture_trigger().sql_disable())
         cur.execute(self.function.sql_uninstall())
         cur.execute(self.function.sql_remove_args())
 
-    def initial_sync(self, con):
+    def primary_key(self, con):
+        """
+        @returns the primary key columns of the table, in order, an empty
+                 list if it has none.
+        """
+        cur = con.cursor()
+        cur.execute("SELECT a.attname FROM pg_index i "+
+                    "JOIN pg_attribute a ON a.attrelid = i.indrelid "+
+                    "AND a.attnum = ANY(i.indkey) "+
+                    "WHERE i.indrelid = %s::regclass AND i.indisprimary "+
+                    "ORDER BY array_position(i.indkey::int2[], a.attnum)",
+                    [self.trigger.table])
+        return [row[0] for row in cur.fetchall()]
+
+    def init_phase(self):
+        """ Bindings are initialized by phases, in ascending order : those of
+        a phase may run concurrently (see copiste.init.ParallelInit).
+
+        @returns the phase given to the binding, defaulting to the
+                 INIT_PHASE of the function
+        """
+        if self.phase is not None:
+            return self.phase
+        return self.function.INIT_PHASE
+
+    def install_init(self, con):
+        """ Creates the data initialization function of the binding """
         self.load_function(con)
+        con.cursor().execute(
+            self.function.sql_install_init(self.trigger.table))
+
+    def uninstall_init(self, con):
+        con.cursor().execute(
+            self.function.sql_uninstall_init(self.trigger.table))
+
+    def initial_sync(self, con, chunk_size=5000, progress=None,
+                     resume=False):
+        """ Replays the function on the rows already in the table
+
+        Rows do not leave the database : the function gets them through its
+        call_batch(), chunk_size at a time, chunks being ranges of the
+        primary key ; each is committed, then checkpointed (see
+        init_parts()). Tables without a primary key are handled in a single
+        statement, row by row.
 
+        @param progress called after each chunk, with the number of rows
+                        done so far
+        @param resume   continue from the last checkpoint, if any
+        @returns the number of rows
+        """
+        self.install_init(con)
+        parts = self.init_parts(con, 1, resume)
+        con.commit()
+        try:
+            keyed = bool(self.primary_key(con))
+            done = sum([p[3] for p in parts])
+            for part, lower, upper, rows, finished in parts:
+                if finished:
+                    continue
+                report = None
+                if progress:
+                    report = lambda n, before=done: progress(before + n)
+                if keyed:
+                    done += self.sync_range(con, chunk_size, lower, upper,
+                                            progress=report, part=part)
+                else:
+                    done += self.sync_blocks(con, lower, upper,
+                                             progress=report, part=part)
+            return done
+        finally:
+            con.rollback()
+            self.uninstall_init(con)
+            con.commit()
+
+    def init_parts(self, con, parts=1, resume=False):
+        """ Plans the ranges of the table to load, and records them in the
+        progress table, which the loads update as they go.
+
+        @param parts  the number of ranges
+        @param resume keep the ranges planned by a previous run, if any,
+                      starting each after its last loaded key
+        @returns a list of (part, lower, upper, rows, done) tuples, rows being
+                 those already loaded, see split_range() and split_blocks()
+                 for lower and upper.
+        """
+        keyed = bool(self.primary_key(con))
+        func_name = self.function.func_name()
         cur = con.cursor()
-        cur.execute(self.function.sql_install_init(self.trigger.table))
-        cur.execute('SELECT * FROM {}'.format(self.trigger.table))
-        for row in cur.fetchall():
-            cur.callproc(self.function.init_func_name(), [row])
+        cur.execute(sql_create_progress_table())
+        if resume:
+            cur.execute(('SELECT part, coalesce(last, lower), upper, rows, '+
+                         'done FROM {} WHERE funcname = %s ORDER BY part'
+                        ).format(PROGRESS_TABLE), [func_name])
+            planned = cur.fetchall()
+            if planned:
+                return [(part, _from_text(lower, keyed),
+                         _from_text(upper, keyed), rows, done)
+                        for part, lower, upper, rows, done in planned]
+
+        cur.execute('DELETE FROM {} WHERE funcname = %s'.format(
+                PROGRESS_TABLE), [func_name])
+        if keyed:
+            ranges = self.split_range(con, parts)
+        else:
+            ranges = self.split_blocks(con, parts)
+        planned = []
+        for part, (lower, upper) in enumerate(ranges):
+            cur.execute(('INSERT INTO {} (funcname, part, lower, upper) '+
+                         'VALUES (%s, %s, %s, %s)').format(PROGRESS_TABLE),
+                        [func_name, part, _to_text(lower), _to_text(upper)])
+            planned.append((part, lower, upper, 0, False))
+        return planned
+
+    def checkpoint(self, con, part, rows, last=None, done=False):
+        """ Records the progress of a part, and the stats of the init
+        function, once a chunk is committed.
 
-        cur.execute(self.function.sql_uninstall_init(self.trigger.table))
+        This is done in a transaction of its own : the chunks may read an
+        exported snapshot, which does not see the checkpoints and stats
+        written since, and fails to update them.
+
+        @param part the part of the progress table, or None
+        """
+        cur = con.cursor()
+        cur.execute("SELECT {}('{{}}')".format(
+                self.function.init_func_name()))
+        if part is not None:
+            cur.execute(('UPDATE {} SET last = coalesce(%s, last), '+
+                         'rows = rows + %s, done = %s, updated = now() '+
+                         'WHERE funcname = %s AND part = %s'
+                        ).format(PROGRESS_TABLE),
+                        [_to_text(last), rows, done,
+                         self.function.func_name(), part])
+        con.commit()
+
+    def estimate_rows(self, con):
+        """
+        @returns the number of rows of the table estimated by the planner, or
+                 None if it was never analyzed.
+        """
+        cur = con.cursor()
+        cur.execute('SELECT reltuples::bigint FROM pg_class '+
+                    'WHERE oid = %s::regclass', [self.trigger.table])
+        rows = cur.fetchone()[0]
+        if rows > 0:
+            return rows
+        return None
+
+    def split_range(self, con, parts):
+        """ Splits the table into ranges of its primary key holding about the
+        same number of rows.
+
+        Keys are given as text, which PostgreSQL casts back to the column
+        types in comparisons.
+
+        @returns a list of (lower, upper) tuples of primary key values, lower
+                 excluded and upper included, None meaning unbounded.
+        """
+        if parts <= 1:
+            # no need to count and sort the table
+            return [(None, None)]
+        keys = [copiste.sql.quote_ident(k) for k in self.primary_key(con)]
+        cur = con.cursor()
+        cur.execute('SELECT count(*) FROM {}'.format(self.trigger.table))
+        count = cur.fetchone()[0]
+        step = max(1, -(-count // parts))
+        cur.execute('SELECT {0} FROM (SELECT {1}, row_number() OVER '
+                    '(ORDER BY {1}) AS n FROM {2}) t '
+                    'WHERE n %% %s = 0 AND n < %s ORDER BY {1}'.format(
+                        _as_text(keys), ', '.join(keys), self.trigger.table),
+                    [step, count])
+        bounds = [None] + [tuple(row) for row in cur.fetchall()] + [None]
+        return zip(bounds[:-1], bounds[1:])
+
+    def split_blocks(self, con, parts):
+        """ Splits a table without a primary key into ranges of its pages
+
+        Before PostgreSQL 14, ctid ranges are not read with TID range scans,
+        each would scan the whole table : it is then left in one range.
+
+        @returns a list of (first, last) page numbers, last excluded, None
+                 meaning unbounded.
+        """
+        if con.server_version < TID_RANGE_SCAN_VERSION:
+            return [(None, None)]
+        cur = con.cursor()
+        cur.execute("SELECT pg_relation_size(%s::regclass) / "
+                    "current_setting('block_size')::int",
+                    [self.trigger.table])
+        blocks = cur.fetchone()[0]
+        step = max(1, -(-blocks // parts))
+        bounds = range(0, blocks, step)[1:]
+        bounds = [None] + bounds + [None]
+        return zip(bounds[:-1], bounds[1:])
+
+    @staticmethod
+    def _begin(cur, snapshot):
+        # every transaction of a parallel init reads the same snapshot
+        if snapshot:
+            cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            cur.execute('SET TRANSACTION SNAPSHOT %s', [snapshot])
+
+    def sync_range(self, con, chunk_size=5000, lower=None, upper=None,
+                   progress=None, snapshot=None, part=None):
+        """ Replays the function on a range of the primary key, by chunks,
+        each one committed. The init function has to be installed.
+
+        @param lower   primary key values after which to start, if any
+        @param upper   last primary key values to handle, if any
+        @param snapshot an exported snapshot all chunks should read
+        @param part    the part of the progress table to checkpoint, if any
+        @returns the number of rows
+        """
+        table = self.trigger.table
+        init_func_name = self.function.init_func_name()
+        keys = [copiste.sql.quote_ident(k) for k in self.primary_key(con)]
+        columns = ', '.join(keys)
+        con.commit()
+        cur = con.cursor()
+        done = 0
+        last = lower
+        params = lambda values: ', '.join(['%s'] * len(values))
+        while True:
+            self._begin(cur, snapshot)
+            conditions, args = [], []
+            if last is not None:
+                conditions.append('({}) > ({})'.format(columns, params(last)))
+                args += list(last)
+            if upper is not None:
+                conditions.append('({}) <= ({})'.format(
+                        columns, params(upper)))
+                args += list(upper)
+            where = ''
+            if conditions:
+                where = 'WHERE ' + ' AND '.join(conditions)
+            cur.execute('SELECT {} FROM {} {} ORDER BY {} OFFSET %s LIMIT 1'
+                        .format(_as_text(keys), table, where, columns),
+                        args + [chunk_size - 1])
+            end = cur.fetchone()
+            if end is not None:
+                conditions.append('({}) <= ({})'.format(columns, params(end)))
+                args += list(end)
+                where = 'WHERE ' + ' AND '.join(conditions)
+            cur.execute(('SELECT {}(array_agg(t ORDER BY {}), false) '+
+                         'FROM {} t {}').format(
+                    init_func_name, columns, table, where), args)
+            rows = cur.fetchone()[0] or 0
+            con.commit()
+            self.checkpoint(con, part, rows, end, done=end is None)
+            done += rows
+            if progress:
+                progress(done)
+            if end is None:
+                return done
+            last = end
+
+    def sync_blocks(self, con, first=None, last=None, progress=None,
+                    snapshot=None, part=None):
+        """ Replays the function on a range of pages of a table without a
+        primary key, row by row, in a single statement. The init function has
+        to be installed.
+
+        @param first the first page, if any
+        @param last  the page before which to stop, if any
+        @param snapshot an exported snapshot to read
+        @param part  the part of the progress table to checkpoint, if any
+        @returns the number of rows
+        """
+        cur = con.cursor()
+        con.commit()
+        self._begin(cur, snapshot)
+        conditions = []
+        if first is not None:
+            conditions.append("ctid >= '({},0)'::tid".format(int(first)))
+        if last is not None:
+            conditions.append("ctid < '({},0)'::tid".format(int(last)))
+        where = ''
+        if conditions:
+            where = 'WHERE ' + ' AND '.join(conditions)
+        cur.execute('SELECT sum({}(ARRAY[t], false)) FROM {} t {}'.format(
+                self.function.init_func_name(), self.trigger.table, where))
+        done = cur.fetchone()[0] or 0
+        con.commit()
+        self.checkpoint(con, part, done, done=True)
+        if progress:
+            progress(done)
+        return done
 
     def load_function(self, con):
         """ Loads the right existant function UUID, related to the trigger
+
+        @returns the name of the installed function
         """
         cur = con.cursor()
-        cur.execute(self.function.sql_get_for_trigger(self.trigger.db_name()))
+        cur.execute(self.function.sql_get_for_trigger(
+                self.trigger.db_names() + self.capture_trigger().db_names()))
         try:
-            uuid = self.function.extract_uuid(cur.fetchone()[0])
+            installed_name = cur.fetchone()[0]
         except TypeError:
             func_name = self.function.func_name()
             raise DoesNotExist(
                 'Tried to load a non-existent function ({})'.format(func_name))
-        self.function.set_uuid(uuid)
+        self.function.set_uuid(self.function.extract_uuid(installed_name))
+        return installed_name
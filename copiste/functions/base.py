@@ -1,6 +1,254 @@
-import inspect
+import collections
+import hashlib
+import itertools
+import json
 import marshal
-import uuid
+import os
+import re
+import sys
+
+import copiste.sql
+import copiste.stats
+
+# key of the function options in the stored args
+OPTIONS_KEY = '_copiste_options'
+
+WARMUP_FUNCTION = 'copiste_warmup'
+
+# Prepared plans, kept for the life of the backend (see
+# PlPythonFunction.prepare()), emptied when it reaches PLANS_CACHE_SIZE.
+PLANS_CACHE_SIZE = 100
+_PLANS = {}
+
+_TEMPLATES = {}
+# templates which parameters could not be typed, see execute_template()
+_UNTYPED_TEMPLATES = set()
+_TEMPLATE_TOKEN = re.compile(r"'(?:[^']|'')*'|\{\{|\}\}|\{(\w+)\}")
+_LITERAL_PART = re.compile(r"(\{\{|\}\}|\{\w+\})")
+
+def dumps_row(row, columns=None):
+    """ Encodes a row into JSON, to be recorded in a table
+
+    @param columns the columns to keep, all if None
+    """
+    if row is None:
+        return None
+    if columns is not None:
+        row = dict([(k, v) for k, v in row.items() if k in columns])
+    return json.dumps(row, default=str)
+
+def loads_change(row):
+    """ Decodes a recorded change (see QueueWriteTrigger and
+    BufferedWriteTrigger)
+
+    @param row the (id, event, table_name, old_row, new_row) of the change
+    @returns a TD-like dict
+    """
+    _, event, table_name, old_row, new_row = row
+    TD = {'event': event, 'when': 'AFTER', 'level': 'ROW',
+          'table_name': table_name}
+    if old_row is not None:
+        TD['old'] = loads_row(old_row)
+    if new_row is not None:
+        TD['new'] = loads_row(new_row)
+    return TD
+
+def loads_row(data):
+    """ Decodes a recorded row, giving utf-8 strings as plpython would
+    """
+    row = {}
+    for k, v in json.loads(data).items():
+        if isinstance(v, unicode):
+            v = v.encode('utf-8')
+        row[k.encode('utf-8')] = v
+    return row
+
+def render_template(template, field, literal):
+    """ Replaces the fields of a query template
+
+    @param field   called with the name of a field out of any SQL literal,
+                   gives what replaces it
+    @param literal called with the parts of a SQL literal holding fields
+                   (strings, and field names as 1-tuples), gives what
+                   replaces the literal
+    """
+    def replace(match):
+        token = match.group(0)
+        if token in ('{{', '}}'):
+            return token[0]
+        elif match.group(1):
+            return field(match.group(1))
+
+        parts = []
+        for part in _LITERAL_PART.split(token[1:-1]):
+            if part in ('{{', '}}'):
+                part = part[0]
+            elif part.startswith('{'):
+                parts.append((part[1:-1],))
+                continue
+            if parts and not isinstance(parts[-1], tuple):
+                parts[-1] += part
+            elif part:
+                parts.append(part)
+        if not [p for p in parts if isinstance(p, tuple)]:
+            return "'{}'".format(''.join(parts))
+        return literal(parts)
+
+    return _TEMPLATE_TOKEN.sub(replace, template)
+
+def compile_template(template):
+    """ Turns a query template into a query with bind parameters
+
+    Templates are the SQL requests given in functions args, fields such as
+    "{name}" or "'{name}'" (quoted, as a literal would be) are replaced by
+    $1, $2..., the same name always using the same parameter. Fields within
+    a larger literal ("'%{name}%'") are concatenated to its other parts.
+
+    @returns a (query, names) tuple, names being the ordered fields names
+             giving each parameter value.
+    """
+    try:
+        return _TEMPLATES[template]
+    except KeyError:
+        pass
+
+    names = []
+    def param(name):
+        if not name in names:
+            names.append(name)
+        return '${}'.format(names.index(name) + 1)
+
+    def literal(parts):
+        parts = [isinstance(p, tuple) and param(p[0]) or "'{}'".format(p)
+                 for p in parts]
+        if len(parts) == 1:
+            return parts[0]
+        return '({})'.format(' || '.join(parts))
+
+    compiled = (render_template(template, param, literal), names)
+    _TEMPLATES[template] = compiled
+    return compiled
+
+def inline_template(template, data, quote_literal):
+    """ Turns a query template into a query holding the fields values as
+    literals, untyped as the template ones.
+
+    @param quote_literal the plpy.quote_literal() function
+    """
+    def value(name):
+        v = data[name]
+        if v is None:
+            return 'NULL'
+        elif isinstance(v, bool):
+            return v and 'true' or 'false'
+        elif isinstance(v, (int, long, float)) or is_decimal(v):
+            return str(v)
+        else:
+            return quote_literal(str(v))
+
+    def literal(parts):
+        values = []
+        for p in parts:
+            if isinstance(p, tuple):
+                if data[p[0]] is None:
+                    return 'NULL'
+                p = str(data[p[0]]).replace("'", "''")
+            values.append(p)
+        return "'{}'".format(''.join(values))
+
+    return render_template(template, value, literal)
+
+def is_decimal(value):
+    # decimal is slow to import, and values can not be Decimal unless
+    # someone (ex: plpython, for numeric columns) imported it.
+    decimal = sys.modules.get('decimal')
+    return decimal is not None and isinstance(value, decimal.Decimal)
+
+def pg_type(value):
+    """ Gives the PostgreSQL type to use to bind a python value
+
+    Strings are bound as text, which, unlike a literal, does not compare to
+    other types (ex: uuid) : see execute_template().
+    """
+    if isinstance(value, bool):
+        return 'boolean'
+    elif isinstance(value, (int, long)):
+        return 'bigint'
+    elif isinstance(value, float):
+        return 'double precision'
+    elif is_decimal(value):
+        return 'numeric'
+    else:
+        return 'text'
+
+def coalesce_changes(changes, key):
+    """ Merges the changes affecting a same target into their net effect
+
+    For example INSERT+UPDATE gives an INSERT of the updated row, and
+    INSERT+UPDATE+DELETE gives nothing at all.
+
+    @param changes an iterable of TD-like dicts (with "event", "old", "new")
+    @param key     a function giving the target (ex: a DN) of a row
+    @returns the list of net changes, ordered by their last change.
+    """
+    net = collections.OrderedDict()
+    for TD in changes:
+        event = TD['event']
+        if event == 'INSERT':
+            k = key(TD['new'])
+            previous = net.pop(k, None)
+            if previous and previous['event'] == 'DELETE':
+                net[k] = dict(TD, event='UPDATE', old=previous['old'])
+            else:
+                net[k] = TD
+
+        elif event == 'UPDATE':
+            previous = net.pop(key(TD['old']), None)
+            if previous is None:
+                merged = TD
+            elif previous['event'] == 'INSERT':
+                merged = dict(previous, new=TD['new'])
+            else:
+                merged = dict(TD, old=previous['old'])
+            net[key(TD['new'])] = merged
+
+        elif event == 'DELETE':
+            k = key(TD['old'])
+            previous = net.pop(k, None)
+            if previous is None or previous['event'] == 'DELETE':
+                net[k] = TD
+            elif previous['event'] == 'UPDATE':
+                net[k] = dict(TD, old=previous['old'])
+            # INSERT+DELETE : nothing happened
+
+        else:
+            raise ValueError('unknown event : '+event)
+
+    return net.values()
+
+
+def warmup(functions, plpy, GD):
+    """ Loads functions ahead of their first call, in the current backend
+
+    Failures are only logged, warming up must not prevent from connecting.
+
+    @param functions a list of (module name, class name, func_name, args_key)
+    @returns the number of loaded functions
+    """
+    loaded = 0
+    for pymodule_name, class_name, func_name, args_key in functions:
+        try:
+            module = __import__('copiste.functions.'+pymodule_name,
+                                fromlist=[class_name])
+            f = getattr(module, class_name).load(func_name, args_key, plpy, GD)
+            f.warmup(plpy)
+        except Exception, e:
+            plpy.warning('copiste: could not warm up {} : {}'.format(
+                    func_name, e))
+        else:
+            loaded += 1
+    return loaded
+
 
 class PlPythonFunction(object):
     """ An abstract plpython object
@@ -9,16 +257,38 @@ class PlPythonFunction(object):
     functions.
 
     One should extend it, overriding call() and optionally __init__()
+
+    Besides its args, a function has options, which are not about what it
+    does but how (ex: "profile"), they are stored along with the args.
+
+    Queries issued from call() should go through execute() or
+    execute_template(), so that they get planned once per backend.
+
+    Functions bound to statement-level triggers get all the changes of a
+    statement at once through call_batch(), which can be overriden to handle
+    them smarter than one by one.
     """
+    # functions writing to what others create get initialized after them
+    INIT_PHASE = 0
+
     def __init__(self, **kwargs):
         self.args = kwargs
 
+        # relid -> primary key columns, see primary_key()
+        self._primary_keys = {}
+
+        self.options = {}
+
+        # runtime counters and profile, see copiste.stats
+        self.stats = copiste.stats.Stats()
+        self.profiler = copiste.stats.Profiler()
+
         # builds a uuid withou '-' sign which is forbidden in SQL functions names
-        self.uuid = ''
         # take only the two last uuid groups because all is too long for
-        # postgres proname
-        for f in uuid.uuid4().fields[-2:]:
-            self.uuid += str(f)
+        # postgres proname : that is what uuid.uuid4().fields[-2:] gives,
+        # without importing uuid, which is slow.
+        rand = os.urandom(7)
+        self.uuid = str(ord(rand[0])) + str(int(rand[1:].encode('hex'), 16))
 
     def pymodule_name(self):
         return  self.__module__.split('.')[-1]
@@ -42,29 +312,46 @@ class PlPythonFunction(object):
 
 
     def _marshalled_args(self):
-        return marshal.dumps(self.args).encode('base64').strip()
+        pyargs = self.args
+        if self.options:
+            pyargs = dict(pyargs)
+            pyargs[OPTIONS_KEY] = self.options
+        return marshal.dumps(pyargs).encode('base64').strip()
+
+    def args_key(self):
+        """ A digest of the marshalled args, embedded in the stored stub.
+
+        It changes each time the args change, so that backends holding a
+        cached copy of them know they have to reload it.
+        """
+        return hashlib.md5(self._marshalled_args()).hexdigest()
 
 
-    def sql_install(self):
+    def sql_install(self, replace=False):
         """ Stores the function inside the db. Actually stores only a stub,
-        which will call the function. """
-        pyargs_marshalled = self._marshalled_args()
+        which will call the function.
+
+        @param replace replace the stored function if it exists, backends
+               then reload it, as the stub changes with args_key().
+        """
         sql = """
-CREATE FUNCTION {func_name}()
+CREATE {or_replace}FUNCTION {func_name}()
 RETURNS TRIGGER
 AS
 $$
-  import copiste
-  import copiste.functions.{pymodule_name}
-  import marshal
-  sql_pyargs = "SELECT data FROM copiste_pyargs WHERE funcname = '{func_name}'"
-  pyargs_marshalled = plpy.execute(sql_pyargs)[0]['data']
-  pyargs = marshal.loads(pyargs_marshalled.decode('base64'))
-  f = copiste.functions.{pymodule_name}.{class_name}(**pyargs)
-  return f.call(TD, plpy)
+  try:
+    f = SD['function']
+  except KeyError:
+    import copiste.functions.{pymodule_name}
+    f = copiste.functions.{pymodule_name}.{class_name}.load(
+      '{func_name}', '{args_key}', plpy, GD)
+    SD['function'] = f
+  return f.run(TD, plpy)
 $$
 LANGUAGE plpythonu SECURITY DEFINER;
-        """.format(func_name          = self.func_name(),
+        """.format(or_replace         = replace and 'OR REPLACE ' or '',
+                   func_name          = self.func_name(),
+                   args_key           = self.args_key(),
                    pymodule_name      = self.pymodule_name(),
                    class_name         = self.__class__.__name__)
         return sql
@@ -75,6 +362,10 @@ INSERT INTO copiste_pyargs(funcname, data) VALUES('{}', '{}');
 """.format(self.func_name(), self._marshalled_args())
         return sql
 
+    def sql_update_args(self):
+        sql = "UPDATE copiste_pyargs SET data = '{}' WHERE funcname = '{}';"
+        return sql.format(self._marshalled_args(), self.func_name())
+
     def sql_remove_args(self):
         sql = "DELETE FROM copiste_pyargs WHERE funcname = '{}';".format(
             self.func_name())
@@ -84,25 +375,41 @@ INSERT INTO copiste_pyargs(funcname, data) VALUES('{}', '{}');
         return 'DROP FUNCTION {}()'.format(self.func_name())
 
     def sql_install_init(self, table):
+        """ The data initialization function : it gives an array of rows of
+        table to call_batch(), as inserts, counted in the stats as "INIT".
+
+        @returns the SQL creating the function, which returns the number of
+                 handled rows.
+        """
         sql = """
-CREATE FUNCTION {init_func_name}(new {table_name})
-RETURNS void
+CREATE FUNCTION {init_func_name}(rows {table_name}[],
+                                 flush boolean DEFAULT true)
+RETURNS integer
 AS
 $$
-  import copiste
-  import copiste.functions.{pymodule}
-  import marshal
-  sql_pyargs = "SELECT data FROM copiste_pyargs WHERE funcname = '{func_name}'"
-  pyargs_marshalled = plpy.execute(sql_pyargs)[0]['data']
-  pyargs = marshal.loads(pyargs_marshalled.decode('base64'))
-  f = copiste.functions.{pymodule}.{pyfunc_name}(**pyargs)
-  f.call({{'new': new, 'event': 'INSERT'}}, plpy)
+  if not rows:
+    if flush and 'function' in SD:
+      SD['function'].stats.flush(plpy, '{func_name}', force=True)
+    return 0
+  try:
+    f = SD['function']
+  except KeyError:
+    import copiste.functions.{pymodule}
+    f = copiste.functions.{pymodule}.{pyfunc_name}.load(
+      '{func_name}', '{args_key}', plpy, GD)
+    SD['function'] = f
+  f.measured('INIT', plpy, f.call_batch,
+             [{{'new': new, 'event': 'INSERT', 'when': 'AFTER',
+               'level': 'ROW', 'table_name': '{table_name}'}}
+              for new in rows])
+  f.stats.flush(plpy, '{func_name}', force=flush)
+  return len(rows)
 $$
 LANGUAGE plpythonu;
         """.format(
             init_func_name  = self.init_func_name(),
             func_name = self.func_name(),
-            args_data  = self._marshalled_args(),
+            args_key  = self.args_key(),
             pyfunc_name= self.__class__.__name__,
             table_name = table,
             pymodule   = self.pymodule_name()
@@ -110,20 +417,367 @@ LANGUAGE plpythonu;
         return sql
 
     def sql_uninstall_init(self, table):
-        return 'DROP FUNCTION {}(new {})'.format(self.init_func_name(), table)
+        return 'DROP FUNCTION IF EXISTS {}({}[], boolean)'.format(
+            self.init_func_name(), table)
 
-    def sql_create_pyargs_table(self):
+    @staticmethod
+    def sql_create_pyargs_table():
         return 'CREATE TABLE IF NOT EXISTS copiste_pyargs (funcname TEXT UNIQUE, data TEXT);'
 
-    def sql_get_for_trigger(self, trigger_name):
+    def sql_get_for_trigger(self, trigger_names):
+        """
+        @param trigger_names a trigger name, or a list of the names of the
+               triggers calling the function
+        """
+        if isinstance(trigger_names, basestring):
+            trigger_names = [trigger_names]
         return """
 SELECT proname FROM pg_trigger JOIN pg_proc ON pg_proc.oid=pg_trigger.tgfoid
-WHERE pg_trigger.tgname = '{}'
-        """.format(trigger_name)
+WHERE pg_trigger.tgname IN ({}) LIMIT 1
+        """.format(', '.join(["'{}'".format(n) for n in trigger_names]))
 
     def set_uuid(self, uuid):
         self.uuid = uuid
 
+    def run(self, TD, plpy):
+        """ Entry point of the stored stub, records the stats of dispatch(),
+        and profiles one call out of the "profile" option, if set.
+        """
+        if copiste.sql.FLUSH in (TD.get('args') or []):
+            event = 'FLUSH'
+        else:
+            event = TD['event']
+        if self.profiler.sampled(self.options.get('profile')):
+            result = self.profiler.runcall(
+                self.measured, event, plpy, self.dispatch, TD)
+        else:
+            result = self.measured(event, plpy, self.dispatch, TD)
+        self.stats.flush(plpy, self.func_name())
+        self.profiler.flush(plpy, self.func_name())
+        return result
+
+    def measured(self, event, plpy, method, arg):
+        """ Calls method(arg, plpy), counting it into the stats of event
+
+        plpy is wrapped to count the time spent in SQL.
+        """
+        started = self.stats.start(event)
+        try:
+            result = method(arg, self.stats.timed_plpy(plpy))
+        except:
+            self.stats.stop(started, failed=True)
+            raise
+        else:
+            self.stats.stop(started)
+            return result
+
+    def dispatch(self, TD, plpy):
+        """ Dispatches row-level triggers to call() and statement-level ones
+        to call_batch().
+
+        Row-level AFTER triggers (ex: the update trigger of a
+        StatementWriteTrigger on a table without primary key) see the state
+        following the change, as call_batch() expects : they give it a single
+        change.
+        """
+        trigger_args = TD.get('args') or []
+        if copiste.sql.BUFFER in trigger_args:
+            return self.buffer_change(TD, plpy)
+        elif copiste.sql.FLUSH in trigger_args:
+            return self.flush_buffer(plpy)
+        elif copiste.sql.ENQUEUE in trigger_args:
+            return self.enqueue_change(TD, plpy)
+        elif TD['level'] == 'STATEMENT':
+            return self.call_batch(self.transition_changes(TD, plpy), plpy)
+        elif TD.get('when') == 'AFTER':
+            return self.call_batch([TD], plpy)
+        else:
+            return self.call(TD, plpy)
+
+    def current_txid(self, plpy):
+        return self.execute(plpy, 'SELECT txid_current() AS txid')[0]['txid']
+
+    def buffer_change(self, TD, plpy):
+        """ Records a row change into the buffer table, to be handled by
+        flush_buffer() ; it is rolled back along with the change.
+        """
+        columns = self.sql_columns()
+        self.execute(
+            plpy,
+            ('INSERT INTO {}(txid, funcname, event, table_name, old_row, '+
+             'new_row) VALUES (txid_current(), $1, $2, $3, $4, $5)'
+            ).format(copiste.sql.BUFFER_TABLE),
+            [self.func_name(), TD['event'], TD['table_name'],
+             dumps_row(TD.get('old'), columns),
+             dumps_row(TD.get('new'), columns)])
+
+    def flush_buffer(self, plpy):
+        """ Handles all the changes recorded by the current transaction
+
+        Called for each changed row at commit time, only the first call has
+        something to do.
+        """
+        rows = self.execute(
+            plpy,
+            ('DELETE FROM {} WHERE txid = txid_current() AND funcname = $1 '+
+             'RETURNING id, event, table_name, old_row, new_row'
+            ).format(copiste.sql.BUFFER_TABLE),
+            [self.func_name()])
+        if not rows:
+            return
+        rows = sorted(rows, key=lambda row: row['id'])
+        self.call_batch(
+            [loads_change((row['id'], row['event'], row['table_name'],
+                           row['old_row'], row['new_row'])) for row in rows],
+            plpy)
+
+    def call_batch(self, changes, plpy):
+        """ Handles a set of changes at once
+
+        Unlike call(), it is called once the changes are done : SQL queries
+        see the state following them.
+
+        @param changes an iterable of TD-like dicts, one per changed row
+        """
+        for TD in changes:
+            self.call(TD, plpy)
+
+    def handled_events(self):
+        """ The row events the function does something with
+
+        Triggers only subscribe to those.
+        """
+        return copiste.sql.EVENTS
+
+    def is_transient(self, error):
+        """ Whether an error raised while handling a change may not happen
+        again (ex: a server down), or comes from the change itself.
+        """
+        return False
+
+    def sql_columns(self):
+        """ The columns of the trigger table the function reads
+
+        @returns a sorted list of columns names, or None if it may use any.
+        """
+        return None
+
+    def enqueue_change(self, TD, plpy):
+        """ Queues a row change, to be handled by the "copiste run" worker
+        """
+        columns = self.sql_columns()
+        self.execute(
+            plpy,
+            ('INSERT INTO {}(funcname, event, table_name, old_row, new_row) '+
+             'VALUES ($1, $2, $3, $4, $5)').format(copiste.sql.QUEUE_TABLE),
+            [self.func_name(), TD['event'], TD['table_name'],
+             dumps_row(TD.get('old'), columns),
+             dumps_row(TD.get('new'), columns)])
+        self.execute(plpy, "SELECT pg_notify($1, '')",
+                     [copiste.sql.QUEUE_CHANNEL])
+
+    def transition_changes(self, TD, plpy):
+        """ Reads the transition tables of a statement-level trigger
+
+        @returns a generator of row-level-like TD dicts
+        """
+        event = TD['event']
+        common = {
+            'event': event,
+            'when': TD['when'],
+            'level': 'ROW',
+            'name': TD['name'],
+            'table_name': TD['table_name'],
+            'table_schema': TD['table_schema'],
+            'relid': TD['relid'],
+            'args': TD['args'],
+        }
+        select = 'SELECT * FROM {}'
+        if event == 'INSERT':
+            for new in plpy.cursor(select.format(copiste.sql.NEW_TABLE)):
+                yield dict(common, new=new)
+        elif event == 'DELETE':
+            for old in plpy.cursor(select.format(copiste.sql.OLD_TABLE)):
+                yield dict(common, old=old)
+        elif event == 'UPDATE':
+            # the tables are not read in any given order : rows are paired by
+            # primary key (see StatementWriteTrigger), those which key changed
+            # can not be, they are given as deleted then inserted.
+            key = self.primary_key(plpy, TD['relid'])
+            olds = collections.OrderedDict()
+            for i, old in enumerate(
+                    plpy.cursor(select.format(copiste.sql.OLD_TABLE))):
+                olds[key and tuple([old[k] for k in key]) or i] = old
+            inserted = []
+            for new in plpy.cursor(select.format(copiste.sql.NEW_TABLE)):
+                old = None
+                if key:
+                    old = olds.pop(tuple([new[k] for k in key]), None)
+                if old is None:
+                    inserted.append(new)
+                else:
+                    yield dict(common, old=old, new=new)
+            for old in olds.values():
+                yield dict(common, event='DELETE', old=old)
+            for new in inserted:
+                yield dict(common, event='INSERT', new=new)
+
+    def primary_key(self, plpy, relid):
+        """ The primary key columns of a table, read once per backend
+
+        @returns a list of column names, empty if there is no primary key
+        """
+        try:
+            return self._primary_keys[relid]
+        except KeyError:
+            rows = self.execute(
+                plpy,
+                'SELECT a.attname FROM pg_index i JOIN pg_attribute a '+
+                'ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) '+
+                'WHERE i.indrelid = $1::oid AND i.indisprimary '+
+                'ORDER BY a.attnum', [str(relid)])
+            key = self._primary_keys[relid] = [r['attname'] for r in rows]
+            return key
+
+    def prepare(self, plpy, query, types=[]):
+        """ Prepares a query, the plan is cached for the life of the backend
+
+        @param query a SQL query, using $1, $2... as parameters
+        @param types the PostgreSQL type names of the parameters
+        @returns a plpy plan
+        """
+        key = (query, tuple(types))
+        try:
+            return _PLANS[key]
+        except KeyError:
+            if len(_PLANS) >= PLANS_CACHE_SIZE:
+                _PLANS.clear()
+            plan = plpy.prepare(query, list(types))
+            _PLANS[key] = plan
+            return plan
+
+    def execute(self, plpy, query, args=[]):
+        """ Runs a query through the plans cache
+
+        @param query a SQL query, using $1, $2... as parameters
+        @param args  the values of the parameters, their types are guessed
+                     with pg_type()
+        """
+        plan = self.prepare(plpy, query, [pg_type(v) for v in args])
+        return plpy.execute(plan, list(args))
+
+    def cursor(self, plpy, query, args=[]):
+        """ Same as execute(), but the rows are fetched as they are iterated
+        over, rather than all at once.
+        """
+        plan = self.prepare(plpy, query, [pg_type(v) for v in args])
+        return plpy.cursor(plan, list(args))
+
+    def execute_template(self, plpy, template, data):
+        """ Runs a query template through the plans cache
+
+        Should the template not be planned with the types of the values
+        (ex: a string compared to an uuid column), it is run with the values
+        inlined as literals, without plans cache, from then on.
+
+        @param template a query template (see compile_template())
+        @param data     a dict (usualy a SQL row) holding the fields values
+        """
+        return self._run_template(plpy, plpy.execute, template, data)
+
+    def cursor_template(self, plpy, template, data):
+        """ Same as execute_template(), but the rows are fetched as they are
+        iterated over.
+        """
+        return self._run_template(plpy, plpy.cursor, template, data)
+
+    def _run_template(self, plpy, run, template, data):
+        if not template in _UNTYPED_TEMPLATES:
+            query, names = compile_template(template)
+            args = [data[n] for n in names]
+            try:
+                plan = self.prepare(plpy, query, [pg_type(v) for v in args])
+            except plpy.SPIError:
+                _UNTYPED_TEMPLATES.add(template)
+            else:
+                return run(plan, args)
+        return run(inline_template(template, data, plpy.quote_literal))
+
+    @classmethod
+    def load(cls, func_name, args_key, plpy, GD):
+        """ Builds the function stored as func_name, from its stored args
+
+        This is what the stored stubs call the first time they run in a
+        backend, the returned instance is then kept in their SD. Instances
+        are also kept in GD for the life of the backend, so that the trigger
+        and the data initialization functions share them, and so that
+        copiste_warmup() can build them ahead ; they are built again only if
+        args_key differs from the cached one (reinstall).
+
+        @param args_key the args_key() the stub was generated with
+        @param GD       the plpython global dict
+        """
+        cache = GD.setdefault('copiste_functions', {})
+        try:
+            cached_key, f = cache[func_name]
+            if cached_key == args_key:
+                return f
+        except KeyError:
+            pass
+
+        sql_pyargs = "SELECT data FROM copiste_pyargs WHERE funcname = '{}'"
+        pyargs_marshalled = plpy.execute(
+            sql_pyargs.format(func_name))[0]['data']
+        pyargs = marshal.loads(pyargs_marshalled.decode('base64'))
+
+        f = cls.from_pyargs(pyargs)
+        f.set_uuid(cls.extract_uuid(func_name))
+        cache[func_name] = (args_key, f)
+        return f
+
+    @classmethod
+    def from_pyargs(cls, pyargs):
+        """ Builds a function from its stored args, options included
+        """
+        pyargs = dict(pyargs)
+        options = pyargs.pop(OPTIONS_KEY, {})
+        f = cls(**pyargs)
+        f.options = options
+        return f
+
+    def warmup(self, plpy):
+        """ Does ahead what the first call would (imports, connections...)
+        """
+        pass
+
+    @staticmethod
+    def sql_install_warmup(functions):
+        """ Gives the SQL sentence storing the warm-up function
+
+        Calling it (ex: as the connect query of a connection pooler) loads
+        the functions, their args and what they need in the backend, sparing
+        the cost of it to the first triggered write.
+
+        @param functions the installed functions
+        """
+        return """
+CREATE OR REPLACE FUNCTION {warmup_name}()
+RETURNS integer
+AS
+$$
+  import copiste.functions.base
+  return copiste.functions.base.warmup({functions!r}, plpy, GD)
+$$
+LANGUAGE plpythonu SECURITY DEFINER;
+        """.format(warmup_name = WARMUP_FUNCTION,
+                   functions   = [(f.pymodule_name(), f.__class__.__name__,
+                                   f.func_name(), f.args_key())
+                                  for f in functions])
+
+    @staticmethod
+    def sql_uninstall_warmup():
+        return 'DROP FUNCTION IF EXISTS {}()'.format(WARMUP_FUNCTION)
+
     @staticmethod
     def sql_drop_pyargs_table():
         return 'DROP TABLE IF EXISTS copiste_pyargs'
@@ -138,6 +792,12 @@ class LogWarn(PlPythonFunction):
     def call(self, TD, plpy):
         plpy.warning(self.args['message'])
 
+class Noop(PlPythonFunction):
+    """ Function doing nothing, useful to measure the cost of the stub
+    """
+    def call(self, TD, plpy):
+        pass
+
 class DebugParams(PlPythonFunction):
     """ Function that prints to sql log the content of its TD arg and a message
     """
@@ -1,33 +1,117 @@
-import ldap
+import collections
+import time
 
-from copiste.ldapsync import LDAPModel, LDAPUtils
-from copiste.functions.base import PlPythonFunction
+# python-ldap is imported where used, see copiste.ldapsync
+import copiste.ldapsync
+from copiste.ldapsync import LDAPModel, LDAPPipeline, LDAPUtils
+from copiste.functions.base import PlPythonFunction, coalesce_changes
 
 class LDAPWriterFunction(PlPythonFunction):
     def get_ldap_model(self):
-        return LDAPModel(**(self.args['ldap_model']))
+        # built once, as function instances live as long as the backend
+        try:
+            return self._ldap_model
+        except AttributeError:
+            self._ldap_model = LDAPModel(**(self.args['ldap_model']))
+            return self._ldap_model
+
+    def warmup(self, plpy):
+        import ldap.modlist
+        self.get_ldap_model()
+        self.ldap_connect()
+
+    def is_transient(self, error):
+        import ldap
+        return isinstance(error, (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.BUSY,
+                                  ldap.UNAVAILABLE))
+
+    def ldap_connect(self, reconnect=False):
+        """ Gives a bound connection, from the connections of the backend
+
+        They are kept for "ldap_idle_timeout" seconds (function option, 300 by
+        default) once unused.
+        """
+        started = time.time()
+        c = copiste.ldapsync.CONNECTIONS.get(
+            self.args['ldap_creds'], reconnect=reconnect,
+            idle_timeout=self.options.get('ldap_idle_timeout', 300))
+        self.stats.add('ldap_time', time.time() - started)
+        return self.stats.timed_ldap(c)
+
+    def with_connection(self, method, arg, plpy):
+        """ Calls method(arg, plpy, ldap_c)
+
+        If the server went away (ex: it closed the connection, idle) before
+        any write was sent, the call is retried once on a new connection :
+        writes are not replayed, as they may have been done.
+
+        Entries read or written are cached until the end of the transaction,
+        in a cache shared by the functions using the same connection, up to
+        the largest "ldap_cache_size" (function option, 1000 by default, 0
+        disables the cache) of them. The transaction is only checked once
+        per call, and only if the cache is used.
+        """
+        import ldap
+        cache = copiste.ldapsync.CONNECTIONS.cache(self.args['ldap_creds'])
+        self.get_ldap_model().cache = cache
+        cache.size = max(cache.size, self.options.get('ldap_cache_size', 1000))
+        cache.begin(lambda: self.current_txid(plpy))
+        ldap_c = self.ldap_connect()
+        try:
+            try:
+                return method(arg, plpy, ldap_c)
+            except ldap.SERVER_DOWN:
+                if ldap_c.writes:
+                    copiste.ldapsync.CONNECTIONS.discard(
+                        self.args['ldap_creds'])
+                    raise
+                plpy.log('LDAP connection lost, reconnecting')
+                cache.clear()
+                return method(arg, plpy, self.ldap_connect(reconnect=True))
+        except:
+            # writes may have been lost half-way
+            cache.clear()
+            raise
 
     def call(self, TD, plpy):
-        creds = self.args['ldap_creds']
-        event = TD['event']
+        self.with_connection(self.handle, TD, plpy)
+
+    def call_batch(self, changes, plpy):
+        # listed, to be iterated again on retry
+        self.with_connection(self.pipelined_batch, list(changes), plpy)
 
-        c = ldap.initialize(creds['host'])
-        c.simple_bind_s(creds['bind_dn'], creds['bind_pw'])
+    def pipelined_batch(self, changes, plpy, ldap_c):
+        """ Runs handle_batch(), sending its LDAP writes asynchronously
+
+        Up to "ldap_window" (function option, 64 by default) writes are
+        pending at once.
+        """
+        pipeline = LDAPPipeline(
+            ldap_c, window=self.options.get('ldap_window', 64))
         try:
-            if event == 'DELETE':
-                self.handle_DELETE(TD, plpy, c)
-            elif event == 'UPDATE':
-                self.handle_UPDATE(TD, plpy, c)
-            elif event == 'INSERT':
-                self.handle_INSERT(TD, plpy, c)
-            else:
-                raise ValueError('unknown event : '+event )
+            self.handle_batch(changes, plpy, pipeline)
         except:
-            c.unbind_s()
+            pipeline.discard()
             raise
+        pipeline.flush()
 
+    def handle(self, TD, plpy, ldap_c):
+        event = TD['event']
+        if event == 'DELETE':
+            self.handle_DELETE(TD, plpy, ldap_c)
+        elif event == 'UPDATE':
+            self.handle_UPDATE(TD, plpy, ldap_c)
+        elif event == 'INSERT':
+            self.handle_INSERT(TD, plpy, ldap_c)
         else:
-            c.unbind_s()
+            raise ValueError('unknown event : '+event )
+
+    def handle_batch(self, changes, plpy, ldap_c):
+        """ Handles a set of changes with a single LDAP connection, one by
+        one ; subclasses group them by target entry.
+        """
+        for TD in changes:
+            self.handle(TD, plpy, ldap_c)
 
 
 
@@ -37,6 +121,9 @@ class StoreIfExists(LDAPWriterFunction):
     If one or more row(s) related to our model exists in SQL table, set a given
     attribute to a given value; otherwise, remove that attributes.
     """
+    # entries are expected to exist
+    INIT_PHASE = 1
+
     def __init__(self, sql_test_attr, key_map,
                  ldap_model,ldap_store_key, ldap_store_val, ldap_creds):
 
@@ -55,6 +142,10 @@ class StoreIfExists(LDAPWriterFunction):
             ' WHERE {sql_key} = {sql_key_val}'
         super(StoreIfExists, self).__init__(**kwargs)
 
+    def sql_columns(self):
+        return sorted(set(self.args['key_map'].values() +
+                          [self.args['sql_test_attr']]))
+
     def handle_INSERT(self, TD, plpy, ldap_c):
         ldap_key, sql_key = self.args['key_map'].items()[0]
         ldap_identify = {ldap_key: TD['new'][sql_key]}
@@ -88,10 +179,10 @@ class StoreIfExists(LDAPWriterFunction):
         store_val = self.args['ldap_store_val']
 
         # >1 cause we have to count the row that is going to be deleted
-        sql = "SELECT COUNT(*) > 1 FROM {} WHERE {} = '{}'".format(
-            TD['table_name'], sql_key, old[sql_key])
+        sql = "SELECT COUNT(*) > 1 FROM {} WHERE {} = $1".format(
+            plpy.quote_ident(TD['table_name']), plpy.quote_ident(sql_key))
 
-        has_match = plpy.execute(sql)[0].values()[0]
+        has_match = self.execute(plpy, sql, [old[sql_key]])[0].values()[0]
         if not has_match:
             model = self.get_ldap_model()
             plpy.log('setting "{}" for {} from SQL'.format(
@@ -99,6 +190,43 @@ class StoreIfExists(LDAPWriterFunction):
             model.remove_from_attr(
                 ldap_c, ldap_identify_old, store_attr, store_val)
 
+    def handle_batch(self, changes, plpy, ldap_c):
+        """ Checks once each key involved in the changes, against the SQL
+        state following them.
+        """
+        ldap_key, sql_key = self.args['key_map'].items()[0]
+        store_attr = self.args['ldap_store_key']
+        store_val = self.args['ldap_store_val']
+        model = self.get_ldap_model()
+
+        keys = collections.OrderedDict()
+        table_name = None
+        for TD in changes:
+            table_name = TD['table_name']
+            for row in (TD.get('old'), TD.get('new')):
+                if row and row[sql_key] is not None:
+                    keys[row[sql_key]] = True
+
+        if keys:
+            sql = "SELECT EXISTS (SELECT 1 FROM {} WHERE {} = $1)".format(
+                plpy.quote_ident(table_name), plpy.quote_ident(sql_key))
+
+        for key in keys:
+            ldap_identify = {ldap_key: key}
+            has_match = self.execute(plpy, sql, [key])[0].values()[0]
+            if has_match:
+                plpy.log('setting "{}" for {} from SQL'.format(
+                        store_attr, model.get_dn(ldap_identify)))
+                model.modify(
+                    ldap_c, ldap_identify,
+                    {store_attr: store_val},
+                    accumulate=True)
+            else:
+                plpy.log('unsetting "{}" for {} from SQL'.format(
+                        store_attr, model.get_dn(ldap_identify)))
+                model.remove_from_attr(
+                    ldap_c, ldap_identify, store_attr, store_val)
+
 
 
 class Copy2LDAP(LDAPWriterFunction):
@@ -124,6 +252,12 @@ class Copy2LDAP(LDAPWriterFunction):
         }
         super(Copy2LDAP, self).__init__(**kwargs)
 
+    def sql_columns(self):
+        # a request may read any column of the row, through the table
+        if self.args['dyn_attrs_map']:
+            return None
+        return sorted(set(self.args['attrs_map'].values()))
+
     def handle_INSERT(self, TD, plpy, ldap_c):
         model = self.get_ldap_model()
         ldap_attrs = self.ldap_data(TD['new'])
@@ -166,6 +300,17 @@ class Copy2LDAP(LDAPWriterFunction):
         plpy.log('deleting {} from SQL'.format(model.get_dn(ldap_attrs)))
         model.delete(ldap_c, ldap_attrs)
 
+    def handle_batch(self, changes, plpy, ldap_c):
+        """ Applies only the net change of each DN
+        """
+        for TD in coalesce_changes(changes, self.change_key):
+            self.handle(TD, plpy, ldap_c)
+
+    def change_key(self, sql_data):
+        """ The DN a SQL row is replicated to
+        """
+        return self.get_ldap_model().get_dn(self.ldap_data(sql_data))
+
     def ldap_data(self, sql_data):
         """ Transforms a SQL row into a dict of attributes ready for LDAP use.
 
@@ -203,7 +348,7 @@ class Copy2LDAP(LDAPWriterFunction):
         @param ldap_attrs the ldap_attrs, already populated
         """
         for k, sql_request in self.args['dyn_attrs_map'].items():
-            res = plpy.execute(sql_request.format(**new_row))
+            res = self.execute_template(plpy, sql_request, new_row)
 
             if len(res) > 0:
                 if not ldap_attrs.has_key(k):
@@ -220,6 +365,9 @@ class Accumulate2LDAPField(LDAPWriterFunction):
     """ This function will store the result of a query in a multi-value
         attribute from a ldap model.
     """
+    # target entries are created by other bindings (ex: Copy2LDAP)
+    INIT_PHASE = 1
+
     def __init__(self, ldap_field, keys_map, ldap_model, ldap_creds, **kwargs):
         # as models are marshalled for db storage, we can't store objects, but
         # only basic types.
@@ -234,6 +382,20 @@ class Accumulate2LDAPField(LDAPWriterFunction):
         })
         super(Accumulate2LDAPField, self).__init__(**kwargs)
 
+    def key_columns(self):
+        """ The local columns identifying the target, see keys_map
+        """
+        columns = set()
+        for sql_k in self.args['keys_map'].values():
+            if isinstance(sql_k, dict):
+                columns.add(sql_k['join'][0])
+            else:
+                columns.add(sql_k)
+        return columns
+
+    def sql_columns(self):
+        return sorted(self.key_columns() | set([self.args['ldap_field']]))
+
     def get_ldap_identifier_map(self, sql_data, plpy):
         """ Returns the required key-val map to identify the target in the LDAP
 
@@ -259,14 +421,14 @@ class Accumulate2LDAPField(LDAPWriterFunction):
                 field_value = sql_data[j['join'][0]]
                 if field_value is None:
                     raise NoSQLJoinMatch
-                vals = plpy.execute((
+                vals = self.execute(plpy, (
                     'SELECT {foreign_field} FROM {foreign_table}'+
-                    ' WHERE {foreign_attr} = {local_val}').format(
+                    ' WHERE {foreign_attr} = $1').format(
                         foreign_field = plpy.quote_ident(j['foreign_field']),
                         foreign_table = plpy.quote_ident(j['foreign_table']),
-                        foreign_attr  = plpy.quote_ident(j['join'][1]),
-                        local_val = plpy.quote_literal(str(field_value))
-                    )
+                        foreign_attr  = plpy.quote_ident(j['join'][1])
+                    ),
+                    [field_value]
                 )
                 try:
                     v = vals[0][j['foreign_field']]
@@ -283,34 +445,18 @@ class Accumulate2LDAPField(LDAPWriterFunction):
     def handle_INSERT(self, TD, plpy, ldap_c):
         field = self.args['ldap_field']
         new_row = TD['new']
-        new_val = new_row[field]
-        dn, previous_values = self.get_accumulator_list(ldap_c, new_row, plpy)
-
-        if not new_val in previous_values:
-            new_values = list(previous_values) # copy
-            new_values.append(new_val)
-
-            ldif = ldap.modlist.modifyModlist(
-                {field : previous_values},
-                {field: new_values}
-            )
-            plpy.log('adding a "{}" value to {} from SQL'.format(field, dn))
-            ldap_c.modify_s(dn, ldif)
+        matches = self.get_ldap_identifier_map(new_row, plpy)
+        dn = self.get_ldap_model().modify_values(
+            ldap_c, matches, field, added=[new_row[field]])
+        plpy.log('adding a "{}" value to {} from SQL'.format(field, dn))
 
     def handle_DELETE(self, TD, plpy, ldap_c):
         field = self.args['ldap_field']
         old_row = TD['old']
-        old_val = old_row[field]
-
-        dn, previous_values = self.get_accumulator_list(ldap_c, old_row, plpy)
-        new_values = list(previous_values) # copy
-        new_values.remove(old_val)
-        ldif = ldap.modlist.modifyModlist(
-            {field : previous_values},
-            {field: new_values}
-        )
+        matches = self.get_ldap_identifier_map(old_row, plpy)
+        dn = self.get_ldap_model().modify_values(
+            ldap_c, matches, field, removed=[old_row[field]])
         plpy.log('removing a "{}" value from {} from SQL'.format(field, dn))
-        ldap_c.modify_s(dn, ldif)
 
     def handle_UPDATE(self, TD, plpy, ldap_c):
         field = self.args['ldap_field']
@@ -320,30 +466,62 @@ class Accumulate2LDAPField(LDAPWriterFunction):
         new_val = new_row[field]
 
         if new_val != old_val:
-            dn, previous_values = self.get_accumulator_list(ldap_c, old_row,
-                                                            plpy)
-            new_values = list(previous_values) # copy
-            new_values.remove(old_val)
-            if not new_val in new_values:
-                new_values.append(new_val)
-            ldif = ldap.modlist.modifyModlist(
-                {field: previous_values},
-                {field: new_values}
-            )
+            matches = self.get_ldap_identifier_map(old_row, plpy)
+            dn = self.get_ldap_model().modify_values(
+                ldap_c, matches, field, added=[new_val], removed=[old_val])
             plpy.log('modifying a "{}" value in {} from SQL'.format(field, dn))
-            ldap_c.modify_s(dn, ldif)
+
+    def handle_batch(self, changes, plpy, ldap_c):
+        """ Writes each target entry once for all the changes
+        """
+        field = self.args['ldap_field']
+
+        # target -> (identifier map, {value: is_add})
+        targets = collections.OrderedDict()
+        for TD in changes:
+            event = TD['event']
+            ops = []
+            if event in ('UPDATE', 'DELETE'):
+                ops.append((TD['old'], False))
+            if event in ('INSERT', 'UPDATE'):
+                ops.append((TD['new'], True))
+
+            ops = [(self.get_ldap_identifier_map(row, plpy), is_add, row[field])
+                   for row, is_add in ops]
+            if (event == 'UPDATE' and
+                ops[0][0] == ops[1][0] and ops[0][2] == ops[1][2]):
+                continue
+
+            for matches, is_add, value in ops:
+                target = tuple(sorted(matches.items()))
+                # the last change of a value wins
+                targets.setdefault(target, (matches, {}))[1][value] = is_add
+
+        model = self.get_ldap_model()
+        for matches, values in targets.values():
+            added = [v for v, is_add in values.items() if is_add]
+            removed = [v for v, is_add in values.items() if not is_add]
+            dn = model.modify_values(ldap_c, matches, field, added, removed)
+            plpy.log('modifying "{}" values in {} from SQL'.format(field, dn))
 
     def has_join(self):
         return isinstance(self.args['keys_map'].values()[0], dict)
 
-    def get_accumulator_list(self, ldap_c, sql_data, plpy):
+    def get_accumulator_list(self, ldap_c, sql_data, plpy, identified=False):
+        """
+        @param identified if True, sql_data is already an identifier map (see
+                          get_ldap_identifier_map())
+        """
         keys_map = self.args['keys_map']
         ldap_model = self.get_ldap_model()
         field = self.args['ldap_field']
 
-        matches = self.get_ldap_identifier_map(sql_data, plpy)
+        if identified:
+            matches = sql_data
+        else:
+            matches = self.get_ldap_identifier_map(sql_data, plpy)
 
-        dn, attrs = ldap_model.get(ldap_c, matches)
+        dn, attrs = ldap_model.get(ldap_c, matches, [field])
         try:
             values = attrs[field]
         except KeyError:
@@ -357,14 +535,26 @@ class AccumulateRequest2LDAPField(Accumulate2LDAPField):
     """ Gets all the results from an SQL request to accumulate into multi-valued
     attr.
 
-    Inefficient but flexible
+    The request runs again on each change, only the difference with the LDAP
+    values is written.
     """
 
     def __init__(self, sql_request, *args, **kwargs):
         kwargs['sql_request'] = sql_request
         super(AccumulateRequest2LDAPField, self).__init__(*args, **kwargs)
 
+    def handled_events(self):
+        return ('INSERT', 'UPDATE')
+
+    def sql_columns(self):
+        # the request may read any column of the row, through the table
+        return None
+
     def mk_sql_req(self, sql_data, plpy):
+        """ Gives the fields of the sql_request for a given row
+
+        @returns a dict, to be given to cursor_template()
+        """
         # Merge extra-id data from the join
         if self.has_join():
             data = {}
@@ -373,15 +563,18 @@ class AccumulateRequest2LDAPField(Accumulate2LDAPField):
             data.update({'_foreign_id': foreign_id})
         else:
             data = sql_data
-
-        return self.args['sql_request'].format(**data)
+        return data
 
     def handle_write_op(self, sql_row, plpy, ldap_c):
         field = self.args['ldap_field']
 
         try:
-            sql_select = self.mk_sql_req(sql_row, plpy)
-            new_values = [i.values()[0] for i in plpy.execute(sql_select)]
+            data = self.mk_sql_req(sql_row, plpy)
+            # streamed, the request may give a lot of values
+            new_values = set()
+            for i in self.cursor_template(plpy, self.args['sql_request'],
+                                          data):
+                new_values.add(i.values()[0])
             dn, previous_values = self.get_accumulator_list(ldap_c, sql_row, plpy)
 
         except NoSQLJoinMatch:
@@ -389,12 +582,11 @@ class AccumulateRequest2LDAPField(Accumulate2LDAPField):
             # is on a list alias)
             pass
         else:
-            ldif = ldap.modlist.modifyModlist(
-                {field : previous_values},
-                {field : new_values}
-            )
-            plpy.log('settings  "{}" value to {} from SQL'.format(field, dn))
-            ldap_c.modify_s(dn, ldif)
+            changed = self.get_ldap_model().set_values(
+                ldap_c, dn, field, previous_values, new_values)
+            if changed:
+                plpy.log('setting "{}" values of {} from SQL ({} changed)'.format(
+                        field, dn, changed))
 
     def handle_INSERT(self, TD, plpy, ldap_c):
         return self.handle_write_op(TD['new'], plpy, ldap_c)
@@ -406,3 +598,18 @@ class AccumulateRequest2LDAPField(Accumulate2LDAPField):
         """Don't accumulate to a field of a vanished record...
         """
         pass
+
+    def handle_batch(self, changes, plpy, ldap_c):
+        """ Runs the request once per target entry
+        """
+        rows = collections.OrderedDict()
+        for TD in changes:
+            if TD['event'] in ('INSERT', 'UPDATE'):
+                try:
+                    matches = self.get_ldap_identifier_map(TD['new'], plpy)
+                except NoSQLJoinMatch:
+                    continue
+                rows[tuple(sorted(matches.items()))] = TD['new']
+
+        for row in rows.values():
+            self.handle_write_op(row, plpy, ldap_c)
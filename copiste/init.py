@@ -0,0 +1,787 @@
+""" Initial data load and reconciliation, run from outside of the database
+
+Bind.initial_sync() runs the function inside PostgreSQL, on chunks of the
+table, each one committed, and ParallelInit does so from several connections
+at once ; OnlineInit lets the tables be written meanwhile. ClientSync streams
+the table to the control host with COPY instead, and hands the rows to the
+function by batches, through its call_batch() : LDAP functions thus keep a
+window of asynchronous writes pending (see
+LDAPWriterFunction.pipelined_batch()).
+
+Resync compares a table with the LDAP entries of a Copy2LDAP function, and
+only writes the differences.
+"""
+import datetime
+import decimal
+import heapq
+import logging
+import marshal
+import multiprocessing
+import re
+import string
+import sys
+import tempfile
+import time
+
+import psycopg2
+
+import copiste.binding
+import copiste.functions.ldapfuncs
+import copiste.sql
+import copiste.stats
+import copiste.worker
+from copiste.ldapsync import LDAPBatchError, LDAPPipeline, LDAPUtils
+
+logger = logging.getLogger('copiste')
+
+_ESCAPE = re.compile(r'\\([0-7]{1,3}|x[0-9a-fA-F]{1,2}|.)')
+_ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+
+def _unescape(match):
+    c = match.group(1)
+    if c in _ESCAPES:
+        return _ESCAPES[c]
+    elif c[0] == 'x' and len(c) > 1:
+        return chr(int(c[1:], 16))
+    elif c[0] in '01234567':
+        return chr(int(c, 8))
+    else:
+        return c
+
+def decode_copy_field(field):
+    """ Decodes a field of the COPY text format
+
+    @returns a str, or None for NULL
+    """
+    if field == '\\N':
+        return None
+    elif '\\' in field:
+        return _ESCAPE.sub(_unescape, field)
+    else:
+        return field
+
+# type name -> conversion from text, to get the values plpython would give
+# (other types are left as str)
+_CONVERTERS = {
+    'bool': lambda v: v == 't',
+    'int2': int,
+    'int4': int,
+    'int8': long,
+    'oid': long,
+    'float4': float,
+    'float8': float,
+    'numeric': decimal.Decimal,
+}
+
+def table_columns(con, table):
+    """
+    @returns a list of (column name, type name) tuples, in the table order
+    """
+    cur = con.cursor()
+    cur.execute('SELECT a.attname, t.typname FROM pg_attribute a '+
+                'JOIN pg_type t ON t.oid = a.atttypid '+
+                'WHERE a.attrelid = %s::regclass AND a.attnum > 0 '+
+                'AND NOT a.attisdropped ORDER BY a.attnum', [table])
+    return cur.fetchall()
+
+def function_columns(con, function, table):
+    """ The columns of table a function reads
+
+    @returns a list of (column name, type name) tuples, in the table order
+    """
+    columns = table_columns(con, table)
+    wanted = function.sql_columns()
+    if wanted is not None:
+        columns = [c for c in columns if c[0] in wanted]
+    return columns
+
+def sorted_externally(records, chunk_size=100000):
+    """ Sorts records which may not fit in memory
+
+    Sorted chunks of chunk_size records are written to temporary files, then
+    merged.
+
+    @param records an iterable of marshallable records
+    @returns an iterator over the sorted records
+    """
+    files = []
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            files.append(_spool(sorted(chunk)))
+            chunk = []
+    if not files:
+        return iter(sorted(chunk))
+    files.append(_spool(sorted(chunk)))
+    return heapq.merge(*[_unspool(f) for f in files])
+
+def _spool(records):
+    f = tempfile.TemporaryFile()
+    for record in records:
+        marshal.dump(record, f)
+    f.seek(0)
+    return f
+
+def _unspool(f):
+    try:
+        while True:
+            yield marshal.load(f)
+    except EOFError:
+        f.close()
+
+
+class CopyRowReader(object):
+    """ File-like object given to psycopg2 copy_expert(), decoding the rows
+    as they are received, and giving them to a callback.
+    """
+    def __init__(self, columns, callback):
+        """
+        @param columns  the (name, type name) of the copied columns
+        @param callback called with each row, as a dict
+        """
+        self.names = [name for name, _ in columns]
+        self.converters = [_CONVERTERS.get(t) for _, t in columns]
+        self.callback = callback
+        # incomplete last line
+        self.pending = ''
+
+    def write(self, data):
+        lines = (self.pending + data).split('\n')
+        self.pending = lines.pop()
+        for line in lines:
+            self.callback(self.decode(line))
+
+    def decode(self, line):
+        row = {}
+        for name, convert, field in zip(
+                self.names, self.converters, line.split('\t')):
+            value = decode_copy_field(field)
+            if value is not None and convert:
+                value = convert(value)
+            row[name] = value
+        return row
+
+
+class ClientSync(object):
+    """ Loads the rows of a table through a function, from outside of the
+    database.
+
+    Each batch of rows is handled in a transaction of its own on con, the
+    table being read at once (one COPY) on copy_con.
+    """
+    def __init__(self, con, copy_con, function, table, batch_size=500):
+        """
+        @param con        a psycopg2 connection, for the queries of the
+                          function
+        @param copy_con   another psycopg2 connection, streaming the table
+        @param function   the function, see copiste.worker.load_functions()
+        @param table      the table to load
+        @param batch_size number of rows given to each call_batch()
+        """
+        self.con = con
+        self.copy_con = copy_con
+        self.function = function
+        self.table = table
+        self.batch_size = batch_size
+        self.plpy = copiste.worker.PlpyAdapter(con)
+        self.batch = []
+        self.rows = 0
+        self.errors = 0
+
+    def sql_copy(self, columns):
+        return 'COPY (SELECT {} FROM {}) TO STDOUT'.format(
+            ', '.join([copiste.sql.quote_ident(name) for name, _ in columns]),
+            self.table)
+
+    def run(self):
+        """ Loads the whole table
+
+        Failed LDAP writes are logged, and do not stop the load.
+
+        @returns a (rows, errors) tuple
+        """
+        columns = function_columns(self.copy_con, self.function, self.table)
+        reader = CopyRowReader(columns, self.add)
+        self.copy_con.cursor().copy_expert(self.sql_copy(columns), reader)
+        self.copy_con.commit()
+        self.flush()
+        return self.rows, self.errors
+
+    def add(self, row):
+        self.batch.append({'event': 'INSERT', 'when': 'AFTER', 'level': 'ROW',
+                           'table_name': self.table, 'new': row})
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Handles the pending rows
+        """
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        try:
+            self.function.call_batch(batch, self.plpy)
+        except LDAPBatchError, e:
+            for dn, error in e.errors:
+                logger.error('failed to load {} : {}'.format(dn, error))
+            self.errors += len(e.errors)
+            self.con.rollback()
+        else:
+            self.con.commit()
+        self.rows += len(batch)
+
+
+# state of the ParallelInit worker processes
+_worker = {}
+
+def _init_worker(pg_credentials, bindings, chunk_size):
+    _worker['con'] = psycopg2.connect(**pg_credentials)
+    _worker['bindings'] = bindings
+    _worker['chunk_size'] = chunk_size
+
+def _run_task(task):
+    """ Handles a range of a table, in a worker process
+
+    @returns a (binding index, rows) tuple
+    """
+    index, kind, part, lower, upper, snapshot = task
+    binding = _worker['bindings'][index]
+    con = _worker['con']
+    try:
+        if kind == 'range':
+            rows = binding.sync_range(con, _worker['chunk_size'], lower, upper,
+                                      snapshot=snapshot, part=part)
+        else:
+            rows = binding.sync_blocks(con, lower, upper, snapshot=snapshot,
+                                       part=part)
+    except Exception:
+        con.rollback()
+        raise
+    return index, rows
+
+
+class ParallelInit(object):
+    """ Runs Bind.initial_sync() on several worker processes, each with its
+    own connection.
+
+    Tables are split into ranges of their primary key (or of their pages,
+    lacking one), one task each, checkpointed like by initial_sync().
+    Bindings run by phases (see Bind.init_phase()) : the tasks of a phase run
+    concurrently, a phase starting once the previous one is over. All the
+    workers read the same snapshot, exported by a transaction kept open
+    meanwhile, so that the load is consistent (a resumed load reads a new
+    one).
+    """
+    def __init__(self, pg_credentials, bindings, jobs, chunk_size=5000,
+                 resume=False):
+        """
+        @param pg_credentials psycopg2.connect() keyword arguments
+        @param bindings       the bindings to initialize
+        @param jobs           the number of worker processes, and of ranges
+                              each table is split into
+        @param chunk_size     rows handled per transaction
+        @param resume         continue from the last checkpoints, if any
+        """
+        self.pg_credentials = pg_credentials
+        self.bindings = bindings
+        self.jobs = jobs
+        self.chunk_size = chunk_size
+        self.resume = resume
+
+    def phases(self):
+        """
+        @returns the bindings indexes, grouped by phase, in order
+        """
+        phases = {}
+        for i, binding in enumerate(self.bindings):
+            phases.setdefault(binding.init_phase(), []).append(i)
+        return [phases[k] for k in sorted(phases)]
+
+    def tasks(self, con, indexes, parts, snapshot):
+        """ Lists the ranges of some bindings left to load
+
+        @param parts the parts of each binding, see Bind.init_parts()
+        """
+        tasks = []
+        for i in indexes:
+            kind = 'blocks'
+            if self.bindings[i].primary_key(con):
+                kind = 'range'
+            tasks += [(i, kind, part, lower, upper, snapshot)
+                      for part, lower, upper, _, done in parts[i] if not done]
+        return tasks
+
+    def export_snapshot(self, cur):
+        """ Starts the transaction holding the snapshot the workers read
+
+        @returns the snapshot id
+        """
+        cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        cur.execute('SELECT pg_export_snapshot()')
+        return cur.fetchone()[0]
+
+    def run(self, progress=None, interval=10):
+        """
+        @param progress called with a binding after each of its tasks, and
+                        every interval seconds for those being loaded
+        @returns the number of rows handled, per binding, as a list
+        """
+        con = psycopg2.connect(**self.pg_credentials)
+        installed = []
+        pool = None
+        try:
+            for binding in self.bindings:
+                binding.install_init(con)
+                installed.append(binding)
+            # ranges partition the keys whatever the snapshot, they are
+            # committed for the workers to checkpoint them
+            parts = [binding.init_parts(con, self.jobs, self.resume)
+                     for binding in self.bindings]
+            con.commit()
+
+            # kept open until the end, for the snapshot to remain importable
+            snapshot = self.export_snapshot(con.cursor())
+
+            pool = multiprocessing.Pool(
+                self.jobs, _init_worker,
+                (self.pg_credentials, self.bindings, self.chunk_size))
+            rows = [sum([p[3] for p in binding_parts])
+                    for binding_parts in parts]
+            for indexes in self.phases():
+                tasks = self.tasks(con, indexes, parts, snapshot)
+                results = pool.imap_unordered(_run_task, tasks)
+                for _ in tasks:
+                    while True:
+                        try:
+                            i, done = results.next(interval)
+                            break
+                        except multiprocessing.TimeoutError:
+                            if progress:
+                                for j in indexes:
+                                    progress(self.bindings[j])
+                    rows[i] += done
+                    if progress:
+                        progress(self.bindings[i])
+            pool.close()
+            pool.join()
+            pool = None
+            return rows
+        finally:
+            if pool is not None:
+                pool.terminate()
+            con.rollback()
+            for binding in installed:
+                binding.uninstall_init(con)
+            con.commit()
+            con.close()
+
+
+class OnlineInit(ParallelInit):
+    """ Loads tables while they are written to, without missing nor
+    replaying twice a change.
+
+    capture() installs the bindings with their capture trigger (see
+    Bind.capture_trigger()), which queues the changes. run() then loads the
+    tables like ParallelInit, from a snapshot taken afterwards : the queued
+    changes it already holds are dropped, the others replayed, from the
+    control host like "copiste run" does, until less than a batch is left.
+    At last, each table is locked against writes while its capture trigger
+    is replaced by the binding one and the few changes queued meanwhile
+    replayed.
+
+    Tables are locked as LockRetry does, so as not to queue their traffic
+    behind the lock. Should it fail, the tables stay in capture mode, changes
+    pile up in the queue : uninstall the bindings to start over.
+    """
+    def __init__(self, pg_credentials, bindings, jobs=1, chunk_size=5000,
+                 batch_size=500, lock_timeout=2000, lock_deadline=60):
+        """
+        @param batch_size max number of queued changes replayed per
+                          transaction
+        @param lock_timeout  see LockRetry
+        @param lock_deadline see LockRetry
+        """
+        ParallelInit.__init__(self, pg_credentials, bindings, jobs,
+                              chunk_size=chunk_size)
+        self.batch_size = batch_size
+        self.lock_timeout = lock_timeout
+        self.lock_deadline = lock_deadline
+        self.seen = []
+
+    def lock_retry(self, con):
+        return copiste.binding.LockRetry(
+            con, lock_timeout=self.lock_timeout, deadline=self.lock_deadline)
+
+    def capture(self):
+        """ Installs the bindings, queueing the changes of their tables """
+        con = psycopg2.connect(**self.pg_credentials)
+        try:
+            locks = self.lock_retry(con)
+            for binding in self.bindings:
+                locks.run(binding.trigger.table, binding.install, con, True)
+            if locks.failed:
+                raise copiste.worker.Error('could not lock {}'.format(
+                        ', '.join(locks.failed)))
+        finally:
+            con.close()
+
+    def export_snapshot(self, cur):
+        snapshot = ParallelInit.export_snapshot(self, cur)
+        # queued by transactions the snapshot sees, thus loaded
+        cur.execute('SELECT id FROM {} WHERE funcname = ANY(%s)'.format(
+                copiste.sql.QUEUE_TABLE),
+                    [[b.function.func_name() for b in self.bindings]])
+        self.seen = [row[0] for row in cur.fetchall()]
+        return snapshot
+
+    def run(self, progress=None, interval=10):
+        """ Loads the tables, then catches up with their changes
+
+        @returns the number of rows loaded, per binding, as a list
+        """
+        rows = ParallelInit.run(self, progress, interval)
+        con = psycopg2.connect(**self.pg_credentials)
+        try:
+            con.cursor().execute(
+                'DELETE FROM {} WHERE id = ANY(%s)'.format(
+                    copiste.sql.QUEUE_TABLE), [self.seen])
+            con.commit()
+            functions = copiste.worker.load_functions(con, self.bindings)
+            worker = copiste.worker.QueueWorker(
+                con, functions, batch_size=self.batch_size)
+            for indexes in self.phases():
+                for i in indexes:
+                    self.catch_up(worker, self.bindings[i])
+            return rows
+        finally:
+            con.rollback()
+            con.close()
+
+    def catch_up(self, worker, binding):
+        """ Replays the queued changes of a binding, then switches it to its
+        own trigger.
+        """
+        con = worker.con
+        # while the table is written to, until a batch is not even full
+        while self.replay(worker, binding) >= self.batch_size:
+            con.commit()
+        con.commit()
+
+        def switch():
+            con.cursor().execute(
+                'LOCK TABLE {} IN SHARE ROW EXCLUSIVE MODE'.format(
+                    binding.trigger.table))
+            # before replaying, so that a lock timeout replays nothing twice
+            binding.switch_capture(con)
+            # the last ones, queued before the lock
+            while self.replay(worker, binding):
+                pass
+
+        if not self.lock_retry(con).run(binding.trigger.table, switch):
+            raise copiste.worker.Error(
+                'could not lock {}, binding {} left capturing'.format(
+                    binding.trigger.table, binding))
+        logger.info('binding {} switched to its trigger'.format(binding))
+
+    def replay(self, worker, binding):
+        """ Handles a batch of the queued changes of a binding, in the
+        current transaction.
+
+        @returns the number of changes
+        """
+        func_name = binding.function.func_name()
+        changes = worker.dequeue(func_name)
+        if changes is None:
+            raise copiste.worker.Error(
+                'the queue of {} is being handled by another worker'.format(
+                    func_name))
+        if changes:
+            f = worker.functions[func_name]
+            f.measured('QUEUE', worker.plpy, f.call_batch, changes)
+        return len(changes)
+
+
+class ProgressReport(object):
+    """ Prints the progress of the load of a binding, as checkpointed in the
+    progress table : rows and LDAP operations per second, and the estimated
+    time left.
+
+    It reads the tables on a connection of its own, the loading ones being
+    inside their transactions.
+    """
+    def __init__(self, con, binding, resume=False, out=None, interval=10):
+        """
+        @param con      a psycopg2 connection
+        @param resume   whether the load continues from checkpoints, the
+                        progress table is cleared otherwise
+        @param out      a file, sys.stdout if None
+        @param interval min time between two reports, in seconds
+        """
+        self.con = con
+        self.binding = binding
+        self.out = out or sys.stdout
+        self.interval = interval
+        self.total = binding.estimate_rows(con)
+        self.started = time.time()
+        self.last_report = self.started
+        self.start_rows, self.start_ops = self.read()
+        if not resume:
+            self.start_rows = 0
+
+    def read(self):
+        """
+        @returns the (rows loaded, LDAP operations) counters
+        """
+        func_name = self.binding.function.func_name()
+        cur = self.con.cursor()
+        cur.execute('SELECT coalesce(sum(rows), 0) FROM {} '
+                    'WHERE funcname = %s'.format(
+                        copiste.binding.PROGRESS_TABLE), [func_name])
+        rows = cur.fetchone()[0]
+        ops = 0
+        for s in copiste.stats.read_stats(self.con, func_name):
+            if s['event'] == 'INIT':
+                ops = s['ldap_searches'] + s['ldap_modifies']
+        self.con.commit()
+        return rows, ops
+
+    def report(self, force=False):
+        now = time.time()
+        if not force and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        rows, ops = self.read()
+        elapsed = max(now - self.started, 0.001)
+        rate = (rows - self.start_rows) / elapsed
+        eta = '?'
+        if self.total and rate > 0:
+            eta = str(datetime.timedelta(
+                    seconds=int(max(self.total - rows, 0) / rate)))
+        self.out.write(
+            '  binding {} : {} row(s), {:.0f} rows/s, {:.0f} LDAP ops/s, '
+            'ETA {}\n'.format(self.binding, rows, rate,
+                               (ops - self.start_ops) / elapsed, eta))
+        self.out.flush()
+
+
+def _values(value):
+    """ The values of a LDAP attribute, as a list
+    """
+    if value is None:
+        return []
+    elif isinstance(value, (list, tuple)):
+        return list(value)
+    else:
+        return [value]
+
+
+# lowercases the ASCII letters only, as PostgreSQL with the "C" collation
+_ASCII_LOWER = string.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+class Resync(object):
+    """ Makes the LDAP entries of a Copy2LDAP function match a table
+
+    The rows, ordered by the DN fields of the LDAP model, are merged with the
+    entries of the model (read page by page, then sorted the same way,
+    out of memory if needed) : only the missing entries are added, the
+    differing ones modified, and those matching no row deleted (or only
+    counted, unless delete is set). Writes are sent asynchronously, see
+    LDAPPipeline.
+
+    Rows and entries are matched on the text of the DN fields, with only the
+    ASCII letters lowercased : the key of the rows is computed by PostgreSQL
+    with the "C" collation, which also orders it bytewise, as python does
+    for the entries.
+    """
+    def __init__(self, con, copy_con, function, table, dry_run=False,
+                 delete=False, page_size=500, sort_chunk_size=100000):
+        """
+        @param con        a psycopg2 connection, for the queries of the
+                          function (dynamic attributes)
+        @param copy_con   another psycopg2 connection, streaming the table
+        @param function   a Copy2LDAP, see copiste.worker.load_functions()
+        @param dry_run    only count the writes to do
+        @param delete     delete the entries matching no row
+        @param page_size  number of LDAP entries read per page
+        @param sort_chunk_size max number of LDAP entries sorted in memory
+        """
+        if not isinstance(function, copiste.functions.ldapfuncs.Copy2LDAP):
+            raise ValueError('only Copy2LDAP functions can be resynced')
+        self.con = con
+        self.copy_con = copy_con
+        self.function = function
+        self.table = table
+        self.dry_run = dry_run
+        self.delete_entries = delete
+        self.page_size = page_size
+        self.sort_chunk_size = sort_chunk_size
+        self.plpy = copiste.worker.PlpyAdapter(con)
+        self.model = function.get_ldap_model()
+
+        attrs_map = function.args['attrs_map']
+        self.dn_fields = self.model.dn_fields()
+        self.key_columns = []
+        for field in self.dn_fields:
+            if not field in attrs_map:
+                raise ValueError(
+                    'DN field "{}" is not in the attributes map'.format(field))
+            self.key_columns.append(attrs_map[field])
+        # the keys, as copied
+        self.key_names = ['_copiste_key{}'.format(i)
+                          for i in range(len(self.key_columns))]
+        # attributes compared, RDNs excepted
+        self.attrs = sorted(
+            (set(attrs_map.keys()) |
+             set(function.args['dyn_attrs_map'].keys())) -
+            set(self.dn_fields))
+
+        self.counts = dict.fromkeys(
+            ('added', 'modified', 'deleted', 'orphans', 'unchanged',
+             'errors'), 0)
+
+    def sql_copy(self, columns):
+        """ Copies the keys of the rows first, then the columns, ordered by
+        the keys
+        """
+        return ('COPY (SELECT {}, {} FROM {} WHERE {} ORDER BY {}) TO STDOUT'
+        ).format(
+            ', '.join(['lower({}::text COLLATE "C")'.format(
+                        copiste.sql.quote_ident(c)) for c in self.key_columns]),
+            ', '.join([copiste.sql.quote_ident(name) for name, _ in columns]),
+            self.table,
+            ' AND '.join(['{} IS NOT NULL'.format(copiste.sql.quote_ident(c))
+                          for c in self.key_columns]),
+            ', '.join([str(i + 1) for i in range(len(self.key_columns))]))
+
+    def row_key(self, row):
+        """ Removes the keys copied along with a row
+
+        @returns the key of the row
+        """
+        return tuple([row.pop(name) for name in self.key_names])
+
+    def entry_key(self, dn, attrs):
+        """
+        @returns the key of an entry, None if it lacks a DN field
+        """
+        attrs = dict([(k.lower(), v) for k, v in attrs.items()])
+        key = []
+        for field in self.dn_fields:
+            values = attrs.get(field.lower(), [])
+            # if multi-valued, the one in the DN
+            in_dn = [v for v in values
+                     if '{}={}'.format(field, v).lower() in dn.lower()]
+            values = in_dn or values
+            if not values:
+                return None
+            key.append(values[0].translate(_ASCII_LOWER))
+        return tuple(key)
+
+    def sorted_entries(self, ldap_c):
+        """
+        @returns an iterator over the (key, dn, attrs) of the model entries,
+                 sorted by key
+        """
+        entries = LDAPUtils.paged_search(
+            ldap_c, self.model.base, self.model.ldap_scope(),
+            self.model.list_query(), self.dn_fields + self.attrs,
+            self.page_size)
+        records = ((self.entry_key(dn, attrs), dn, attrs)
+                   for dn, attrs in entries)
+        return sorted_externally(
+            (r for r in records if r[0] is not None), self.sort_chunk_size)
+
+    def run(self):
+        """ Compares the whole table, and writes the differences
+
+        @returns a dict of counts : "added", "modified", "deleted",
+                 "unchanged" entries, entries matching no row but not deleted
+                 ("orphans"), and failed writes ("errors")
+        """
+        ldap_c = self.function.ldap_connect()
+        self.entries = self.sorted_entries(ldap_c)
+        self.next_entry()
+        self.last_key = None
+        self.ldap_c = LDAPPipeline(
+            ldap_c, window=self.function.options.get('ldap_window', 64))
+
+        columns = function_columns(self.copy_con, self.function, self.table)
+        reader = CopyRowReader(
+            [(name, 'text') for name in self.key_names] + columns,
+            self.merge_row)
+        try:
+            self.copy_con.cursor().copy_expert(self.sql_copy(columns), reader)
+            self.copy_con.commit()
+            while self.entry is not None:
+                self.delete(self.entry[1])
+                self.next_entry()
+        except:
+            self.ldap_c.discard()
+            raise
+        self.con.commit()
+
+        try:
+            self.ldap_c.flush()
+        except LDAPBatchError, e:
+            for dn, error in e.errors:
+                logger.error('failed to resync {} : {}'.format(dn, error))
+            self.counts['errors'] = len(e.errors)
+        return self.counts
+
+    def next_entry(self):
+        self.entry = next(self.entries, None)
+
+    def merge_row(self, row):
+        key = self.row_key(row)
+        if key == self.last_key:
+            logger.warning('several rows of {} give {}, one is kept'.format(
+                    self.table, self.model.get_dn(self.function.ldap_data(row))))
+            return
+        self.last_key = key
+
+        while self.entry is not None and self.entry[0] < key:
+            self.delete(self.entry[1])
+            self.next_entry()
+
+        if self.entry is not None and self.entry[0] == key:
+            _, dn, attrs = self.entry
+            self.next_entry()
+            self.compare(row, dn, attrs)
+        else:
+            self.add(row)
+
+    def desired_attrs(self, row):
+        attrs = self.function.ldap_data(row)
+        self.function.process_dyn_attrs(attrs, self.plpy, row)
+        return attrs
+
+    def compare(self, row, dn, attrs):
+        wanted = self.desired_attrs(row)
+        current = dict([(k.lower(), v) for k, v in attrs.items()])
+        old, new = {}, {}
+        for k in self.attrs:
+            values = _values(wanted.get(k))
+            if set(values) != set(current.get(k.lower(), [])):
+                old[k] = current.get(k.lower(), [])
+                new[k] = values
+        if not new:
+            self.counts['unchanged'] += 1
+            return
+        self.counts['modified'] += 1
+        if not self.dry_run:
+            import ldap.modlist
+            self.ldap_c.modify_s(dn, ldap.modlist.modifyModlist(old, new))
+
+    def add(self, row):
+        self.counts['added'] += 1
+        if not self.dry_run:
+            self.model.create(self.ldap_c, self.desired_attrs(row))
+
+    def delete(self, dn):
+        if not self.delete_entries:
+            self.counts['orphans'] += 1
+            return
+        self.counts['deleted'] += 1
+        if not self.dry_run:
+            self.ldap_c.delete_s(dn)
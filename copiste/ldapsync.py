@@ -1,9 +1,34 @@
-import ldap
-import ldap.modlist
-
+import collections
 import copy
+import re
+import time
+
+# python-ldap is imported by the methods needing it : loading copiste does not
+# pay for it (nor require it) unless LDAP is actually used.
+
+# Permissive Modify control : adding a value already there, or deleting a
+# missing one, is not an error.
+PERMISSIVE_MODIFY_OID = '1.2.840.113556.1.4.1413'
 
 class LDAPUtils:
+    @staticmethod
+    def supported_controls(ldap_con):
+        """ Reads the controls supported by the server from its root DSE
+
+        @returns a list of OIDs, empty if the root DSE can not be read.
+        """
+        import ldap
+        try:
+            res = ldap_con.search_s('', ldap.SCOPE_BASE, '(objectClass=*)',
+                                    ['supportedControl'])
+        except ldap.LDAPError:
+            return []
+        for dn, attrs in res:
+            for k, v in attrs.items():
+                if k.lower() == 'supportedcontrol':
+                    return v
+        return []
+
     @staticmethod
     def build_AND_filter(keyval):
         """ Builds a LDAP AND filter
@@ -19,10 +44,405 @@ class LDAPUtils:
         else:
             return '&({})'.format(''.join(filters))
 
+    @staticmethod
+    def paged_search(ldap_con, base, scope, filterstr, attrlist=None,
+                     page_size=500):
+        """ Searches page by page, with the Simple Paged Results control
+
+        @returns an iterator over the (dn, attrs) results
+        """
+        import ldap.controls
+        page = ldap.controls.SimplePagedResultsControl(
+            True, size=page_size, cookie='')
+        while True:
+            msgid = ldap_con.search_ext(base, scope, filterstr, attrlist,
+                                        serverctrls=[page])
+            _, results, _, ctrls = ldap_con.result3(msgid)
+            for dn, attrs in results:
+                # search references have no DN
+                if dn is not None:
+                    yield dn, attrs
+            cookies = [c.cookie for c in ctrls if c.controlType ==
+                       ldap.controls.SimplePagedResultsControl.controlType]
+            if not cookies or not cookies[0]:
+                break
+            page.cookie = cookies[0]
+
 
 class LDAPDataError(Exception):
     pass
 
+
+_TEMPLATE_FIELD = re.compile(r'\{(\w+)\}')
+_FILTER_ATTR = re.compile(r'\(([\w;-]+)[~<>]?=')
+
+# attrlist asking for no attribute (RFC 4511), to only get the DN
+NO_ATTRS = ['1.1']
+
+def _attr_names(attrlist):
+    """ Normalizes a search attrlist
+
+    @returns the set of lowercased attribute names, None for all attributes
+    """
+    if attrlist is None:
+        return None
+    return set([a.lower() for a in attrlist]) - set([NO_ATTRS[0]])
+
+def _project(attrs, attrlist):
+    """ Keeps the attributes of attrlist (all if None) """
+    if attrlist is None:
+        return attrs
+    names = _attr_names(attrlist)
+    return dict([(k, v) for k, v in attrs.items() if k.lower() in names])
+
+class LDAPEntryCache:
+    """ The entries read or written during a transaction
+
+    Entries are found by the query which gave them, a query is forgotten
+    when one of the attributes it tests is written. As searches may fetch
+    some attributes only, the cache knows which ones it holds for each entry.
+    The cache is disabled until begin() is called.
+
+    The models writing through a same connection share its cache (see
+    LDAPConnections.cache()), so that each one sees the writes of the others.
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        self.txid = None
+        # gives the transaction to check on next use, see begin()
+        self.get_txid = None
+        # normalized dn -> (dn, attrs, fetched attr names or None for all),
+        # least recently used first
+        self.entries = collections.OrderedDict()
+        # query -> normalized dn
+        self.queries = {}
+
+    def begin(self, txid):
+        """ Empties the cache, unless txid is the transaction it holds
+
+        @param txid the current transaction, or a function giving it, only
+                    called once the cache is read or filled
+        """
+        if callable(txid):
+            self.get_txid = txid
+            return
+        self.get_txid = None
+        if txid != self.txid:
+            self.clear()
+            self.txid = txid
+
+    def active(self):
+        """ Tells if the cache is enabled, checking the transaction if needed
+        """
+        if not self.size:
+            return False
+        if self.get_txid is not None:
+            self.begin(self.get_txid())
+        return self.txid is not None
+
+    def clear(self):
+        self.entries.clear()
+        self.queries.clear()
+
+    def get(self, query, attrlist=None):
+        """
+        @param attrlist the attributes needed, all if None
+        @returns a (dn, attrs) tuple, or None if query is not cached, or not
+                 with all the attributes of attrlist.
+        """
+        if not self.active():
+            return None
+        try:
+            key = self.queries[query]
+            dn, attrs, fetched = self.entries.pop(key)
+        except KeyError:
+            return None
+        self.entries[key] = (dn, attrs, fetched)
+        needed = _attr_names(attrlist)
+        if fetched is not None and (needed is None or
+                                    not needed.issubset(fetched)):
+            return None
+        return dn, copy.deepcopy(_project(attrs, attrlist))
+
+    def put(self, query, dn, attrs, attrlist=None):
+        """
+        @param attrlist the attributes attrs was searched with
+        """
+        if not self.active():
+            return
+        key = dn.lower()
+        fetched = _attr_names(attrlist)
+        if key in self.entries and fetched is not None:
+            # merges with what is known of the entry
+            _, known, known_fetched = self.entries.pop(key)
+            known = dict([(k, v) for k, v in known.items()
+                          if not k.lower() in fetched])
+            known.update(copy.deepcopy(attrs))
+            if known_fetched is not None:
+                fetched = fetched | known_fetched
+            else:
+                fetched = None
+        else:
+            self.entries.pop(key, None)
+            known = copy.deepcopy(attrs)
+        self.entries[key] = (dn, known, fetched)
+        self.queries[query] = key
+        while len(self.entries) > self.size:
+            self.forget(self.entries.keys()[0])
+
+    def update(self, dn, changed_attrs):
+        """ Records a write to an entry
+
+        @param changed_attrs the new values of the written attributes
+        """
+        key = dn.lower()
+        if not key in self.entries:
+            return
+        _, attrs, fetched = self.entries[key]
+        changed = set([k.lower() for k in changed_attrs.keys()])
+        for k in attrs.keys():
+            if k.lower() in changed:
+                del attrs[k]
+        attrs.update(copy.deepcopy(changed_attrs))
+        if fetched is not None:
+            fetched.update(changed)
+        for query, dn_key in self.queries.items():
+            if dn_key == key and changed.intersection(
+                    [a.lower() for a in _FILTER_ATTR.findall(query)]):
+                del self.queries[query]
+
+    def change_values(self, dn, attr, added=(), removed=()):
+        """ Records values added to or removed from an attribute
+        """
+        key = dn.lower()
+        if not key in self.entries:
+            return
+        _, attrs, fetched = self.entries[key]
+        names = [k for k in attrs.keys() if k.lower() == attr.lower()]
+        if names:
+            removed = set(removed)
+            values = [v for v in attrs[names[0]] if not v in removed]
+            known = set(values)
+            values += [v for v in added if not v in known]
+            self.update(dn, {names[0]: values})
+        elif fetched is None or attr.lower() in fetched:
+            # known as empty
+            self.update(dn, {attr: list(added)})
+        else:
+            # the other values are unknown
+            self.forget(dn)
+
+    def forget(self, dn):
+        key = dn.lower()
+        self.entries.pop(key, None)
+        for query, dn_key in self.queries.items():
+            if dn_key == key:
+                del self.queries[query]
+
+
+class LDAPBatchError(LDAPDataError):
+    """ Errors of the operations of a LDAPPipeline
+    """
+    def __init__(self, errors):
+        """
+        @param errors a list of (dn, LDAPError)
+        """
+        self.errors = errors
+        LDAPDataError.__init__(self, '{} LDAP operation(s) failed : {}'.format(
+                len(errors), '; '.join(['{}: {}'.format(dn, e)
+                                        for dn, e in errors])))
+
+
+class LDAPPipeline:
+    """ Wraps a LDAP connection, sending its writes (add_s, modify_s,
+    delete_s) asynchronously, up to window operations at once.
+
+    Operations on a same DN are done in order : a write, or a base-scoped
+    search, waits for the pending writes on its DN. Other searches do not
+    wait, they may not see the pending writes.
+
+    Write errors are collected, and raised at once by flush(), except those
+    the write was sent to ignore.
+    """
+    def __init__(self, con, window=64):
+        self.con = con
+        self.window = window
+        # msgid -> (normalized dn, ignored errors), oldest first
+        self.pending = collections.OrderedDict()
+        self.errors = []
+
+    def __getattr__(self, name):
+        return getattr(self.con, name)
+
+    def add_s(self, dn, modlist):
+        self.send(dn, self.con.add, dn, modlist)
+
+    def modify_s(self, dn, modlist):
+        self.send(dn, self.con.modify, dn, modlist)
+
+    def delete_s(self, dn):
+        self.send(dn, self.con.delete, dn)
+
+    def modify_ext_s(self, dn, modlist, serverctrls=None, ignore=()):
+        """
+        @param ignore the LDAPError classes not to report for this write
+        """
+        self.send(dn, self.con.modify_ext, dn, modlist, serverctrls,
+                  ignore=ignore)
+
+    def search_s(self, base, scope, *args, **kwargs):
+        import ldap
+        if scope == ldap.SCOPE_BASE:
+            self.wait_dn(base)
+        return self.con.search_s(base, scope, *args, **kwargs)
+
+    def send(self, dn, method, *args, **kwargs):
+        self.wait_dn(dn)
+        while len(self.pending) >= self.window:
+            self.wait_one()
+        msgid = method(*args)
+        self.pending[msgid] = (dn.lower(), kwargs.get('ignore', ()))
+
+    def wait_dn(self, dn):
+        dn = dn.lower()
+        while dn in [pending_dn for pending_dn, _ in self.pending.values()]:
+            self.wait_one()
+
+    def wait_one(self):
+        """ Waits for the result of the oldest pending operation
+        """
+        import ldap
+        msgid, (dn, ignore) = self.pending.popitem(last=False)
+        try:
+            self.con.result(msgid)
+        except ldap.SERVER_DOWN:
+            raise
+        except ldap.LDAPError, e:
+            if not isinstance(e, ignore):
+                self.errors.append((dn, e))
+
+    def flush(self):
+        """ Waits for all the pending operations
+
+        @raises LDAPBatchError if some of the operations failed
+        """
+        while self.pending:
+            self.wait_one()
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise LDAPBatchError(errors)
+
+    def discard(self):
+        """ Waits for all the pending operations, ignoring their errors
+        """
+        while self.pending:
+            self.wait_one()
+        self.errors = []
+
+
+class LDAPConnections:
+    """ Bound LDAP connections, kept for the life of the process (in
+    plpython : of the backend) and shared by all the functions using the same
+    server and bind DN.
+
+    Connections idle for more than CHECK_INTERVAL seconds are checked before
+    being handed out, and rebound if dead ; connections idle for more than
+    their idle timeout are closed.
+    """
+    CHECK_INTERVAL = 30
+
+    def __init__(self, initialize=None):
+        """
+        @param initialize the function opening connections, defaults to
+               ldap.initialize
+        """
+        self.initialize = initialize
+        # (host, bind_dn) -> {'con', 'bind_pw', 'last_used', 'idle_timeout'}
+        self.connections = {}
+        # (host, bind_dn) -> LDAPEntryCache
+        self.caches = {}
+
+    def get(self, creds, idle_timeout=300, reconnect=False):
+        """ Gives a bound connection
+
+        @param creds        a dict with host, bind_dn and bind_pw keys
+        @param idle_timeout close the connection once unused for that long,
+                            in seconds
+        @param reconnect    do not reuse the existing connection (ex: it was
+                            found dead)
+        """
+        now = time.time()
+        self.close_idle(now)
+
+        key = (creds['host'], creds['bind_dn'])
+        entry = self.connections.get(key)
+        if entry and (reconnect or entry['bind_pw'] != creds['bind_pw'] or
+                      (now - entry['last_used'] > self.CHECK_INTERVAL and
+                       not self.is_alive(entry['con']))):
+            self.close(key)
+            entry = None
+
+        if entry is None:
+            initialize = self.initialize
+            if initialize is None:
+                import ldap
+                initialize = ldap.initialize
+            con = initialize(creds['host'])
+            con.simple_bind_s(creds['bind_dn'], creds['bind_pw'])
+            entry = self.connections[key] = {
+                'con': con, 'bind_pw': creds['bind_pw']}
+
+        entry['last_used'] = now
+        entry['idle_timeout'] = idle_timeout
+        return entry['con']
+
+    def is_alive(self, con):
+        import ldap
+        try:
+            con.whoami_s()
+        except ldap.LDAPError:
+            return False
+        return True
+
+    def close(self, key):
+        import ldap
+        entry = self.connections.pop(key)
+        try:
+            entry['con'].unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def cache(self, creds):
+        """ The entry cache of the connection for creds, kept across
+        reconnections
+        """
+        key = (creds['host'], creds['bind_dn'])
+        try:
+            return self.caches[key]
+        except KeyError:
+            cache = self.caches[key] = LDAPEntryCache(size=0)
+            return cache
+
+    def discard(self, creds):
+        """ Closes the connection for creds, if any (ex: found dead)
+        """
+        key = (creds['host'], creds['bind_dn'])
+        if key in self.connections:
+            self.close(key)
+
+    def close_idle(self, now=None):
+        now = now or time.time()
+        for key, entry in self.connections.items():
+            if now - entry['last_used'] > entry['idle_timeout']:
+                self.close(key)
+
+    def close_all(self):
+        for key in self.connections.keys():
+            self.close(key)
+
+# the connections of the process
+CONNECTIONS = LDAPConnections()
+
 class LDAPModel:
     """ Represents a "model" within LDAPD
 
@@ -30,7 +450,9 @@ class LDAPModel:
     CRUD methods are provided to manipulate the model instances.
     """
 
-    def __init__(self, query, base, dn, static_attrs={}):
+    SCOPES = ('base', 'one', 'subtree')
+
+    def __init__(self, query, base, dn, static_attrs={}, scope='subtree'):
         """
         @param dn is a template to generate the dn, fields are handled as for
                the query
@@ -40,36 +462,101 @@ class LDAPModel:
         @param base the LDAP base to search for this model
         @param static_attrs: a dict containing attributes that will always
                be the same for a givenModel (think about objectClass).
+        @param scope the scope of the searches under base : "base", "one" or
+               "subtree".
         """
+        if not scope in self.SCOPES:
+            raise ValueError('unknown LDAP scope : {}'.format(scope))
         self.dn = dn
         self.query = query
         self.base = base
         self.static_attrs = static_attrs
+        self.scope = scope
+        self.cache = LDAPEntryCache()
+
+    def ldap_scope(self):
+        import ldap
+        return {'base': ldap.SCOPE_BASE,
+                'one': ldap.SCOPE_ONELEVEL,
+                'subtree': ldap.SCOPE_SUBTREE}[self.scope]
+
+    def dn_fields(self):
+        """ The attributes the DN template uses, in order
+        """
+        return _TEMPLATE_FIELD.findall(self.dn)
+
+    def list_query(self):
+        """ The LDAP filter matching all the entries of the model
+        """
+        return _TEMPLATE_FIELD.sub('*', self.query)
+
+    def dn_is_computable(self):
+        """ Tells if the DN of the entries can be computed from the attrs the
+        query uses, in which case they are read by DN rather than searched.
+        """
+        dn_fields = set(self.dn_fields())
+        dn, base = self.dn.lower(), self.base.lower()
+        if self.scope == 'base':
+            in_scope = dn == base
+        elif self.scope == 'one':
+            in_scope = dn.split(',', 1)[-1] == base
+        else:
+            in_scope = dn.endswith(base)
+        return dn_fields.issubset(_TEMPLATE_FIELD.findall(self.query)) and \
+            in_scope
 
     def to_dict(self):
         d = {}
-        for k in ('dn', 'query', 'base', 'static_attrs'):
+        for k in ('dn', 'query', 'base', 'static_attrs', 'scope'):
             d[k] = getattr(self, k)
         return d
 
-    def get(self, ldap_con, attrs):
+    def cache_key(self, query):
+        """ Where the cache files the result of query, as models with other
+        bases may share the cache
+        """
+        return '{}?{}?{}'.format(self.base, self.scope, query)
+
+    def get(self, ldap_con, attrs, attrlist=None):
         """ Tries to fetch the model from LDAP
 
+        If the DN can be computed (see dn_is_computable()), the entry is read
+        by DN, searching the base only if it is not there.
+
         @param ldap_con a LDAPObject, already bound
         @param attrs    a map of attrs, they should contain (at least) the
                         arguments used in the query (see __init__()).
+        @param attrlist the LDAP attributes to fetch, all if None ; NO_ATTRS
+                        only gives the DN.
 
         @return (dn, attrs) if found, None, None else.
         """
+        import ldap
         query = self.query.format(**attrs)
-        res = ldap_con.search_s(self.base, ldap.SCOPE_SUBTREE, query)
+        cached = self.cache.get(self.cache_key(query), attrlist)
+        if cached:
+            return cached
+
+        res = []
+        if self.dn_is_computable():
+            try:
+                res = ldap_con.search_s(
+                    self.get_dn(attrs), ldap.SCOPE_BASE, query, attrlist)
+            except ldap.NO_SUCH_OBJECT:
+                pass
+        if not res:
+            res = ldap_con.search_s(
+                self.base, self.ldap_scope(), query, attrlist)
+
         if len(res) > 1:
             raise LDAPDataError(
                 'More than one result for query "{}" on base "{}"'.format(
                     query, self.base))
 
         elif len(res) == 1:
-            return res[0]
+            dn, entry_attrs = res[0]
+            self.cache.put(self.cache_key(query), dn, entry_attrs, attrlist)
+            return dn, entry_attrs
         else:
             return None, None
 
@@ -82,9 +569,10 @@ class LDAPModel:
         @param attrs    a map of attrs, they should contain (at least) the
                         arguments used in the query (see __init__()).
         """
-        ldap_dn, ldap_attrs = self.get(ldap_con, attrs)
+        ldap_dn, ldap_attrs = self.get(ldap_con, attrs, NO_ATTRS)
         if ldap_dn:
             ldap_con.delete_s(ldap_dn)
+            self.cache.forget(ldap_dn)
         else:
             raise LDAPDataError('cannot delete a non-existant model')
 
@@ -102,51 +590,111 @@ class LDAPModel:
                              change, others won't be touched. Specify empty list
                              to blank an attribute.
         @param accumulate  add element to multi-valued attr instead of
-                           overwritting existing attrs
+                           overwritting existing attrs (see modify_values())
         """
+        if accumulate:
+            for k, v in changed_attrs.items():
+                self.modify_values(ldap_con, attrs, k, added=[v])
+            return
 
-        ldap_dn, old_attrs = self.get(ldap_con, attrs)
+        import ldap.modlist
+        # only the changed attributes are fetched and compared
+        ldap_dn, old_attrs = self.get(ldap_con, attrs, changed_attrs.keys())
         if not ldap_dn:
             raise LDAPDataError('cannot modify a non-existant model')
         new_attrs = copy.deepcopy(old_attrs)
+        new_attrs.update(changed_attrs)
 
-        if accumulate:
-            # add element to multi-valued attr instead of overwritting
-            for k,v in changed_attrs.items():
-                if not new_attrs.has_key(k):
-                    new_attrs[k] = []
-                elif not isinstance(new_attrs[k], (list, tuple)):
-                    new_attrs[k] = [new_attrs[k]]
-                # avoid duplicates
-                if not v in new_attrs[k]:
-                    new_attrs[k].append(v)
-        else:
-            new_attrs.update(changed_attrs)
-
-        if ldap_dn:
-            delta = ldap.modlist.modifyModlist(old_attrs, new_attrs)
-            ldap_con.modify_s(ldap_dn, delta)
-        else:
-            raise LDAPDataError('cannot delete a non-existant model')
+        delta = ldap.modlist.modifyModlist(old_attrs, new_attrs)
+        ldap_con.modify_s(ldap_dn, delta)
+        self.cache.update(ldap_dn, changed_attrs)
 
     def remove_from_attr(self, ldap_con, attrs, attr, val):
         """ For a specific LDAP attribute, remove a value from a multi-valued
-        attr.
+        attr (see modify_values()).
         """
-        ldap_dn, old_attrs = self.get(ldap_con, attrs)
-        new_attrs = copy.deepcopy(old_attrs)
+        self.modify_values(ldap_con, attrs, attr, removed=[val])
 
-        if val in new_attrs[attr]:
-            new_attrs = new_attrs.copy()
-            new_attrs[attr].remove(val)
+    def modify_values(self, ldap_con, attrs, attr, added=[], removed=[]):
+        """ Adds and removes values of a multi-valued attribute, without
+        reading them first.
 
-        if ldap_dn:
-            delta = ldap.modlist.modifyModlist(old_attrs, new_attrs)
-            ldap_con.modify_s(ldap_dn, delta)
+        The entry is not searched for if it is cached ; otherwise it is read
+        by get(), by DN if computable, as it may not be at the computed DN.
+        Adding a value already there, or removing a missing one, is not an
+        error.
 
-        else:
+        @returns the DN of the modified entry
+        """
+        import ldap
+        query = self.query.format(**attrs)
+        cached = self.cache.get(self.cache_key(query), NO_ATTRS)
+        if cached:
+            dn = cached[0]
+            try:
+                self.send_values(ldap_con, dn, attr, added, removed)
+                return dn
+            except ldap.NO_SUCH_OBJECT:
+                # moved since cached
+                self.cache.forget(dn)
+
+        dn, _ = self.get(ldap_con, attrs, NO_ATTRS)
+        if not dn:
             raise LDAPDataError('cannot modify a non-existant model')
+        self.send_values(ldap_con, dn, attr, added, removed)
+        return dn
 
+    def send_values(self, ldap_con, dn, attr, added, removed):
+        """ Sends value-level modifications, with the Permissive Modify
+        control if the server supports it.
+
+        Through a LDAPPipeline, they are sent asynchronously ; without the
+        control, value by value then, ignoring the values already there (or
+        already missing).
+        """
+        import ldap
+        mods = []
+        if removed:
+            mods.append((ldap.MOD_DELETE, attr, list(removed)))
+        if added:
+            mods.append((ldap.MOD_ADD, attr, list(added)))
+        if not mods:
+            return
+        if self.supports_permissive_modify(ldap_con):
+            import ldap.controls.simple
+            ctrls = [ldap.controls.simple.ValueLessRequestControl(
+                    PERMISSIVE_MODIFY_OID, True)]
+            ldap_con.modify_ext_s(dn, mods, serverctrls=ctrls)
+        elif isinstance(ldap_con, LDAPPipeline):
+            # errors are only known once flushed
+            for op, _, values in mods:
+                for v in values:
+                    ldap_con.modify_ext_s(
+                        dn, [(op, attr, [v])],
+                        ignore=(ldap.TYPE_OR_VALUE_EXISTS,
+                                ldap.NO_SUCH_ATTRIBUTE))
+        else:
+            try:
+                ldap_con.modify_ext_s(dn, mods)
+            except (ldap.TYPE_OR_VALUE_EXISTS, ldap.NO_SUCH_ATTRIBUTE):
+                # value by value, to skip those already done
+                for op, _, values in mods:
+                    for v in values:
+                        try:
+                            ldap_con.modify_ext_s(dn, [(op, attr, [v])])
+                        except (ldap.TYPE_OR_VALUE_EXISTS,
+                                ldap.NO_SUCH_ATTRIBUTE):
+                            pass
+        self.cache.change_values(dn, attr, added, removed)
+
+    def supports_permissive_modify(self, ldap_con):
+        # checked once, as a model always talks to the same server
+        try:
+            return self._permissive_modify
+        except AttributeError:
+            self._permissive_modify = (
+                PERMISSIVE_MODIFY_OID in LDAPUtils.supported_controls(ldap_con))
+            return self._permissive_modify
 
     def create(self, ldap_con, attrs):
         """ Tries to create the object from LDAP
@@ -155,6 +703,7 @@ class LDAPModel:
         @param attrs    all the attrs for the new object, you should ommit dn,
                         it will be computed from self.dn
         """
+        import ldap.modlist
         all_attrs = self.static_attrs.copy()
         all_attrs.update(attrs)
 
@@ -162,8 +711,26 @@ class LDAPModel:
 
         try:
             res = ldap_con.add_s(self.get_dn(attrs), ldif)
+        except ldap.SERVER_DOWN:
+            raise
         except ldap.LDAPError, e:
             raise LDAPDataError('LDAP Error: {}'.format(str(e)))
+        self.cache.forget(self.get_dn(attrs))
+
+    def set_values(self, ldap_con, dn, attr, old_values, new_values):
+        """ Changes the values of an attribute of an entry, sending only the
+        added and removed values.
+
+        @param old_values the current values, as read
+        @param new_values an iterable of the values to set
+        @returns the number of added and removed values
+        """
+        new_values = set(new_values)
+        old_values = set(old_values)
+        added = sorted(new_values - old_values)
+        removed = sorted(old_values - new_values)
+        self.send_values(ldap_con, dn, attr, added, removed)
+        return len(added) + len(removed)
 
     def get_dn(self, attrs):
         return self.dn.format(**attrs)
@@ -1,4 +1,34 @@
-import marshal
+# names of the transition tables of statement-level triggers
+OLD_TABLE = 'copiste_old'
+NEW_TABLE = 'copiste_new'
+
+# trigger arguments, telling the function what to do with the change
+BUFFER = 'buffer'
+FLUSH = 'flush'
+ENQUEUE = 'enqueue'
+
+# table and notification channel used by QueueWriteTrigger
+QUEUE_TABLE = 'copiste_queue'
+QUEUE_CHANNEL = 'copiste_queue'
+# changes the worker could not handle, see QueueWorker
+QUEUE_FAILED_TABLE = 'copiste_queue_failed'
+
+# table where BufferedWriteTrigger records the changes until commit
+BUFFER_TABLE = 'copiste_buffer'
+
+# row events a trigger may subscribe to, in the order SQL lists them
+EVENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+def quote_ident(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+def sql_events(events=None):
+    """ Lists the row events to subscribe to
+
+    @param events the events to keep, all if None
+    @returns a list of events, in EVENTS order
+    """
+    return [e for e in EVENTS if events is None or e in events]
 
 class Trigger:
     """A SQL trigger"""
@@ -13,24 +43,252 @@ class Trigger:
     def db_name(self):
         return 'copiste__{}'.format(self.name)
 
+    def db_names(self):
+        """ Names of all the SQL triggers created by sql_enable()
+        """
+        return [self.db_name()]
+
+    def sql_requirements(self):
+        """ SQL sentences to run before sql_enable()
+        """
+        return []
+
+    def sql_comment(self, names, comment):
+        """ Comments the given SQL triggers
+        """
+        return ''.join(["COMMENT ON TRIGGER {} ON {} IS '{}';".format(
+                    name, self.table, comment) for name in names])
+
+    def check_func_name(self, func_name):
+        if not func_name.startswith('copiste__'):
+            raise ValueError(
+                '"{}" does not seem to be a copiste function'.format(func_name))
+
 class WriteTrigger(Trigger):
     """ Trigger executed on write/update/deletes, row-level
+
+    If the columns read by the function are known, updates leaving them
+    untouched do not fire the trigger, they never reach plpython.
     """
-    def sql_enable(self, func_name, args={}):
+    def update_db_name(self, name=None):
+        return '{}__update'.format(name or self.db_name())
+
+    def db_names(self):
+        return [self.db_name(), self.update_db_name()]
+
+    def sql_row_triggers(self, name, create, events=None, columns=None):
+        """ Gives the SQL sentences creating the row-level triggers
+
+        WHEN clauses can not refer to OLD on INSERT, so if columns are given,
+        UPDATE gets a trigger of its own, named after update_db_name().
+
+        @param name    the trigger name
+        @param create  the CREATE TRIGGER sentence, with {name}, {events} and
+                       {when} fields
+        @param events  the events to subscribe to, all if None
+        @param columns the columns whose changes matter on UPDATE, any if None
+        """
+        events = sql_events(events)
+        sql = ''
+        if columns and 'UPDATE' in events:
+            events.remove('UPDATE')
+            columns = [quote_ident(c) for c in columns]
+            when = ' OR '.join(['OLD.{0} IS DISTINCT FROM NEW.{0}'.format(c)
+                                for c in columns])
+            sql += create.format(
+                name=self.update_db_name(name), when='WHEN ({}) '.format(when),
+                events='UPDATE OF {}'.format(', '.join(columns)))
+        if events:
+            sql = create.format(
+                name=name, when='', events=' OR '.join(events)) + sql
+        return sql
+
+    def sql_enable(self, func_name, args={}, events=None, columns=None):
         """Gives the SQL sentence to enable the SQL trigger
 
         @param func_name the function to call on trigger activation
         @param args a dictionary with args for the method (if any), those args
                are always the same for each call of this trigger.
+        @param events the events handled by the function, all if None
+        @param columns the columns read by the function, any if None
         """
-        pyargs_marshalled = marshal.dumps(args).encode('base64')
+        self.check_func_name(func_name)
 
-        if not func_name.startswith('copiste__'):
-            raise ValueError(
-                '"{}" does not seem to be a copiste function'.format(func_name))
+        create = ("CREATE TRIGGER {{name}} {} {{events}} ON {} "+
+                  "FOR EACH ROW {{when}}EXECUTE PROCEDURE {}();"
+        ).format(self.moment, self.table, func_name)
+        return self.sql_row_triggers(self.db_name(), create, events, columns)
+
+    def sql_disable(self):
+        return ''.join(['DROP TRIGGER IF EXISTS {} ON {};'.format(
+                    name, self.table) for name in self.db_names()])
+
+class BufferedWriteTrigger(WriteTrigger):
+    """ Row-level trigger which only records the changes, the function
+    handles them at commit time, all at once, through its call_batch().
+
+    Changes are recorded into an unlogged table by a first trigger, and
+    flushed by a second, deferred, constraint trigger. The LDAP operations
+    thus happen once the transaction is done with its changes, which are
+    merged (ex: an INSERT followed by a DELETE gives nothing). Deferred
+    triggers run within the commit, the written rows are still locked while
+    LDAP is waited for.
+
+    Changes rolled back to a savepoint are rolled back from the table too.
+    Only the columns used by the function are recorded, as by
+    QueueWriteTrigger.
+    """
+    def __init__(self, sql_table, name):
+        WriteTrigger.__init__(self, sql_table, name, moment='AFTER')
+
+    def sql_requirements(self):
+        return [self.sql_create_buffer_table()]
 
-        sql = ("CREATE TRIGGER {} {} INSERT OR UPDATE OR DELETE ON {} "+
-               "FOR EACH ROW EXECUTE PROCEDURE {}();"
-        ).format(self.db_name(), self.moment ,self.table,
-                 func_name, pyargs_marshalled)
+    @staticmethod
+    def sql_create_buffer_table():
+        # unlogged : a crash rolls back what it holds anyway
+        return ('CREATE UNLOGGED TABLE IF NOT EXISTS {0} ('+
+                'id BIGSERIAL PRIMARY KEY, txid BIGINT NOT NULL, '+
+                'funcname TEXT NOT NULL, event TEXT NOT NULL, '+
+                'table_name TEXT NOT NULL, old_row TEXT, new_row TEXT);'+
+                'CREATE INDEX IF NOT EXISTS {0}_txid ON {0} (txid, funcname);'
+        ).format(BUFFER_TABLE)
+
+    @staticmethod
+    def sql_drop_buffer_table():
+        return 'DROP TABLE IF EXISTS {}'.format(BUFFER_TABLE)
+
+    def flush_db_name(self):
+        return '{}__flush'.format(self.db_name())
+
+    def db_names(self):
+        return [self.db_name(), self.update_db_name(),
+                self.flush_db_name(), self.update_db_name(self.flush_db_name())]
+
+    def sql_enable(self, func_name, args={}, events=None, columns=None):
+        """Gives the SQL sentences to enable the SQL triggers
+
+        @param func_name the function to call on trigger activation
+        @param events the events handled by the function, all if None
+        @param columns the columns read by the function, any if None
+        """
+        self.check_func_name(func_name)
+
+        buffer_create = ("CREATE TRIGGER {{name}} {} {{events}} ON {} "+
+                         "FOR EACH ROW {{when}}EXECUTE PROCEDURE {}('{}');"
+        ).format(self.moment, self.table, func_name, BUFFER)
+        flush_create = ("CREATE CONSTRAINT TRIGGER {{name}} AFTER {{events}} "+
+                        "ON {} DEFERRABLE INITIALLY DEFERRED FOR EACH ROW "+
+                        "{{when}}EXECUTE PROCEDURE {}('{}');"
+        ).format(self.table, func_name, FLUSH)
+        return (
+            self.sql_row_triggers(
+                self.db_name(), buffer_create, events, columns) +
+            self.sql_row_triggers(
+                self.flush_db_name(), flush_create, events, columns))
+
+
+class QueueWriteTrigger(WriteTrigger):
+    """ Row-level trigger which only queues the changes into a table, to be
+    handled outside of the database by the "copiste run" worker.
+
+    Only the columns used by the function are queued, a notification is sent
+    on each change.
+    """
+    def __init__(self, sql_table, name):
+        WriteTrigger.__init__(self, sql_table, name, moment='AFTER')
+
+    def sql_requirements(self):
+        return [self.sql_create_queue_table()]
+
+    def sql_enable(self, func_name, args={}, events=None, columns=None):
+        """Gives the SQL sentence to enable the SQL trigger
+
+        @param func_name the function to call on trigger activation
+        @param events the events handled by the function, all if None
+        @param columns the columns read by the function, any if None
+        """
+        self.check_func_name(func_name)
+
+        create = ("CREATE TRIGGER {{name}} {} {{events}} ON {} "+
+                  "FOR EACH ROW {{when}}EXECUTE PROCEDURE {}('{}');"
+        ).format(self.moment, self.table, func_name, ENQUEUE)
+        return self.sql_row_triggers(self.db_name(), create, events, columns)
+
+    @staticmethod
+    def sql_create_queue_table():
+        return ('CREATE TABLE IF NOT EXISTS {} ('+
+                'id BIGSERIAL PRIMARY KEY, funcname TEXT NOT NULL, '+
+                'event TEXT NOT NULL, table_name TEXT NOT NULL, '+
+                'old_row TEXT, new_row TEXT);'+
+                'CREATE TABLE IF NOT EXISTS {} ('+
+                'id BIGINT PRIMARY KEY, funcname TEXT NOT NULL, '+
+                'event TEXT NOT NULL, table_name TEXT NOT NULL, '+
+                'old_row TEXT, new_row TEXT, error TEXT, '+
+                'failed TIMESTAMP NOT NULL DEFAULT now());'
+        ).format(QUEUE_TABLE, QUEUE_FAILED_TABLE)
+
+    @staticmethod
+    def sql_drop_queue_table():
+        return 'DROP TABLE IF EXISTS {}, {}'.format(
+            QUEUE_TABLE, QUEUE_FAILED_TABLE)
+
+
+class StatementWriteTrigger(Trigger):
+    """ Trigger executed once per write/update/delete statement
+
+    The function gets the whole changeset through its call_batch() method,
+    read from transition tables, so it requires PostgreSQL >= 10.
+    Transition tables are only allowed on single-event AFTER triggers, so one
+    trigger is created for each event. Updates can not be filtered by column,
+    as transition tables are not allowed on "UPDATE OF" triggers.
+
+    The old and new rows of an update are paired by primary key : on a table
+    without one, the update trigger is created row-level instead.
+    """
+    EVENTS = EVENTS
+
+    def __init__(self, sql_table, name):
+        Trigger.__init__(self, sql_table, name, moment='AFTER')
+
+    def event_db_name(self, event):
+        return '{}__{}'.format(self.db_name(), event.lower())
+
+    def db_names(self):
+        return [self.event_db_name(e) for e in self.EVENTS]
+
+    def sql_enable(self, func_name, args={}, events=None, columns=None):
+        """Gives the SQL sentences to enable the SQL triggers
+
+        @param func_name the function to call on trigger activation
+        @param events the events handled by the function, all if None
+        @param columns ignored
+        """
+        self.check_func_name(func_name)
+
+        referencing = {
+            'INSERT': 'NEW TABLE AS {}'.format(NEW_TABLE),
+            'UPDATE': 'OLD TABLE AS {} NEW TABLE AS {}'.format(
+                OLD_TABLE, NEW_TABLE),
+            'DELETE': 'OLD TABLE AS {}'.format(OLD_TABLE),
+        }
+        sql = ''
+        for event in sql_events(events):
+            create = ("CREATE TRIGGER {} {} {} ON {} REFERENCING {} "+
+                      "FOR EACH STATEMENT EXECUTE PROCEDURE {}();"
+            ).format(self.event_db_name(event), self.moment, event,
+                     self.table, referencing[event], func_name)
+            if event == 'UPDATE':
+                create = ("DO $$BEGIN IF EXISTS (SELECT 1 FROM pg_index "+
+                          "WHERE indrelid = '{}'::regclass AND indisprimary) "+
+                          "THEN {} ELSE CREATE TRIGGER {} {} UPDATE ON {} "+
+                          "FOR EACH ROW EXECUTE PROCEDURE {}(); END IF; "+
+                          "END$$;"
+                ).format(self.table, create, self.event_db_name(event),
+                         self.moment, self.table, func_name)
+            sql += create
         return sql
+
+    def sql_disable(self):
+        return ''.join(['DROP TRIGGER IF EXISTS {} ON {};'.format(
+                    name, self.table) for name in self.db_names()])
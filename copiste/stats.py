@@ -0,0 +1,352 @@
+""" Runtime statistics of the functions
+
+Each function instance keeps counters in the backend memory (a Stats), which
+are written every FLUSH_INTERVAL seconds to the copiste_stats table, one row
+per function, event and backend. Rows hold totals since the backend started,
+so that a rolled back write is caught up by the next one.
+
+Functions with the "profile" option also profile some of their calls (a
+Profiler), the results are written the same way to copiste_profiles.
+"""
+import marshal
+import os
+import random
+import time
+
+# cProfile and pstats are only imported when profiling
+
+STATS_TABLE = 'copiste_stats'
+PROFILES_TABLE = 'copiste_profiles'
+
+# minimal time between two writes of the stats of a function, in seconds
+FLUSH_INTERVAL = 10
+PROFILE_FLUSH_INTERVAL = 60
+
+# tells apart backends, as pids get reused
+BACKEND_ID = os.urandom(16).encode('hex')
+
+COUNTERS = ('calls', 'errors', 'total_time', 'max_time', 'sql_time',
+            'ldap_time', 'ldap_searches', 'ldap_modifies')
+
+# LDAP methods prefixes, and the counter they increase
+LDAP_OPERATIONS = (
+    ('search', 'ldap_searches'),
+    ('modify', 'ldap_modifies'),
+    ('add', 'ldap_modifies'),
+    ('delete', 'ldap_modifies'),
+    ('rename', 'ldap_modifies'),
+    ('modrdn', 'ldap_modifies'),
+)
+
+def sql_create_stats_table():
+    return ('CREATE TABLE IF NOT EXISTS {} ('+
+            'funcname TEXT NOT NULL, event TEXT NOT NULL, '+
+            'backend TEXT NOT NULL, pid INT NOT NULL, '+
+            'calls BIGINT NOT NULL, errors BIGINT NOT NULL, '+
+            'total_time DOUBLE PRECISION NOT NULL, '+
+            'max_time DOUBLE PRECISION NOT NULL, '+
+            'sql_time DOUBLE PRECISION NOT NULL, '+
+            'ldap_time DOUBLE PRECISION NOT NULL, '+
+            'ldap_searches BIGINT NOT NULL, ldap_modifies BIGINT NOT NULL, '+
+            'updated TIMESTAMP NOT NULL DEFAULT now(), '+
+            'PRIMARY KEY (funcname, event, backend));').format(STATS_TABLE)
+
+def sql_drop_stats_table():
+    return 'DROP TABLE IF EXISTS {}'.format(STATS_TABLE)
+
+def sql_create_profiles_table():
+    return ('CREATE TABLE IF NOT EXISTS {} ('+
+            'funcname TEXT NOT NULL, backend TEXT NOT NULL, '+
+            'pid INT NOT NULL, calls BIGINT NOT NULL, data TEXT NOT NULL, '+
+            'updated TIMESTAMP NOT NULL DEFAULT now(), '+
+            'PRIMARY KEY (funcname, backend));').format(PROFILES_TABLE)
+
+def sql_drop_profiles_table():
+    return 'DROP TABLE IF EXISTS {}'.format(PROFILES_TABLE)
+
+def read_stats(con, func_name):
+    """ Sums up the stats of a function over all backends
+
+    @param con a psycopg2 connection
+    @returns a list of dicts, one per event, with COUNTERS keys plus "event".
+    """
+    cur = con.cursor()
+    cur.execute(
+        ('SELECT event, SUM(calls), SUM(errors), SUM(total_time), '+
+         'MAX(max_time), SUM(sql_time), SUM(ldap_time), SUM(ldap_searches), '+
+         'SUM(ldap_modifies) FROM {} WHERE funcname = %s '+
+         'GROUP BY event ORDER BY event').format(STATS_TABLE),
+        [func_name])
+    return [dict(zip(('event',) + COUNTERS, row)) for row in cur.fetchall()]
+
+
+class TimedPlpy(object):
+    """ Wraps the plpy module, counting the time spent in SQL
+    """
+    def __init__(self, plpy, stats):
+        self._plpy = plpy
+        self._stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self._plpy, name)
+
+    def _timed(self, method, *args):
+        started = time.time()
+        try:
+            return method(*args)
+        finally:
+            self._stats.add('sql_time', time.time() - started)
+
+    def prepare(self, *args):
+        return self._timed(self._plpy.prepare, *args)
+
+    def execute(self, *args):
+        return self._timed(self._plpy.execute, *args)
+
+    def cursor(self, *args):
+        return TimedCursor(self._timed(self._plpy.cursor, *args), self._timed)
+
+
+class TimedCursor(object):
+    """ Wraps a plpy cursor, counting the time spent fetching its rows, as
+    the query runs while they are
+    """
+    def __init__(self, cursor, timed):
+        self._cursor = cursor
+        self._rows = iter(cursor)
+        self._timed = timed
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self._timed(next, self._rows)
+
+    def fetch(self, *args):
+        return self._timed(self._cursor.fetch, *args)
+
+
+class TimedLDAPConnection(object):
+    """ Wraps a python-ldap connection, counting the time spent in LDAP and
+    the operations.
+
+    writes is the number of writes attempted through the wrapper.
+    """
+    def __init__(self, con, stats):
+        self._con = con
+        self._stats = stats
+        self.writes = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._con, name)
+        if not callable(attr):
+            return attr
+
+        counter = None
+        for prefix, c in LDAP_OPERATIONS:
+            if name.startswith(prefix):
+                counter = c
+                break
+
+        stats = self._stats
+        def timed(*args, **kwargs):
+            if counter == 'ldap_modifies':
+                self.writes += 1
+            started = time.time()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                stats.add('ldap_time', time.time() - started)
+                if counter:
+                    stats.add(counter, 1)
+        return timed
+
+
+class Stats(object):
+    """ The counters of a function, per event
+    """
+    def __init__(self, flush_interval=FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.counters = {}
+        self.current = None
+        self.last_flush = time.time()
+        self.flushed = True
+        self.enabled = True
+
+    def start(self, event):
+        """ Starts measuring a call
+
+        @returns the start time, to be given to stop()
+        """
+        try:
+            self.current = self.counters[event]
+        except KeyError:
+            self.current = self.counters[event] = dict.fromkeys(COUNTERS, 0)
+        self.current['calls'] += 1
+        self.flushed = False
+        return time.time()
+
+    def stop(self, started, failed=False):
+        elapsed = time.time() - started
+        self.current['total_time'] += elapsed
+        if elapsed > self.current['max_time']:
+            self.current['max_time'] = elapsed
+        if failed:
+            self.current['errors'] += 1
+
+    def add(self, counter, value):
+        if self.current is not None:
+            self.current[counter] += value
+
+    def timed_plpy(self, plpy):
+        return TimedPlpy(plpy, self)
+
+    def timed_ldap(self, con):
+        return TimedLDAPConnection(con, self)
+
+    def flush(self, plpy, func_name, force=False):
+        """ Writes the counters to the stats table, if it was not done for
+        flush_interval seconds.
+
+        Errors (ex: a missing table) are only logged, and disable the writes
+        for the life of the backend.
+        """
+        now = time.time()
+        if (self.flushed or not self.enabled or
+            (not force and now - self.last_flush < self.flush_interval)):
+            return
+        self.last_flush = now
+        self.flushed = True
+
+        try:
+            for event, counters in self.counters.items():
+                args = [func_name, event, BACKEND_ID]
+                args += [counters[c] for c in COUNTERS]
+                if not len(plpy.execute(_plan(plpy, 'update'), args)):
+                    plpy.execute(_plan(plpy, 'insert'), args)
+        except plpy.SPIError, e:
+            self.enabled = False
+            plpy.warning('copiste: could not write stats : {}'.format(e))
+
+
+class StoredProfile(object):
+    """ Profile data read back from the profiles table, as pstats takes it
+    """
+    def __init__(self, data):
+        self.stats = marshal.loads(data.decode('base64'))
+
+    def create_stats(self):
+        pass
+
+def read_profile(con, func_name):
+    """ Merges the profiles of a function from all backends
+
+    @param con a psycopg2 connection
+    @returns a (pstats.Stats, profiled calls) tuple, the Stats being None if
+             nothing was profiled.
+    """
+    cur = con.cursor()
+    cur.execute('SELECT calls, data FROM {} WHERE funcname = %s'.format(
+            PROFILES_TABLE), [func_name])
+    rows = cur.fetchall()
+    if not rows:
+        return None, 0
+    import pstats
+    merged = pstats.Stats(StoredProfile(rows[0][1]))
+    for _, data in rows[1:]:
+        merged.add(StoredProfile(data))
+    return merged, sum([calls for calls, _ in rows])
+
+
+class Profiler(object):
+    """ Profiles one call out of rate, accumulating the results
+    """
+    def __init__(self, flush_interval=PROFILE_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.profile = None
+        self.calls = 0
+        self.last_flush = time.time()
+        self.flushed = True
+        self.enabled = True
+
+    def sampled(self, rate):
+        """ Tells if the next call should be profiled
+
+        @param rate profile one call out of rate, never if None or 0
+        """
+        return bool(rate) and self.enabled and random.randrange(rate) == 0
+
+    def runcall(self, func, *args):
+        if self.profile is None:
+            import cProfile
+            self.profile = cProfile.Profile()
+        self.calls += 1
+        self.flushed = False
+        return self.profile.runcall(func, *args)
+
+    def dumps(self):
+        """ Serializes the accumulated profile, pstats-style
+        """
+        import pstats
+        return marshal.dumps(
+            pstats.Stats(self.profile).stats).encode('base64')
+
+    def flush(self, plpy, func_name, force=False):
+        """ Writes the accumulated profile to the profiles table, if it was
+        not done for flush_interval seconds.
+        """
+        now = time.time()
+        if (self.flushed or not self.enabled or
+            (not force and now - self.last_flush < self.flush_interval)):
+            return
+        self.last_flush = now
+        self.flushed = True
+
+        try:
+            args = [func_name, BACKEND_ID, self.calls, self.dumps()]
+            if not len(plpy.execute(_plan(plpy, 'profile_update'), args)):
+                plpy.execute(_plan(plpy, 'profile_insert'), args)
+        except plpy.SPIError, e:
+            self.enabled = False
+            plpy.warning('copiste: could not write profile : {}'.format(e))
+
+
+_QUERIES = {
+    'update': ('UPDATE {} SET calls = $4, errors = $5, total_time = $6, '+
+               'max_time = $7, sql_time = $8, ldap_time = $9, '+
+               'ldap_searches = $10, ldap_modifies = $11, updated = now() '+
+               'WHERE funcname = $1 AND event = $2 AND backend = $3 '+
+               'RETURNING 1').format(STATS_TABLE),
+    'insert': ('INSERT INTO {} (funcname, event, backend, pid, {}) '+
+               'VALUES ($1, $2, $3, pg_backend_pid(), '+
+               '$4, $5, $6, $7, $8, $9, $10, $11)'
+              ).format(STATS_TABLE, ', '.join(COUNTERS)),
+    'profile_update': ('UPDATE {} SET calls = $3, data = $4, updated = now() '+
+                       'WHERE funcname = $1 AND backend = $2 RETURNING 1'
+                      ).format(PROFILES_TABLE),
+    'profile_insert': ('INSERT INTO {} (funcname, backend, pid, calls, data) '+
+                       'VALUES ($1, $2, pg_backend_pid(), $3, $4)'
+                      ).format(PROFILES_TABLE),
+}
+_STATS_TYPES = ['text', 'text', 'text', 'bigint', 'bigint',
+                'double precision', 'double precision', 'double precision',
+                'double precision', 'bigint', 'bigint']
+_TYPES = {
+    'update': _STATS_TYPES,
+    'insert': _STATS_TYPES,
+    'profile_update': ['text', 'text', 'bigint', 'text'],
+    'profile_insert': ['text', 'text', 'bigint', 'text'],
+}
+_PLANS = {}
+
+def _plan(plpy, name):
+    # plans are kept per plpy, as the worker has its own
+    key = (id(plpy), name)
+    try:
+        return _PLANS[key]
+    except KeyError:
+        plan = _PLANS[key] = plpy.prepare(_QUERIES[name], _TYPES[name])
+        return plan
@@ -0,0 +1,281 @@
+""" Replication outside of the database
+
+Functions are written for plpython, PlpyAdapter lets them run from a regular
+python process, through psycopg2. QueueWorker handles the changes queued by
+QueueWriteTrigger.
+"""
+import logging
+import marshal
+import random
+import re
+import select
+import time
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+import copiste.functions.base
+import copiste.sql
+
+logger = logging.getLogger('copiste')
+
+_PARAM = re.compile(r'\$(\d+)')
+
+def to_pyformat(query):
+    """ Converts a query using $1, $2... parameters to the psycopg2 syntax
+
+    @returns the query, using %(p1)s, %(p2)s... parameters.
+    """
+    return _PARAM.sub(r'%(p\1)s', query.replace('%', '%%'))
+
+
+class Error(Exception):
+    pass
+
+class Plan(object):
+    """ A plpy-like plan, for PlpyAdapter
+    """
+    def __init__(self, query, types):
+        self.query = to_pyformat(query)
+        self.types = types
+
+class PlpyAdapter(object):
+    """ Provides the subset of the plpy module used by functions, on top of a
+    psycopg2 connection.
+    """
+    Error = Error
+    SPIError = Error
+
+    def __init__(self, con):
+        self.con = con
+
+    def _query_args(self, query, args):
+        if isinstance(query, Plan):
+            params = {}
+            for i, v in enumerate(args or []):
+                params['p{}'.format(i+1)] = v
+            return query.query, params
+        else:
+            # plain queries, as plpy, do not handle parameters : without
+            # any, psycopg2 sends them as is
+            return query, None
+
+    def prepare(self, query, types=[]):
+        return Plan(query, types)
+
+    def execute(self, query, args=None):
+        cur = self.con.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(*self._query_args(query, args))
+        if cur.description is None:
+            return []
+        else:
+            return cur.fetchall()
+
+    def cursor(self, query, args=None):
+        return iter(self.execute(query, args))
+
+    def quote_ident(self, s):
+        return psycopg2.extensions.quote_ident(s, self.con)
+
+    def quote_literal(self, s):
+        return psycopg2.extensions.adapt(s).getquoted()
+
+    def debug(self, msg):
+        logger.debug(msg)
+
+    def log(self, msg):
+        logger.info(msg)
+
+    def info(self, msg):
+        logger.info(msg)
+
+    def notice(self, msg):
+        logger.info(msg)
+
+    def warning(self, msg):
+        logger.warning(msg)
+
+    def error(self, msg):
+        raise Error(msg)
+
+
+def load_functions(con, bindings):
+    """ Instanciates the functions of bindings from their installed args
+
+    Args are read from the database rather than from the manifest, as they
+    hold secrets (ex: LDAP passwords) typed at install time.
+
+    @returns a dict funcname -> function
+    """
+    cur = con.cursor()
+    functions = {}
+    for binding in bindings:
+        binding.load_function(con)
+        func_name = binding.function.func_name()
+        cur.execute('SELECT data FROM copiste_pyargs WHERE funcname = %s',
+                    [func_name])
+        pyargs = marshal.loads(cur.fetchone()[0].decode('base64'))
+        f = binding.function.from_pyargs(pyargs)
+        f.set_uuid(binding.function.uuid)
+        functions[func_name] = f
+    con.commit()
+    return functions
+
+
+class QueueWorker(object):
+    """ Handles the changes queued by QueueWriteTrigger
+
+    Several workers can run at once : each takes batches of a binding it
+    holds a lock on, so the changes of a binding are handled in the order
+    they were queued. That is the order of the writes for a given row, whose
+    lock serializes them, but not quite the commit order across rows :
+    changes of concurrent transactions may interleave.
+
+    A batch which keeps failing may have been partly written already (LDAP
+    is not transactional), each replay failing on what is there : after
+    max_failures failures in a row, its changes are handled one by one, and
+    those failing are moved to the copiste_queue_failed table.
+    """
+    def __init__(self, con, functions, batch_size=500, poll_interval=10,
+                 max_failures=3):
+        """
+        @param con       a psycopg2 connection, dedicated to the worker
+        @param functions a dict funcname -> function, see load_functions()
+        @param batch_size    max number of changes handled per transaction
+        @param poll_interval max time to wait for a notification, in seconds
+        @param max_failures  failures of a batch before handling it apart
+        """
+        self.con = con
+        self.functions = functions
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_failures = max_failures
+        self.plpy = PlpyAdapter(con)
+        self.failures = 0
+        # funcname -> failures of its batch in a row
+        self.failed = {}
+
+    def dequeue(self, func_name):
+        """ Takes a batch of changes of a binding out of the queue
+
+        @returns a list of TD-like dicts, or None if another worker holds the
+                 binding.
+        """
+        rows = self.dequeue_rows(func_name)
+        if rows is None:
+            return None
+        return [copiste.functions.base.loads_change(row) for row in rows]
+
+    def dequeue_rows(self, func_name):
+        """ See dequeue()
+
+        @returns a list of (id, event, table_name, old_row, new_row) tuples,
+                 or None
+        """
+        cur = self.con.cursor()
+        cur.execute("SELECT pg_try_advisory_xact_lock("+
+                    "hashtext(%s), hashtext(%s))",
+                    [copiste.sql.QUEUE_TABLE, func_name])
+        if not cur.fetchone()[0]:
+            return None
+
+        cur.execute(
+            ("DELETE FROM {table} WHERE id IN ("+
+             "SELECT id FROM {table} WHERE funcname = %s "+
+             "ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED) "+
+             "RETURNING id, event, table_name, old_row, new_row"
+            ).format(table=copiste.sql.QUEUE_TABLE),
+            [func_name, self.batch_size])
+        return sorted(cur.fetchall())
+
+    def process_batch(self):
+        """ Handles one batch of changes of each binding
+
+        A failing batch is put back in the queue, and retried later.
+
+        @returns the number of handled changes.
+        """
+        done = 0
+        self.failures = 0
+        func_names = self.functions.keys()
+        random.shuffle(func_names)
+        for func_name in func_names:
+            f = self.functions[func_name]
+            try:
+                rows = self.dequeue_rows(func_name)
+                if rows and self.failed.get(func_name, 0) >= self.max_failures:
+                    self.handle_apart(func_name, rows)
+                elif rows:
+                    changes = [copiste.functions.base.loads_change(row)
+                               for row in rows]
+                    f.measured('QUEUE', self.plpy, f.call_batch, changes)
+                done += len(rows or [])
+            except Exception:
+                logger.exception('failed to handle changes for {}'.format(
+                        func_name))
+                self.con.rollback()
+                self.failures += 1
+                self.failed[func_name] = self.failed.get(func_name, 0) + 1
+            else:
+                self.con.commit()
+                if rows:
+                    self.failed.pop(func_name, None)
+            self.flush_stats(func_name)
+        return done
+
+    def handle_apart(self, func_name, rows):
+        """ Handles changes one by one, each in a savepoint, moving those
+        which fail to the copiste_queue_failed table.
+
+        Transient errors (see PlPythonFunction.is_transient()) are raised.
+        """
+        f = self.functions[func_name]
+        cur = self.con.cursor()
+        for row in rows:
+            cur.execute('SAVEPOINT copiste_change')
+            try:
+                f.measured('QUEUE', self.plpy, f.call_batch,
+                           [copiste.functions.base.loads_change(row)])
+            except Exception, e:
+                if (isinstance(e, psycopg2.OperationalError) or
+                    f.is_transient(e)):
+                    raise
+                logger.error('moving change {} of {} to {} : {}'.format(
+                        row[0], func_name, copiste.sql.QUEUE_FAILED_TABLE, e))
+                cur.execute('ROLLBACK TO SAVEPOINT copiste_change')
+                cur.execute(
+                    ('INSERT INTO {}(id, funcname, event, table_name, '+
+                     'old_row, new_row, error) '+
+                     'VALUES (%s, %s, %s, %s, %s, %s, %s)').format(
+                        copiste.sql.QUEUE_FAILED_TABLE),
+                    [row[0], func_name] + list(row[1:]) + [str(e)])
+            cur.execute('RELEASE SAVEPOINT copiste_change')
+
+    def flush_stats(self, func_name):
+        """ Writes the stats of a function, in a transaction of their own
+        """
+        try:
+            self.functions[func_name].stats.flush(self.plpy, func_name)
+        except psycopg2.Error:
+            logger.exception('failed to write stats for {}'.format(func_name))
+            self.con.rollback()
+        else:
+            self.con.commit()
+
+    def run(self):
+        """ Handles the queue forever
+        """
+        cur = self.con.cursor()
+        cur.execute('LISTEN {}'.format(copiste.sql.QUEUE_CHANNEL))
+        self.con.commit()
+
+        while True:
+            done = self.process_batch()
+            if self.failures:
+                # do not hammer a failing LDAP server
+                time.sleep(self.poll_interval)
+            elif done == 0:
+                if select.select([self.con], [], [], self.poll_interval)[0]:
+                    self.con.poll()
+                    del self.con.notifies[:]
@@ -13,6 +13,7 @@ import copiste
 import copiste.sql
 import copiste.functions.base
 import copiste.binding
+import copiste.init
 
 def randomstring():
     return '%030x' % random.randrange(16**30)
@@ -187,6 +188,118 @@ class TestBinding(AbstractPgEnviron):
         self.assertIn('44object', log_result)
 
 
+    def test_initial_sync_chunks(self):
+        self.cur.execute('CREATE LANGUAGE plpythonu')
+        self.cur.execute('CREATE TABLE unittest_pk (id INT PRIMARY KEY, mail TEXT)')
+        self.cur.execute("INSERT INTO unittest_pk SELECT i, 'user' || i "+
+                         "FROM generate_series(1, 5) i")
+        self.con.commit()
+
+        function = copiste.functions.base.Noop()
+        trigger = copiste.sql.WriteTrigger('unittest_pk', function.func_name())
+        bind = copiste.binding.Bind(trigger, function)
+        bind.install(self.con)
+        self.con.commit()
+
+        self.assertEqual(bind.primary_key(self.con), ['id'])
+        progress = []
+        self.assertEqual(
+            bind.initial_sync(self.con, chunk_size=2, progress=progress.append),
+            5)
+        self.assertEqual(progress, [2, 4, 5])
+
+        # the init function is dropped afterwards
+        self.cur.execute('SELECT count(*) FROM pg_proc WHERE proname = %s',
+                         [function.init_func_name()])
+        self.assertEqual(self.cur.fetchone()[0], 0)
+
+
+    def test_initial_sync_resume(self):
+        self.cur.execute('CREATE LANGUAGE plpythonu')
+        self.cur.execute('CREATE TABLE unittest_pk (id INT PRIMARY KEY, mail TEXT)')
+        self.cur.execute("INSERT INTO unittest_pk SELECT i, 'user' || i "+
+                         "FROM generate_series(1, 5) i")
+        self.con.commit()
+
+        function = copiste.functions.base.Noop()
+        trigger = copiste.sql.WriteTrigger('unittest_pk', function.func_name())
+        bind = copiste.binding.Bind(trigger, function)
+        bind.install(self.con)
+        self.con.commit()
+        self.assertEqual(bind.initial_sync(self.con, chunk_size=2), 5)
+
+        # as if it stopped after the second chunk
+        self.cur.execute(
+            "UPDATE copiste_init_progress SET last = ARRAY['4'], rows = 4, "+
+            "done = false WHERE funcname = %s", [function.func_name()])
+        self.con.commit()
+        progress = []
+        self.assertEqual(bind.initial_sync(self.con, chunk_size=2,
+                                           progress=progress.append,
+                                           resume=True), 5)
+        self.assertEqual(progress, [5])
+        self.cur.execute("SELECT rows, done FROM copiste_init_progress "+
+                         "WHERE funcname = %s", [function.func_name()])
+        self.assertEqual(self.cur.fetchall(), [(5, True)])
+
+
+    def test_parallel_init(self):
+        self.cur.execute('CREATE LANGUAGE plpythonu')
+        self.cur.execute('CREATE TABLE unittest_pk (id INT PRIMARY KEY, mail TEXT)')
+        self.cur.execute("INSERT INTO unittest_pk SELECT i, 'user' || i "+
+                         "FROM generate_series(1, 10) i")
+        self.cur.execute("INSERT INTO unittest_table SELECT i, 'user' || i "+
+                         "FROM generate_series(1, 7) i")
+        self.con.commit()
+
+        bindings = []
+        for table in ('unittest_pk', 'unittest_table'):
+            function = copiste.functions.base.Noop()
+            trigger = copiste.sql.WriteTrigger(table, function.func_name())
+            bindings.append(copiste.binding.Bind(trigger, function))
+            bindings[-1].install(self.con)
+        self.con.commit()
+
+        self.assertEqual(len(bindings[0].split_range(self.con, 3)), 3)
+        db_settings = SETTINGS.DB.copy()
+        db_settings['database'] = self.dbname
+        init = copiste.init.ParallelInit(db_settings, bindings, 3,
+                                         chunk_size=2)
+        self.assertEqual(init.run(), [10, 7])
+
+
+    def test_online_init(self):
+        self.cur.execute('CREATE LANGUAGE plpythonu')
+        self.cur.execute('CREATE TABLE unittest_pk (id INT PRIMARY KEY, mail TEXT)')
+        self.cur.execute("INSERT INTO unittest_pk SELECT i, 'user' || i "+
+                         "FROM generate_series(1, 5) i")
+        self.con.commit()
+
+        function = copiste.functions.base.Noop()
+        trigger = copiste.sql.WriteTrigger('unittest_pk', function.func_name())
+        bind = copiste.binding.Bind(trigger, function)
+        db_settings = SETTINGS.DB.copy()
+        db_settings['database'] = self.dbname
+        init = copiste.init.OnlineInit(db_settings, [bind], chunk_size=2)
+        init.capture()
+
+        # written before the snapshot : loaded, not replayed
+        self.cur.execute("INSERT INTO unittest_pk VALUES (6, 'user6')")
+        self.con.commit()
+        self.cur.execute('SELECT count(*) FROM copiste_queue')
+        self.assertEqual(self.cur.fetchone()[0], 1)
+
+        self.assertEqual(init.run(), [6])
+        self.assertEqual(init.seen, [1])
+        self.cur.execute('SELECT count(*) FROM copiste_queue')
+        self.assertEqual(self.cur.fetchone()[0], 0)
+        self.assertEqual(sorted(bind.installed_triggers(self.con).keys()),
+                         sorted(trigger.db_names()))
+        self.cur.execute("SELECT count(*) FROM pg_trigger WHERE tgname = %s",
+                         [bind.capture_trigger().db_name()])
+        self.assertEqual(self.cur.fetchone()[0], 0)
+
+
     def test_log_action_load_function(self):
         msg = 'unittest_'+randomstring()
         self.cur.execute('CREATE LANGUAGE plpythonu')
@@ -208,6 +321,67 @@ class TestBinding(AbstractPgEnviron):
 
 
 
+    def test_apply(self):
+        self.cur.execute('CREATE LANGUAGE plpythonu')
+        self.cur.execute('CREATE TABLE unittest_pk (id INT PRIMARY KEY, mail TEXT)')
+        self.con.commit()
+
+        def bindings(message):
+            return [copiste.binding.Bind(
+                    copiste.sql.WriteTrigger(table, table),
+                    copiste.functions.base.LogWarn(message=message))
+                    for table in ('unittest_table', 'unittest_pk')]
+
+        first = bindings('before')
+        self.assertEqual([a for _, a in copiste.binding.apply(self.con, first)],
+                         ['installed', 'installed'])
+        self.con.commit()
+        self.assertEqual(
+            [a for _, a in copiste.binding.apply(self.con, bindings('before'))],
+            ['unchanged', 'unchanged'])
+
+        # one binding changed, the other one removed
+        self.assertEqual(
+            [a for _, a in copiste.binding.apply(
+                    self.con, bindings('after')[:1])],
+            ['reloaded', 'removed'])
+        self.con.commit()
+        self.assertEqual(first[1].installed_triggers(self.con), {})
+        self.assertEqual(copiste.binding.installed_state(self.con).keys(),
+                         [first[0].function.func_name()])
+
+
+    def test_reload(self):
+        self.cur.execute('CREATE LANGUAGE plpythonu')
+        self.con.commit()
+
+        trigger = copiste.sql.WriteTrigger('unittest_table', 'warn_on_write')
+        bind = copiste.binding.Bind(
+            trigger, copiste.functions.base.LogWarn(message='before'))
+        self.assertEqual(bind.reload(self.con), 'installed')
+        self.con.commit()
+        self.assertEqual(bind.reload(self.con), 'unchanged')
+
+        # args change : the trigger is kept
+        bind = copiste.binding.Bind(
+            trigger, copiste.functions.base.LogWarn(message='after'))
+        installed = bind.installed_triggers(self.con)
+        self.assertEqual(bind.reload(self.con), 'reloaded')
+        self.assertEqual(bind.installed_triggers(self.con), installed)
+        self.cur.execute(
+            "SELECT data FROM copiste_pyargs WHERE funcname = %s",
+            [bind.function.func_name()])
+        self.assertEqual(self.cur.fetchone()[0],
+                         bind.function._marshalled_args())
+
+        # trigger change : the trigger is recreated
+        bind = copiste.binding.Bind(
+            copiste.sql.QueueWriteTrigger('unittest_table', 'warn_on_write'),
+            copiste.functions.base.LogWarn(message='after'))
+        self.assertEqual(bind.reload(self.con), 'reinstalled')
+        self.assertEqual(bind.reload(self.con), 'unchanged')
+
+
 class TestFunctions(AbstractPgEnviron):
     def test_register_two_occurences(self):
         self.cur.execute('CREATE LANGUAGE plpythonu')
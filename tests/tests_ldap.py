@@ -5,6 +5,7 @@ import copiste.ldapsync
 import time
 
 import copiste.functions.ldapfuncs
+import copiste.worker
 
 from tests_functional import AbstractPgEnviron
 
@@ -91,6 +92,19 @@ class TestLDAPModel(unittest.TestCase):
                     'sn': ['Barnes'], 'givenName': ['Jane'], 'uid': ['42']}
         self.assertEqual(result_fields, expected_attrs)
 
+    def test_get_attrlist(self):
+        mod = copiste.ldapsync.LDAPModel(
+            query='(&(objectClass=inetOrgPerson)(uid={uid}))',
+            base='ou=users,dc=foo,dc=bar',
+            dn = 'uid={uid},ou=users,dc=foo,dc=bar',
+            scope = 'one',
+        )
+        result_dn, result_fields = mod.get(self.ldap_c, {'uid':'42'},
+                                           ['mail', 'sn'])
+        self.assertEqual(result_dn, 'cn=jdoe,ou=users,dc=foo,dc=bar')
+        self.assertEqual(result_fields,
+                         {'mail': ['jane@doe.tld'], 'sn': ['Barnes']})
+
     def test_get_noentry(self):
         mod = copiste.ldapsync.LDAPModel(
             query='(&(objectClass=inetOrgPerson)(uid={uid}))',
@@ -326,6 +340,165 @@ class LDAPSync(AbstractLDAPPostgresBinding):
         self.assertEqual(dn, 'uid=1,ou=users,dc=foo,dc=bar')
         self.assertEqual(attrs, expected_attrs)
 
+class LDAPSyncStatement(AbstractLDAPPostgresBinding):
+    def setUp(self):
+        super(LDAPSyncStatement, self).setUp()
+
+        sync_ldap = copiste.functions.ldapfuncs.Copy2LDAP(
+            attrs_map  = {'uid': 'id', 'mail': 'mail', 'sn': 'mail',
+                          'cn': 'mail'},
+            ldap_model = self.ldap_user_model,
+            ldap_creds = self.creds
+        )
+
+        trigger = copiste.sql.StatementWriteTrigger(
+            sql_table = 'unittest_table',
+            name      = 'sync_users'
+        )
+
+        bind = copiste.binding.Bind(trigger, sync_ldap)
+        bind.install(self.con)
+
+    def test_sync_create_many(self):
+        self.cur.execute("INSERT INTO unittest_table (id, mail) "+
+                         "VALUES (1, 'foo@bar.com'), (2, 'bar@bar.com')")
+
+        dn, attrs = self.ldap_user_model.get(self.ldap_c, {'uid':'1'})
+        self.assertEqual(attrs['mail'], ['foo@bar.com'])
+        dn, attrs = self.ldap_user_model.get(self.ldap_c, {'uid':'2'})
+        self.assertEqual(attrs['mail'], ['bar@bar.com'])
+
+    def test_sync_update_many(self):
+        self.cur.execute("INSERT INTO unittest_table (id, mail) "+
+                         "VALUES (1, 'foo@bar.com'), (2, 'bar@bar.com')")
+        self.cur.execute(
+            "UPDATE unittest_table SET mail = 'updated'||id||'@bar.tld'")
+
+        dn, attrs = self.ldap_user_model.get(self.ldap_c, {'uid':'1'})
+        self.assertEqual(attrs['mail'], ['updated1@bar.tld'])
+        dn, attrs = self.ldap_user_model.get(self.ldap_c, {'uid':'2'})
+        self.assertEqual(attrs['mail'], ['updated2@bar.tld'])
+
+    def test_sync_delete_many(self):
+        self.cur.execute("INSERT INTO unittest_table (id, mail) "+
+                         "VALUES (1, 'foo@bar.com'), (2, 'bar@bar.com')")
+        self.cur.execute("DELETE FROM unittest_table")
+
+        dn, _ = self.ldap_user_model.get(self.ldap_c, {'uid':'1'})
+        self.assertEqual(dn, None)
+        dn, _ = self.ldap_user_model.get(self.ldap_c, {'uid':'2'})
+        self.assertEqual(dn, None)
+
+class LDAPSyncBuffered(AbstractLDAPPostgresBinding):
+    def setUp(self):
+        super(LDAPSyncBuffered, self).setUp()
+        self.con.commit()
+
+        sync_ldap = copiste.functions.ldapfuncs.Copy2LDAP(
+            attrs_map  = {'uid': 'id', 'mail': 'mail', 'sn': 'mail',
+                          'cn': 'mail'},
+            ldap_model = self.ldap_user_model,
+            ldap_creds = self.creds
+        )
+
+        trigger = copiste.sql.BufferedWriteTrigger(
+            sql_table = 'unittest_table',
+            name      = 'sync_users'
+        )
+
+        bind = copiste.binding.Bind(trigger, sync_ldap)
+        bind.install(self.con)
+        self.con.commit()
+
+    def test_sync_at_commit(self):
+        self.cur.execute(
+            "INSERT INTO unittest_table (id, mail) VALUES (1, 'foo@bar.com')")
+        self.cur.execute(
+            "UPDATE unittest_table set mail='updated@bar.tld' WHERE (id=1)")
+
+        dn, _ = self.ldap_user_model.get(self.ldap_c, {'uid':'1'})
+        self.assertEqual(dn, None)
+
+        self.con.commit()
+        dn, attrs = self.ldap_user_model.get(self.ldap_c, {'uid':'1'})
+        self.assertEqual(attrs['mail'], ['updated@bar.tld'])
+
+    def test_insert_delete_is_noop(self):
+        self.cur.execute(
+            "INSERT INTO unittest_table (id, mail) VALUES (1, 'foo@bar.com')")
+        self.cur.execute("DELETE FROM unittest_table WHERE (id=1)")
+        self.con.commit()
+
+        dn, _ = self.ldap_user_model.get(self.ldap_c, {'uid':'1'})
+        self.assertEqual(dn, None)
+
+    def test_rollback(self):
+        self.cur.execute(
+            "INSERT INTO unittest_table (id, mail) VALUES (1, 'foo@bar.com')")
+        self.con.rollback()
+        self.cur.execute(
+            "INSERT INTO unittest_table (id, mail) VALUES (2, 'foo@bar.com')")
+        self.con.commit()
+
+        dn, _ = self.ldap_user_model.get(self.ldap_c, {'uid':'1'})
+        self.assertEqual(dn, None)
+        dn, _ = self.ldap_user_model.get(self.ldap_c, {'uid':'2'})
+        self.assertEqual(dn, 'uid=2,ou=users,dc=foo,dc=bar')
+
+    def test_rollback_to_savepoint(self):
+        self.cur.execute(
+            "INSERT INTO unittest_table (id, mail) VALUES (1, 'foo@bar.com')")
+        self.cur.execute("SAVEPOINT foo")
+        self.cur.execute(
+            "INSERT INTO unittest_table (id, mail) VALUES (2, 'foo@bar.com')")
+        self.cur.execute("ROLLBACK TO SAVEPOINT foo")
+        self.con.commit()
+
+        dn, _ = self.ldap_user_model.get(self.ldap_c, {'uid':'1'})
+        self.assertEqual(dn, 'uid=1,ou=users,dc=foo,dc=bar')
+        dn, _ = self.ldap_user_model.get(self.ldap_c, {'uid':'2'})
+        self.assertEqual(dn, None)
+
+class LDAPSyncQueue(AbstractLDAPPostgresBinding):
+    def setUp(self):
+        super(LDAPSyncQueue, self).setUp()
+
+        sync_ldap = copiste.functions.ldapfuncs.Copy2LDAP(
+            attrs_map  = {'uid': 'id', 'mail': 'mail', 'sn': 'mail',
+                          'cn': 'mail'},
+            ldap_model = self.ldap_user_model,
+            ldap_creds = self.creds
+        )
+
+        trigger = copiste.sql.QueueWriteTrigger(
+            sql_table = 'unittest_table',
+            name      = 'sync_users'
+        )
+
+        self.bind = copiste.binding.Bind(trigger, sync_ldap)
+        self.bind.install(self.con)
+        self.con.commit()
+
+    def test_sync_by_worker(self):
+        self.cur.execute(
+            "INSERT INTO unittest_table (id, mail) VALUES (1, 'foo@bar.com')")
+        self.cur.execute(
+            "UPDATE unittest_table set mail='updated@bar.tld' WHERE (id=1)")
+        self.con.commit()
+
+        dn, _ = self.ldap_user_model.get(self.ldap_c, {'uid':'1'})
+        self.assertEqual(dn, None)
+
+        functions = copiste.worker.load_functions(self.con, [self.bind])
+        worker = copiste.worker.QueueWorker(self.con, functions)
+        self.assertEqual(worker.process_batch(), 2)
+
+        dn, attrs = self.ldap_user_model.get(self.ldap_c, {'uid':'1'})
+        self.assertEqual(attrs['mail'], ['updated@bar.tld'])
+
+        self.cur.execute('SELECT COUNT(*) FROM copiste_queue')
+        self.assertEqual(self.cur.fetchone()[0], 0)
+
 class LDAPSyncWithDynAttr(AbstractLDAPPostgresBinding):
     def setUp(self):
         super(LDAPSyncWithDynAttr, self).setUp()
@@ -478,6 +651,60 @@ class LDAPAccumulate(AbstractLDAPPostgresBinding):
 
 
 
+class LDAPAccumulateStatement(AbstractLDAPPostgresBinding):
+    def setUp(self):
+        super(LDAPAccumulateStatement, self).setUp()
+
+        sample_user = {'objectClass': ['top', 'inetOrgPerson'],
+                       'mail': ['foo@bar.com'], 'sn': ['foo@bar.com'],
+                       'cn': ['foo@bar.com'], 'uid': ['1']}
+        self.ldap_c.add_s('uid=1,ou=users,dc=foo,dc=bar',
+                          ldap.modlist.addModlist(sample_user))
+
+        self.cur.execute(
+            'CREATE TABLE unittest_alias (user_id INT, mail VARCHAR(100))')
+
+        accumulate_aliases = copiste.functions.ldapfuncs.Accumulate2LDAPField(
+            ldap_field = 'mail',
+            keys_map   = {'uid': 'user_id'},
+            ldap_model = self.ldap_user_model,
+            ldap_creds = self.creds
+        )
+
+        trigger = copiste.sql.StatementWriteTrigger(
+            sql_table = 'unittest_alias',
+            name      = 'accumulate_mail_aliases'
+        )
+
+        bind = copiste.binding.Bind(trigger, accumulate_aliases)
+        bind.install(self.con)
+
+    def test_insert_many(self):
+        self.cur.execute("INSERT INTO unittest_alias (user_id, mail) "+
+                         "VALUES (1, 'foo2@bar.com'), (1, 'foo3@bar.com')")
+
+        dn, attrs = self.ldap_user_model.get(self.ldap_c, {'uid':'1'})
+        self.assertEqual(attrs['mail'],
+                         ['foo@bar.com', 'foo2@bar.com', 'foo3@bar.com'])
+
+    def test_update_many(self):
+        self.cur.execute("INSERT INTO unittest_alias (user_id, mail) "+
+                         "VALUES (1, 'foo2@bar.com'), (1, 'foo3@bar.com')")
+        self.cur.execute("UPDATE unittest_alias SET mail = 'x'||mail")
+
+        dn, attrs = self.ldap_user_model.get(self.ldap_c, {'uid':'1'})
+        self.assertEqual(attrs['mail'],
+                         ['foo@bar.com', 'xfoo2@bar.com', 'xfoo3@bar.com'])
+
+    def test_delete_many(self):
+        self.cur.execute("INSERT INTO unittest_alias (user_id, mail) "+
+                         "VALUES (1, 'foo2@bar.com'), (1, 'foo3@bar.com')")
+        self.cur.execute("DELETE FROM unittest_alias")
+
+        dn, attrs = self.ldap_user_model.get(self.ldap_c, {'uid':'1'})
+        self.assertEqual(attrs['mail'], ['foo@bar.com'])
+
+
 class TestStoreIfExists(AbstractLDAPPostgresBinding):
     def setUp(self):
         super(TestStoreIfExists, self).setUp()
@@ -761,6 +988,15 @@ SELECT mail FROM unittest_alias WHERE user_id='{id}'
         self.assertEqual(set(attrs1['mail']),
                          set(['foo2updated@bar.tld', 'foomain2@bar.com']))
 
+    def test_sql_main_update_accumulates(self):
+        # mail is read by the request only, not by the keys
+        self.cur.execute(self.sql_insert_main)
+        self.cur.execute(
+            "UPDATE unittest_table SET mail='foomain2updated@bar.tld' "+
+            "WHERE id=1")
+        dn1, attrs1 = self.ldap_user_model.get(self.ldap_c, {'uid':'1'})
+        self.assertEqual(attrs1['mail'], ['foomain2updated@bar.tld'])
+
     def test_sql_both_delete_accumulates(self):
         self.cur.execute(self.sql_insert_main)
         self.cur.execute(self.sql_insert_alias)
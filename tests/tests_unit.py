@@ -8,6 +8,11 @@ sys.path.insert(0, dirname(dirname(abspath(__file__))))
 from unittest import TestCase
 from copiste.sql import *
 from copiste.functions.base import *
+import copiste.functions.base
+import copiste.stats
+import decimal
+import pstats
+import time
 import sys
 
 import tempfile
@@ -55,19 +60,94 @@ CREATE FUNCTION {funcname}()
 RETURNS TRIGGER
 AS
 $$
-  import copiste
-  import copiste.functions.base
-  import marshal
-  sql_pyargs = "SELECT data FROM copiste_pyargs WHERE funcname = '{funcname}'"
-  pyargs_marshalled = plpy.execute(sql_pyargs)[0]['data']
-  pyargs = marshal.loads(pyargs_marshalled.decode('base64'))
-  f = copiste.functions.base.PlPythonFunction(**pyargs)
-  return f.call(TD, plpy)
+  try:
+    f = SD['function']
+  except KeyError:
+    import copiste.functions.base
+    f = copiste.functions.base.PlPythonFunction.load(
+      '{funcname}', '{args_key}', plpy, GD)
+    SD['function'] = f
+  return f.run(TD, plpy)
 $$
 LANGUAGE plpythonu SECURITY DEFINER;
-        """.format(funcname = 'copiste__plpythonfunction__'+ppf.uuid)
+        """.format(funcname = 'copiste__plpythonfunction__'+ppf.uuid,
+                   args_key = ppf.args_key())
         self.assertEqual(ppf.sql_install(), expected)
 
+    def test_plpythonfunction_sql_install_replace(self):
+        ppf = PlPythonFunction()
+        self.assertTrue(ppf.sql_install(replace=True).startswith(
+                '\nCREATE OR REPLACE FUNCTION copiste__plpythonfunction__'))
+
+    def test_plpythonfunction_args_key(self):
+        ppf1 = PlPythonFunction(foo='bar')
+        ppf2 = PlPythonFunction(foo='bar')
+        ppf3 = PlPythonFunction(foo='baz')
+        self.assertEqual(ppf1.args_key(), ppf2.args_key())
+        self.assertNotEqual(ppf1.args_key(), ppf3.args_key())
+        self.assertIn(ppf3.args_key(), ppf3.sql_install())
+
+    def test_plpythonfunction_load_caches_args(self):
+        ppf = PlPythonFunction(foo='bar')
+
+        class FakePlpy:
+            queries = []
+            def execute(self, query):
+                self.queries.append(query)
+                return [{'data': ppf._marshalled_args()}]
+
+        plpy = FakePlpy()
+        GD = {}
+        f1 = PlPythonFunction.load(ppf.func_name(), ppf.args_key(), plpy, GD)
+        f2 = PlPythonFunction.load(ppf.func_name(), ppf.args_key(), plpy, GD)
+        self.assertEqual(f1.args, {'foo': 'bar'})
+        self.assertEqual(f2.args, {'foo': 'bar'})
+        self.assertIs(f1, f2)
+        self.assertEqual(len(plpy.queries), 1)
+
+        # a different key (reinstall) fetches the args again
+        PlPythonFunction.load(ppf.func_name(), 'otherkey', plpy, GD)
+        self.assertEqual(len(plpy.queries), 2)
+
+    def test_plpythonfunction_load_options(self):
+        ppf = PlPythonFunction(message='foo')
+        ppf.options['profile'] = 10
+        class FakePlpy:
+            def execute(self, query):
+                return [{'data': ppf._marshalled_args()}]
+
+        f = PlPythonFunction.load(ppf.func_name(), ppf.args_key(), FakePlpy(),
+                                  {})
+        self.assertEqual(f.args, {'message': 'foo'})
+        self.assertEqual(f.options, {'profile': 10})
+        self.assertNotEqual(ppf.args_key(), PlPythonFunction(
+                message='foo').args_key())
+
+    def test_plpythonfunction_warmup(self):
+        ppf = Noop(foo='bar')
+        class FakePlpy:
+            warnings = []
+            def execute(self, query):
+                if ppf.func_name() in query:
+                    return [{'data': ppf._marshalled_args()}]
+                return []
+            def warning(self, msg):
+                self.warnings.append(msg)
+
+        plpy = FakePlpy()
+        GD = {}
+        functions = [('base', 'Noop', ppf.func_name(), ppf.args_key()),
+                     ('base', 'Noop', 'copiste__noop__42', 'gone')]
+        self.assertEqual(copiste.functions.base.warmup(functions, plpy, GD), 1)
+        self.assertEqual(len(plpy.warnings), 1)
+        self.assertEqual(GD['copiste_functions'][ppf.func_name()][1].args,
+                         {'foo': 'bar'})
+
+        sql = PlPythonFunction.sql_install_warmup([ppf])
+        self.assertIn('CREATE OR REPLACE FUNCTION copiste_warmup()', sql)
+        self.assertIn(repr([('base', 'Noop', ppf.func_name(),
+                             ppf.args_key())]), sql)
+
     def test_plpythonfunction_sql_uninstall(self):
         ppf = PlPythonFunction()
         expected = 'DROP FUNCTION copiste__plpythonfunction__{}()'.format(
@@ -82,31 +162,47 @@ INSERT INTO copiste_pyargs(funcname, data) VALUES('{}', '{}');
 """.format('copiste__plpythonfunction__'+ppf.uuid, 'ezA='  )
         self.assertEqual(ppf.sql_insert_args(), expected)
 
+    def test_plpythonfunction_sql_update_args(self):
+        ppf = PlPythonFunction()
+        expected = "UPDATE copiste_pyargs SET data = 'ezA=' "+\
+            "WHERE funcname = 'copiste__plpythonfunction__{}';".format(ppf.uuid)
+        self.assertEqual(ppf.sql_update_args(), expected)
+
 
     def test_plpythonfunction_sql_install_init(self):
         ppf = PlPythonFunction()
         expected = """
-CREATE FUNCTION copiste__tmp__plpythonfunction__{uuid}(new unittest_table)
-RETURNS void
+CREATE FUNCTION copiste__tmp__plpythonfunction__{uuid}(rows unittest_table[],
+                                 flush boolean DEFAULT true)
+RETURNS integer
 AS
 $$
-  import copiste
-  import copiste.functions.base
-  import marshal
-  sql_pyargs = "SELECT data FROM copiste_pyargs WHERE funcname = 'copiste__plpythonfunction__{uuid}'"
-  pyargs_marshalled = plpy.execute(sql_pyargs)[0]['data']
-  pyargs = marshal.loads(pyargs_marshalled.decode('base64'))
-  f = copiste.functions.base.PlPythonFunction(**pyargs)
-  f.call({{'new': new, 'event': 'INSERT'}}, plpy)
+  if not rows:
+    if flush and 'function' in SD:
+      SD['function'].stats.flush(plpy, 'copiste__plpythonfunction__{uuid}', force=True)
+    return 0
+  try:
+    f = SD['function']
+  except KeyError:
+    import copiste.functions.base
+    f = copiste.functions.base.PlPythonFunction.load(
+      'copiste__plpythonfunction__{uuid}', '{args_key}', plpy, GD)
+    SD['function'] = f
+  f.measured('INIT', plpy, f.call_batch,
+             [{{'new': new, 'event': 'INSERT', 'when': 'AFTER',
+               'level': 'ROW', 'table_name': 'unittest_table'}}
+              for new in rows])
+  f.stats.flush(plpy, 'copiste__plpythonfunction__{uuid}', force=flush)
+  return len(rows)
 $$
 LANGUAGE plpythonu;
-        """.format(uuid=ppf.uuid)
+        """.format(uuid=ppf.uuid, args_key=ppf.args_key())
         self.assertEqual(ppf.sql_install_init(table='unittest_table'), expected)
 
 
     def test_plpythonfunction_sql_uninstall_init(self):
         ppf = PlPythonFunction()
-        expected = 'DROP FUNCTION copiste__tmp__plpythonfunction__{}(new unittest_table)'.format(
+        expected = 'DROP FUNCTION IF EXISTS copiste__tmp__plpythonfunction__{}(unittest_table[], boolean)'.format(
             ppf.uuid
         )
         self.assertEqual(ppf.sql_uninstall_init('unittest_table'), expected)
@@ -115,6 +211,424 @@ LANGUAGE plpythonu;
         ppf = PlPythonFunction()
         self.assertEqual(ppf.extract_uuid(ppf.func_name()), ppf.uuid)
 
+    def test_plpythonfunction_sql_get_for_trigger(self):
+        ppf = PlPythonFunction()
+        self.assertIn("tgname IN ('copiste__foo', 'copiste__foo__update')",
+                      ppf.sql_get_for_trigger(
+                          ['copiste__foo', 'copiste__foo__update']))
+        self.assertIn("tgname IN ('copiste__foo')",
+                      ppf.sql_get_for_trigger('copiste__foo'))
+
+    def test_plpythonfunction_plans_cache(self):
+        class FakePlpy:
+            prepared = []
+            def prepare(self, query, types):
+                self.prepared.append((query, types))
+                return (query, tuple(types))
+            def execute(self, plan, args):
+                return [{'plan': plan, 'args': args}]
+
+        plpy = FakePlpy()
+        ppf = PlPythonFunction()
+        q = 'SELECT mail FROM unittest_table WHERE id = $1'
+        res1 = ppf.execute(plpy, q, [1])
+        res2 = ppf.execute(plpy, q, [2])
+        self.assertEqual(plpy.prepared, [(q, ['bigint'])])
+        self.assertEqual(res1[0]['args'], [1])
+        self.assertEqual(res2[0]['args'], [2])
+
+        ppf.execute(plpy, q, ['foo'])
+        self.assertEqual(plpy.prepared[-1], (q, ['text']))
+
+    def test_plpythonfunction_call_batch(self):
+        calls = []
+        class Recorder(PlPythonFunction):
+            def call(self, TD, plpy):
+                calls.append(TD)
+
+        changes = [{'event': 'INSERT', 'new': {'id': 1}},
+                   {'event': 'INSERT', 'new': {'id': 2}}]
+        Recorder().call_batch(iter(changes), None)
+        self.assertEqual(calls, changes)
+
+    def test_plpythonfunction_run_dispatch(self):
+        calls = []
+        class Recorder(PlPythonFunction):
+            def call(self, TD, plpy):
+                calls.append(TD)
+
+        class FakePlpy:
+            def prepare(self, query, types):
+                return query
+            def execute(self, plan, args):
+                return [{'attname': 'id'}]
+            def cursor(self, query):
+                if 'copiste_old' in query:
+                    return iter([{'id': 1, 'v': 'a'}, {'id': 2, 'v': 'b'},
+                                 {'id': 3, 'v': 'c'}])
+                else:
+                    return iter([{'id': 2, 'v': 'B'}, {'id': 30, 'v': 'C'},
+                                 {'id': 1, 'v': 'A'}])
+
+        TD = {'level': 'STATEMENT', 'event': 'UPDATE', 'when': 'AFTER',
+              'name': 'copiste__foo__update', 'table_name': 'unittest_table',
+              'table_schema': 'public', 'relid': 42, 'args': None}
+        Recorder().run(TD, FakePlpy())
+        # paired by primary key, whatever the order
+        self.assertEqual(
+            [(c['event'], c.get('old'), c.get('new'), c['level'])
+             for c in calls],
+            [('UPDATE', {'id': 2, 'v': 'b'}, {'id': 2, 'v': 'B'}, 'ROW'),
+             ('UPDATE', {'id': 1, 'v': 'a'}, {'id': 1, 'v': 'A'}, 'ROW'),
+             ('DELETE', {'id': 3, 'v': 'c'}, None, 'ROW'),
+             ('INSERT', None, {'id': 30, 'v': 'C'}, 'ROW')])
+
+    def test_dispatch_row_after(self):
+        """ The row-level update trigger of a table without primary key
+        goes through call_batch(), as the row is already changed """
+        calls = []
+        class Recorder(PlPythonFunction):
+            def call(self, TD, plpy):
+                calls.append(('call', TD['event']))
+            def call_batch(self, changes, plpy):
+                calls.append(('call_batch', [c['event'] for c in changes]))
+
+        TD = {'level': 'ROW', 'event': 'UPDATE', 'when': 'AFTER',
+              'name': 'copiste__foo__update', 'table_name': 'unittest_table',
+              'old': {'v': 'a'}, 'new': {'v': 'b'}, 'args': None}
+        Recorder().dispatch(TD, None)
+        Recorder().dispatch(dict(TD, when='BEFORE'), None)
+        self.assertEqual(calls, [('call_batch', ['UPDATE']),
+                                 ('call', 'UPDATE')])
+
+    def test_transition_changes_no_key(self):
+        class FakePlpy:
+            def prepare(self, query, types):
+                return query
+            def execute(self, plan, args):
+                return []
+            def cursor(self, query):
+                if 'copiste_old' in query:
+                    return iter([{'v': 'a'}])
+                return iter([{'v': 'b'}])
+
+        TD = {'level': 'STATEMENT', 'event': 'UPDATE', 'when': 'AFTER',
+              'name': 'copiste__foo__update', 'table_name': 'unittest_table',
+              'table_schema': 'public', 'relid': 42, 'args': None}
+        changes = PlPythonFunction().transition_changes(TD, FakePlpy())
+        self.assertEqual([(c['event'], c.get('old'), c.get('new'))
+                          for c in changes],
+                         [('DELETE', {'v': 'a'}, None),
+                          ('INSERT', None, {'v': 'b'})])
+
+    def test_plpythonfunction_buffer_flush(self):
+        batches = []
+        class Recorder(PlPythonFunction):
+            def call_batch(self, changes, plpy):
+                batches.append(changes)
+
+        class FakePlpy:
+            """ Holds the buffer table, rows of other transactions are not
+            seen """
+            txid = 1
+            def __init__(self):
+                self.table = []
+            def prepare(self, query, types):
+                return query
+            def execute(self, plan, args):
+                if plan.startswith('INSERT INTO copiste_buffer'):
+                    self.table.append(dict(
+                            id=len(self.table) + 1, txid=self.txid,
+                            funcname=args[0], event=args[1],
+                            table_name=args[2], old_row=args[3],
+                            new_row=args[4]))
+                    return []
+                self.assertIn('DELETE FROM copiste_buffer', plan)
+                rows = [r for r in self.table
+                        if r['txid'] == self.txid and r['funcname'] == args[0]]
+                self.table = [r for r in self.table if not r in rows]
+                return list(reversed(rows))
+
+        plpy = FakePlpy()
+        plpy.assertIn = self.assertIn
+        f = Recorder()
+        buffered = {'level': 'ROW', 'args': ['buffer'], 'event': 'INSERT',
+                    'table_name': 'unittest_table'}
+        flush = {'level': 'ROW', 'args': ['flush'], 'event': 'INSERT'}
+
+        f.run(dict(buffered, new={'id': 1}), plpy)
+        f.run(dict(buffered, new={'id': 2}), plpy)
+        # rolled back to a savepoint
+        f.run(dict(buffered, new={'id': 3}), plpy)
+        plpy.table.pop()
+        f.run(flush, plpy)
+        f.run(flush, plpy)
+        self.assertEqual(len(batches), 1)
+        self.assertEqual([c['new'] for c in batches[0]],
+                         [{'id': 1}, {'id': 2}])
+        self.assertEqual(batches[0][0]['table_name'], 'unittest_table')
+
+        # changes of another transaction are not flushed
+        f.run(dict(buffered, new={'id': 4}), plpy)
+        plpy.txid = 2
+        f.run(dict(buffered, new={'id': 5}), plpy)
+        f.run(flush, plpy)
+        self.assertEqual([c['new'] for c in batches[1]], [{'id': 5}])
+
+    def test_plpythonfunction_enqueue(self):
+        class Columns(PlPythonFunction):
+            def sql_columns(self):
+                return ['id']
+
+        class FakePlpy:
+            executed = []
+            def prepare(self, query, types):
+                return query
+            def execute(self, plan, args):
+                self.executed.append((plan, args))
+
+        plpy = FakePlpy()
+        f = Columns()
+        TD = {'level': 'ROW', 'args': ['enqueue'], 'event': 'UPDATE',
+              'table_name': 'unittest_table',
+              'old': {'id': 1, 'mail': 'a'}, 'new': {'id': 2, 'mail': 'b'}}
+        f.run(TD, plpy)
+
+        insert, args = plpy.executed[0]
+        self.assertIn('INSERT INTO copiste_queue', insert)
+        self.assertEqual(args, [f.func_name(), 'UPDATE', 'unittest_table',
+                                '{"id": 1}', '{"id": 2}'])
+        self.assertIn('pg_notify', plpy.executed[1][0])
+
+class TestStats(TestCase):
+    def test_run_counts(self):
+        class Failing(PlPythonFunction):
+            def call(self, TD, plpy):
+                plpy.execute('SELECT 1')
+                if TD['new'] is None:
+                    raise ValueError('no row')
+
+        class FakePlpy:
+            def execute(self, query, args=[]):
+                return []
+
+        f = Failing()
+        TD = {'level': 'ROW', 'event': 'INSERT', 'args': None, 'new': {}}
+        f.run(TD, FakePlpy())
+        f.run(TD, FakePlpy())
+        with self.assertRaises(ValueError):
+            f.run(dict(TD, new=None), FakePlpy())
+
+        counters = f.stats.counters['INSERT']
+        self.assertEqual(counters['calls'], 3)
+        self.assertEqual(counters['errors'], 1)
+        self.assertTrue(counters['total_time'] >= counters['max_time'] > 0)
+        self.assertTrue(counters['sql_time'] > 0)
+
+    def test_timed_cursor(self):
+        class FakePlpy:
+            def cursor(self, query, args=[]):
+                def rows():
+                    for i in range(3):
+                        time.sleep(0.01)
+                        yield {'id': i}
+                return rows()
+
+        stats = copiste.stats.Stats()
+        stats.start('INIT')
+        cursor = stats.timed_plpy(FakePlpy()).cursor('SELECT id FROM foo')
+        self.assertTrue(stats.current['sql_time'] < 0.01)
+        self.assertEqual([row['id'] for row in cursor], [0, 1, 2])
+        # the fetches are counted
+        self.assertTrue(stats.current['sql_time'] >= 0.03)
+
+    def test_timed_ldap(self):
+        class FakeLDAP:
+            def search_s(self, *args):
+                return []
+            def modify_s(self, *args):
+                pass
+            def unbind_s(self):
+                pass
+
+        stats = copiste.stats.Stats()
+        stats.start('UPDATE')
+        c = stats.timed_ldap(FakeLDAP())
+        c.search_s('dc=foo', 2, '(uid=bar)')
+        c.modify_s('uid=bar,dc=foo', [])
+        c.modify_s('uid=bar,dc=foo', [])
+        c.unbind_s()
+        self.assertEqual(stats.current['ldap_searches'], 1)
+        self.assertEqual(stats.current['ldap_modifies'], 2)
+        self.assertTrue(stats.current['ldap_time'] > 0)
+
+    def test_flush(self):
+        class FakePlpy:
+            SPIError = Exception
+            def __init__(self):
+                self.executed = []
+            def prepare(self, query, types=[]):
+                return query
+            def execute(self, query, args=[]):
+                self.executed.append(query)
+                return []
+
+        plpy = FakePlpy()
+        stats = copiste.stats.Stats()
+        stats.stop(stats.start('DELETE'))
+
+        stats.flush(plpy, 'copiste__foo')
+        self.assertEqual(plpy.executed, [])
+
+        stats.flush(plpy, 'copiste__foo', force=True)
+        self.assertEqual(len(plpy.executed), 2)
+        self.assertIn('UPDATE copiste_stats', plpy.executed[0])
+        self.assertIn('INSERT INTO copiste_stats', plpy.executed[1])
+
+        # nothing new to write
+        stats.flush(plpy, 'copiste__foo', force=True)
+        self.assertEqual(len(plpy.executed), 2)
+
+    def test_profile(self):
+        class Profiled(PlPythonFunction):
+            def call(self, TD, plpy):
+                sorted(range(100))
+
+        f = Profiled()
+        f.options['profile'] = 1
+        TD = {'level': 'ROW', 'event': 'INSERT', 'args': None, 'new': {}}
+        f.run(TD, None)
+        f.run(TD, None)
+        self.assertEqual(f.profiler.calls, 2)
+
+        profile = copiste.stats.StoredProfile(f.profiler.dumps())
+        merged = pstats.Stats(profile)
+        merged.add(copiste.stats.StoredProfile(f.profiler.dumps()))
+        names = [func[2] for func in merged.stats.keys()]
+        self.assertIn('call', names)
+
+    def test_profile_disabled(self):
+        f = PlPythonFunction()
+        self.assertFalse(f.profiler.sampled(f.options.get('profile')))
+        self.assertTrue(f.profiler.sampled(1))
+
+class TestCoalesceChanges(TestCase):
+    def key(self, row):
+        return row['id']
+
+    def test_insert_update(self):
+        changes = [{'event': 'INSERT', 'new': {'id': 1, 'v': 'a'}},
+                   {'event': 'UPDATE', 'old': {'id': 1, 'v': 'a'},
+                                       'new': {'id': 1, 'v': 'b'}},
+                   {'event': 'UPDATE', 'old': {'id': 1, 'v': 'b'},
+                                       'new': {'id': 1, 'v': 'c'}}]
+        self.assertEqual(coalesce_changes(changes, self.key),
+                         [{'event': 'INSERT', 'new': {'id': 1, 'v': 'c'}}])
+
+    def test_insert_update_delete(self):
+        changes = [{'event': 'INSERT', 'new': {'id': 1, 'v': 'a'}},
+                   {'event': 'UPDATE', 'old': {'id': 1, 'v': 'a'},
+                                       'new': {'id': 1, 'v': 'b'}},
+                   {'event': 'DELETE', 'old': {'id': 1, 'v': 'b'}}]
+        self.assertEqual(coalesce_changes(changes, self.key), [])
+
+    def test_update_delete(self):
+        changes = [{'event': 'UPDATE', 'old': {'id': 1, 'v': 'a'},
+                                       'new': {'id': 1, 'v': 'b'}},
+                   {'event': 'DELETE', 'old': {'id': 1, 'v': 'b'}}]
+        self.assertEqual(coalesce_changes(changes, self.key),
+                         [{'event': 'DELETE', 'old': {'id': 1, 'v': 'a'}}])
+
+    def test_delete_insert(self):
+        changes = [{'event': 'DELETE', 'old': {'id': 1, 'v': 'a'}},
+                   {'event': 'INSERT', 'new': {'id': 1, 'v': 'b'}}]
+        self.assertEqual(coalesce_changes(changes, self.key),
+                         [{'event': 'UPDATE', 'old': {'id': 1, 'v': 'a'},
+                                              'new': {'id': 1, 'v': 'b'}}])
+
+    def test_key_change(self):
+        changes = [{'event': 'UPDATE', 'old': {'id': 1}, 'new': {'id': 2}},
+                   {'event': 'UPDATE', 'old': {'id': 2}, 'new': {'id': 3}},
+                   {'event': 'INSERT', 'new': {'id': 4}}]
+        self.assertEqual(coalesce_changes(changes, self.key),
+                         [{'event': 'UPDATE', 'old': {'id': 1},
+                                              'new': {'id': 3}},
+                          {'event': 'INSERT', 'new': {'id': 4}}])
+
+class TestTemplates(TestCase):
+    def test_compile_template_quoted(self):
+        query, names = compile_template(
+            "SELECT mail FROM unittest_alias WHERE user_id = '{id}'")
+        self.assertEqual(query,
+                         'SELECT mail FROM unittest_alias WHERE user_id = $1')
+        self.assertEqual(names, ['id'])
+
+    def test_compile_template_multi(self):
+        query, names = compile_template(
+            "SELECT mail FROM t WHERE id='{user_id}'\n"+
+            "UNION SELECT mail FROM u WHERE a = {a} AND b = '{user_id}'")
+        self.assertEqual(query,
+                         "SELECT mail FROM t WHERE id=$1\n"+
+                         "UNION SELECT mail FROM u WHERE a = $2 AND b = $1")
+        self.assertEqual(names, ['user_id', 'a'])
+
+    def test_compile_template_escaped_braces(self):
+        query, names = compile_template(
+            "SELECT '{{1,2}}'::int[] WHERE id = {id}")
+        self.assertEqual(query, "SELECT '{1,2}'::int[] WHERE id = $1")
+        self.assertEqual(names, ['id'])
+
+    def test_compile_template_in_literal(self):
+        query, names = compile_template(
+            "SELECT 1 FROM t WHERE a LIKE '%{name}%' AND b = 'it''s {id}' "+
+            "AND c = '{id}{name}'")
+        self.assertEqual(query,
+                         "SELECT 1 FROM t WHERE a LIKE ('%' || $1 || '%') "+
+                         "AND b = ('it''s ' || $2) AND c = ($2 || $1)")
+        self.assertEqual(names, ['name', 'id'])
+
+    def test_inline_template(self):
+        quote = lambda s: "'{}'".format(s.replace("'", "''"))
+        template = ("SELECT 1 FROM t WHERE a LIKE '%{name}%' AND b = '{id}' "+
+                    "AND c = {n} AND d = {name} AND e = '{{x}}'")
+        self.assertEqual(
+            inline_template(template, {'name': "o'k", 'id': None, 'n': 4},
+                            quote),
+            "SELECT 1 FROM t WHERE a LIKE '%o''k%' AND b = NULL "+
+            "AND c = 4 AND d = 'o''k' AND e = '{x}'")
+
+    def test_execute_template_untyped(self):
+        class FakePlpy:
+            class SPIError(Exception):
+                pass
+            def __init__(self):
+                self.executed = []
+            def prepare(self, query, types=[]):
+                if 'text' in types:
+                    raise self.SPIError('operator does not exist: uuid = text')
+                return query
+            def execute(self, query, args=[]):
+                self.executed.append((query, args))
+                return []
+            def quote_literal(self, s):
+                return "'{}'".format(s)
+
+        plpy = FakePlpy()
+        template = "SELECT 1 FROM t WHERE uuid_col = '{id}' AND n = {n}"
+        PlPythonFunction().execute_template(plpy, template, {'id': 'a', 'n': 1})
+        PlPythonFunction().execute_template(plpy, template, {'id': 'b', 'n': 1})
+        self.assertEqual(plpy.executed, [
+                ("SELECT 1 FROM t WHERE uuid_col = 'a' AND n = 1", []),
+                ("SELECT 1 FROM t WHERE uuid_col = 'b' AND n = 1", [])])
+
+    def test_pg_type(self):
+        self.assertEqual(pg_type(True), 'boolean')
+        self.assertEqual(pg_type(42), 'bigint')
+        self.assertEqual(pg_type(4.2), 'double precision')
+        self.assertEqual(pg_type(decimal.Decimal('4.2')), 'numeric')
+        self.assertEqual(pg_type('foo'), 'text')
+        self.assertEqual(pg_type(None), 'text')
+
 class TestTrigger(TestCase):
     def test_writetrigger_enable(self):
         fooarg = [1,2,3]
@@ -126,8 +640,311 @@ class TestTrigger(TestCase):
         got = t.sql_enable('copiste__unittest_func', args={'foo': fooarg})
         self.assertEqual(expected, got)
 
+    def test_statementwritetrigger_enable(self):
+        t = StatementWriteTrigger('unittest_table', 'unittest_trigger')
+        expected = "CREATE TRIGGER copiste__unittest_trigger__insert AFTER "+\
+            "INSERT ON unittest_table REFERENCING NEW TABLE AS copiste_new "+\
+            "FOR EACH STATEMENT EXECUTE PROCEDURE copiste__unittest_func();"+\
+            "DO $$BEGIN IF EXISTS (SELECT 1 FROM pg_index WHERE indrelid = "+\
+            "'unittest_table'::regclass AND indisprimary) THEN "+\
+            "CREATE TRIGGER copiste__unittest_trigger__update AFTER "+\
+            "UPDATE ON unittest_table REFERENCING OLD TABLE AS copiste_old "+\
+            "NEW TABLE AS copiste_new "+\
+            "FOR EACH STATEMENT EXECUTE PROCEDURE copiste__unittest_func(); "+\
+            "ELSE CREATE TRIGGER copiste__unittest_trigger__update AFTER "+\
+            "UPDATE ON unittest_table FOR EACH ROW "+\
+            "EXECUTE PROCEDURE copiste__unittest_func(); END IF; END$$;"+\
+            "CREATE TRIGGER copiste__unittest_trigger__delete AFTER "+\
+            "DELETE ON unittest_table REFERENCING OLD TABLE AS copiste_old "+\
+            "FOR EACH STATEMENT EXECUTE PROCEDURE copiste__unittest_func();"
+        self.assertEqual(expected, t.sql_enable('copiste__unittest_func'))
+
+    def test_bufferedwritetrigger_enable(self):
+        t = BufferedWriteTrigger('unittest_table', 'unittest_trigger')
+        expected = "CREATE TRIGGER copiste__unittest_trigger AFTER INSERT "+\
+            "OR UPDATE OR DELETE ON unittest_table FOR EACH ROW "+\
+            "EXECUTE PROCEDURE copiste__unittest_func('buffer');"+\
+            "CREATE CONSTRAINT TRIGGER copiste__unittest_trigger__flush "+\
+            "AFTER INSERT OR UPDATE OR DELETE ON unittest_table "+\
+            "DEFERRABLE INITIALLY DEFERRED FOR EACH ROW "+\
+            "EXECUTE PROCEDURE copiste__unittest_func('flush');"
+        self.assertEqual(expected, t.sql_enable('copiste__unittest_func'))
+        self.assertIn('CREATE UNLOGGED TABLE IF NOT EXISTS copiste_buffer',
+                      t.sql_requirements()[0])
+
+    def test_queuewritetrigger_enable(self):
+        t = QueueWriteTrigger('unittest_table', 'unittest_trigger')
+        expected = "CREATE TRIGGER copiste__unittest_trigger AFTER INSERT "+\
+            "OR UPDATE OR DELETE ON unittest_table FOR EACH ROW "+\
+            "EXECUTE PROCEDURE copiste__unittest_func('enqueue');"
+        self.assertEqual(expected, t.sql_enable('copiste__unittest_func'))
+        self.assertIn('CREATE TABLE IF NOT EXISTS copiste_queue',
+                      t.sql_requirements()[0])
+
+    def test_writetrigger_enable_filtered(self):
+        t = WriteTrigger('unittest_table', 'unittest_trigger')
+        expected = "CREATE TRIGGER copiste__unittest_trigger BEFORE INSERT "+\
+            "OR DELETE ON unittest_table FOR EACH ROW "+\
+            "EXECUTE PROCEDURE copiste__unittest_func();"+\
+            "CREATE TRIGGER copiste__unittest_trigger__update BEFORE "+\
+            'UPDATE OF "id", "mail" ON unittest_table FOR EACH ROW '+\
+            'WHEN (OLD."id" IS DISTINCT FROM NEW."id" OR '+\
+            'OLD."mail" IS DISTINCT FROM NEW."mail") '+\
+            "EXECUTE PROCEDURE copiste__unittest_func();"
+        got = t.sql_enable('copiste__unittest_func', columns=['id', 'mail'])
+        self.assertEqual(expected, got)
+
+    def test_writetrigger_enable_events(self):
+        t = WriteTrigger('unittest_table', 'unittest_trigger')
+        expected = "CREATE TRIGGER copiste__unittest_trigger BEFORE INSERT "+\
+            "OR UPDATE ON unittest_table FOR EACH ROW "+\
+            "EXECUTE PROCEDURE copiste__unittest_func();"
+        got = t.sql_enable('copiste__unittest_func',
+                           events=('UPDATE', 'INSERT'))
+        self.assertEqual(expected, got)
+
+        expected = "CREATE TRIGGER copiste__unittest_trigger__update BEFORE "+\
+            'UPDATE OF "id" ON unittest_table FOR EACH ROW '+\
+            'WHEN (OLD."id" IS DISTINCT FROM NEW."id") '+\
+            "EXECUTE PROCEDURE copiste__unittest_func();"
+        got = t.sql_enable('copiste__unittest_func',
+                           events=('UPDATE',), columns=['id'])
+        self.assertEqual(expected, got)
+
+    def test_writetrigger_disable(self):
+        t = WriteTrigger('unittest_table', 'unittest_trigger')
+        expected = \
+            "DROP TRIGGER IF EXISTS copiste__unittest_trigger "+\
+            "ON unittest_table;"+\
+            "DROP TRIGGER IF EXISTS copiste__unittest_trigger__update "+\
+            "ON unittest_table;"
+        self.assertEqual(expected, t.sql_disable())
+
+    def test_bufferedwritetrigger_enable_filtered(self):
+        t = BufferedWriteTrigger('unittest_table', 'unittest_trigger')
+        got = t.sql_enable('copiste__unittest_func',
+                           events=('INSERT', 'UPDATE'), columns=['mail'])
+        self.assertIn("CREATE TRIGGER copiste__unittest_trigger__update "+
+                      'AFTER UPDATE OF "mail" ON unittest_table', got)
+        self.assertIn("CREATE CONSTRAINT TRIGGER "+
+                      "copiste__unittest_trigger__flush__update "+
+                      'AFTER UPDATE OF "mail" ON unittest_table', got)
+        self.assertNotIn('DELETE', got)
+        self.assertEqual(len(t.db_names()), 4)
+
+    def test_statementwritetrigger_enable_events(self):
+        t = StatementWriteTrigger('unittest_table', 'unittest_trigger')
+        got = t.sql_enable('copiste__unittest_func',
+                           events=('INSERT', 'UPDATE'), columns=['mail'])
+        self.assertIn('copiste__unittest_trigger__update AFTER UPDATE ON', got)
+        self.assertNotIn('DELETE', got)
+
+    def test_trigger_comment(self):
+        t = WriteTrigger('unittest_table', 'unittest_trigger')
+        expected = "COMMENT ON TRIGGER copiste__unittest_trigger "+\
+            "ON unittest_table IS 'abc';"
+        self.assertEqual(expected, t.sql_comment(
+                ['copiste__unittest_trigger'], 'abc'))
+
+    def test_statementwritetrigger_disable(self):
+        t = StatementWriteTrigger('unittest_table', 'unittest_trigger')
+        expected = \
+            "DROP TRIGGER IF EXISTS copiste__unittest_trigger__insert "+\
+            "ON unittest_table;"+\
+            "DROP TRIGGER IF EXISTS copiste__unittest_trigger__update "+\
+            "ON unittest_table;"+\
+            "DROP TRIGGER IF EXISTS copiste__unittest_trigger__delete "+\
+            "ON unittest_table;"
+        self.assertEqual(expected, t.sql_disable())
+
+
+from copiste.ldapsync import LDAPUtils, LDAPConnections, LDAPPipeline, \
+    LDAPBatchError, LDAPEntryCache, LDAPModel, NO_ATTRS, \
+    PERMISSIVE_MODIFY_OID
+
+class FakeCatalogConnection:
+    """ Gives the installed triggers, logging the queries """
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, args=None):
+        self.queries.append(query)
+
+    def fetchall(self):
+        return self.rows
+
+    def commit(self):
+        self.queries.append('COMMIT')
+
+    def rollback(self):
+        self.queries.append('ROLLBACK')
+
+
+class TestApply(TestCase):
+    def binding(self, table, message):
+        import copiste.binding
+        function = LogWarn(message=message)
+        return copiste.binding.Bind(WriteTrigger(table, table), function)
+
+    def installed(self, binding, uuid, message):
+        """ The catalog rows of binding, installed with message as arg """
+        binding.function.set_uuid(uuid)
+        args = LogWarn(message=message)._marshalled_args()
+        return (binding.trigger.db_name(), binding.trigger.table,
+                binding.trigger_digest(), binding.function.func_name(), args)
+
+    def test_apply(self):
+        import copiste.binding
+        unchanged = self.binding('users', 'a')
+        changed = self.binding('groups', 'b')
+        added = self.binding('hosts', 'c')
+        con = FakeCatalogConnection([
+                self.installed(unchanged, '1', 'a'),
+                self.installed(changed, '2', 'old'),
+                ('copiste__old', 'old_table', 'x', 'copiste__noop__3', 'x')])
+        unchanged.function.set_uuid('10')
+        changed.function.set_uuid('20')
+
+        self.assertEqual(
+            copiste.binding.apply(con, [unchanged, changed, added]),
+            [(unchanged, 'unchanged'), (changed, 'reloaded'),
+             (added, 'installed'), ('copiste__noop__3', 'removed')])
+        self.assertEqual(unchanged.function.uuid, '1')
+        self.assertEqual(changed.function.uuid, '2')
+
+        # one query to read, one to write
+        self.assertEqual(len(con.queries), 2)
+        ddl = con.queries[1]
+        self.assertIn("UPDATE copiste_pyargs SET data = '{}' WHERE "
+                      "funcname = 'copiste__logwarn__2'".format(
+                changed.function._marshalled_args()), ddl)
+        self.assertIn('CREATE TRIGGER copiste__hosts BEFORE', ddl)
+        self.assertIn('DROP TRIGGER IF EXISTS copiste__old ON old_table', ddl)
+        self.assertIn('DROP FUNCTION copiste__noop__3()', ddl)
+        self.assertNotIn('copiste__users ', ddl)
+        self.assertIn('CREATE OR REPLACE FUNCTION copiste_warmup()', ddl)
+
+    def test_apply_moved(self):
+        """ A binding moved to another table, keeping its trigger name,
+        drops the trigger on the old table before the function """
+        import copiste.binding
+        binding = self.binding('users', 'a')
+        installed = self.installed(binding, '1', 'a')
+        moved = copiste.binding.Bind(WriteTrigger('groups', 'users'),
+                                     LogWarn(message='a'))
+        self.assertEqual(moved.trigger.db_name(), installed[0])
+        con = FakeCatalogConnection([installed])
+        self.assertEqual(copiste.binding.apply(con, [moved]),
+                         [(moved, 'reinstalled')])
+        ddl = con.queries[1]
+        self.assertTrue(
+            ddl.index('DROP TRIGGER IF EXISTS copiste__users ON users') <
+            ddl.index('DROP FUNCTION copiste__logwarn__1()'))
+        self.assertIn('DROP TRIGGER IF EXISTS copiste__users ON groups', ddl)
+        self.assertIn('CREATE TRIGGER copiste__users BEFORE INSERT OR '
+                      'UPDATE OR DELETE ON groups', ddl)
+
+    def test_apply_trigger_changed(self):
+        import copiste.binding
+        binding = self.binding('users', 'a')
+        installed = list(self.installed(binding, '1', 'a'))
+        installed[2] = 'old digest'
+        con = FakeCatalogConnection([tuple(installed)])
+        self.assertEqual(copiste.binding.apply(con, [binding]),
+                         [(binding, 'reinstalled')])
+        ddl = con.queries[1]
+        self.assertTrue(ddl.index('DROP FUNCTION copiste__logwarn__1()') <
+                        ddl.index('CREATE FUNCTION copiste__logwarn__1()'))
+
+
+import psycopg2
+
+class FakeLockError(psycopg2.OperationalError):
+    pgcode = '55P03'
+
+
+class TestLockRetry(TestCase):
+    def setUp(self):
+        import copiste.binding
+        self.con = FakeCatalogConnection([])
+        self.waits = []
+        self.locks = copiste.binding.LockRetry(
+            self.con, lock_timeout=100, deadline=5, backoff=1, max_backoff=2,
+            sleep=self.sleep)
+
+    def sleep(self, wait):
+        self.waits.append(wait)
+        self.con.queries.append('SLEEP')
+
+    def test_run(self):
+        tries = []
+        def ddl(sql):
+            tries.append(sql)
+            if len(tries) < 3:
+                raise FakeLockError()
+        self.assertTrue(self.locks.run('users', ddl, 'DROP TRIGGER foo'))
+        self.assertEqual(len(tries), 3)
+        self.assertEqual(len(self.waits), 2)
+        self.assertTrue(0 <= self.waits[0] <= 1 and 0 <= self.waits[1] <= 2)
+        self.assertEqual(self.con.queries, ['COMMIT'] + [
+                'SET LOCAL lock_timeout = 100', 'ROLLBACK', 'SLEEP'] * 2 + [
+                'SET LOCAL lock_timeout = 100', 'COMMIT'])
+        self.assertEqual(self.locks.failed, [])
+
+    def test_locks_released(self):
+        """ The DDL of a table is committed before waiting for another one """
+        def users():
+            self.con.execute('DROP TRIGGER users')
+        tries = []
+        def groups():
+            tries.append(None)
+            if len(tries) < 2:
+                raise FakeLockError()
+            self.con.execute('DROP TRIGGER groups')
+
+        self.con.execute('SELECT 1')
+        self.assertTrue(self.locks.run('users', users))
+        self.assertTrue(self.locks.run('groups', groups))
+        queries = self.con.queries
+        # what came before the first run is committed too
+        self.assertEqual(queries[:2], ['SELECT 1', 'COMMIT'])
+        self.assertEqual(queries[queries.index('DROP TRIGGER users') + 1],
+                         'COMMIT')
+        # nothing left uncommitted while waiting
+        sleep = queries.index('SLEEP')
+        self.assertEqual(queries[sleep - 1], 'ROLLBACK')
+        self.assertEqual(queries[-2:], ['DROP TRIGGER groups', 'COMMIT'])
+
+    def test_deadline(self):
+        def ddl():
+            raise FakeLockError()
+        self.locks.deadline = 0
+        self.assertFalse(self.locks.run('users', ddl))
+        self.assertFalse(self.locks.run('groups', ddl))
+        self.assertEqual(self.locks.failed, ['users', 'groups'])
+
+    def test_error(self):
+        def ddl():
+            raise psycopg2.ProgrammingError()
+        self.assertRaises(psycopg2.ProgrammingError,
+                          self.locks.run, 'users', ddl)
+        self.assertEqual(self.waits, [])
+
+    def test_apply(self):
+        import copiste.binding
+        binding = copiste.binding.Bind(WriteTrigger('users', 'users'),
+                                       LogWarn(message='a'))
+        self.locks.run = lambda table, method, *args: False
+        self.assertEqual(copiste.binding.apply(self.con, [binding], self.locks),
+                         [(binding, 'locked')])
+        # only the warm-up function is left, without the binding one
+        self.assertEqual(self.con.queries[-1].strip(),
+                         'DROP FUNCTION IF EXISTS copiste_warmup()')
 
-from copiste.ldapsync import LDAPUtils
 
 class TestLDAPUtils(TestCase):
     def test_build_AND_filter_multi(self):
@@ -147,3 +964,1052 @@ class TestLDAPUtils(TestCase):
         expected_filter = ''
 
         self.assertEqual(LDAPUtils.build_AND_filter(d), expected_filter)
+
+
+class FakeLDAPConnection:
+    """ Records the calls of a LDAP connection """
+    def __init__(self, uri, opened, fail_with=None):
+        self.uri = uri
+        self.calls = []
+        self.fail_with = fail_with
+        opened.append(self)
+
+    def simple_bind_s(self, who, cred):
+        self.calls.append(('bind', who, cred))
+
+    def whoami_s(self):
+        if self.fail_with:
+            raise self.fail_with
+        return 'dn:'
+
+    def add_s(self, dn, modlist):
+        self.calls.append(('add', dn))
+        if self.fail_with:
+            raise self.fail_with
+
+    def unbind_s(self):
+        self.calls.append(('unbind',))
+
+
+class TestLDAPConnections(TestCase):
+    def setUp(self):
+        self.opened = []
+        self.pool = LDAPConnections(
+            lambda uri: FakeLDAPConnection(uri, self.opened))
+        self.creds = {'host': 'ldap://localhost', 'bind_dn': 'cn=admin',
+                      'bind_pw': 'password'}
+
+    def test_reuse(self):
+        c1 = self.pool.get(self.creds)
+        c2 = self.pool.get(self.creds)
+        self.assertIs(c1, c2)
+        self.assertEqual(c1.calls, [('bind', 'cn=admin', 'password')])
+
+        other = self.pool.get(dict(self.creds, bind_dn='cn=other'))
+        self.assertIsNot(other, c1)
+        self.assertEqual(len(self.opened), 2)
+
+    def test_rebind_on_password_change(self):
+        c1 = self.pool.get(self.creds)
+        c2 = self.pool.get(dict(self.creds, bind_pw='new'))
+        self.assertIsNot(c1, c2)
+        self.assertEqual(c1.calls[-1], ('unbind',))
+        self.assertEqual(c2.calls, [('bind', 'cn=admin', 'new')])
+
+    def test_idle_timeout(self):
+        c1 = self.pool.get(self.creds, idle_timeout=60)
+        self.pool.close_idle(time.time() + 61)
+        self.assertEqual(self.pool.connections, {})
+        self.assertEqual(c1.calls[-1], ('unbind',))
+
+    def test_dead_connection(self):
+        import ldap
+        c1 = self.pool.get(self.creds)
+        c1.fail_with = ldap.SERVER_DOWN()
+        entry = self.pool.connections[('ldap://localhost', 'cn=admin')]
+
+        # recently used : not checked
+        self.assertIs(self.pool.get(self.creds), c1)
+
+        entry['last_used'] -= LDAPConnections.CHECK_INTERVAL + 1
+        c2 = self.pool.get(self.creds)
+        self.assertIsNot(c2, c1)
+        self.assertEqual(len(self.opened), 2)
+
+
+class FakeAsyncLDAPConnection:
+    """ Records the sent operations and the results waited for """
+    def __init__(self, failing=()):
+        self.log = []
+        self.msgids = {}
+        self.failing = failing
+
+    def _send(self, op, dn):
+        msgid = len(self.msgids) + 1
+        self.msgids[msgid] = dn
+        self.log.append((op, dn))
+        return msgid
+
+    def add(self, dn, modlist):
+        return self._send('add', dn)
+
+    def modify(self, dn, modlist):
+        return self._send('modify', dn)
+
+    def delete(self, dn):
+        return self._send('delete', dn)
+
+    def search_s(self, base, scope, *args):
+        self.log.append(('search', base))
+        return []
+
+    def result(self, msgid):
+        import ldap
+        dn = self.msgids[msgid]
+        self.log.append(('result', dn))
+        if dn in self.failing:
+            raise ldap.NO_SUCH_OBJECT(dn)
+
+
+class TestLDAPPipeline(TestCase):
+    def test_window(self):
+        con = FakeAsyncLDAPConnection()
+        p = LDAPPipeline(con, window=2)
+        for i in range(3):
+            p.modify_s('uid={},dc=foo'.format(i), [])
+        self.assertEqual(con.log, [('modify', 'uid=0,dc=foo'),
+                                   ('modify', 'uid=1,dc=foo'),
+                                   ('result', 'uid=0,dc=foo'),
+                                   ('modify', 'uid=2,dc=foo')])
+        p.flush()
+        self.assertEqual(len(con.log), 6)
+        self.assertEqual(p.pending, {})
+
+    def test_dn_order(self):
+        import ldap
+        con = FakeAsyncLDAPConnection()
+        p = LDAPPipeline(con)
+        p.add_s('uid=0,dc=foo', [])
+        p.modify_s('uid=1,dc=foo', [])
+        p.search_s('dc=foo', ldap.SCOPE_SUBTREE, '(uid=2)')
+        p.modify_s('UID=0,dc=foo', [])
+        p.search_s('uid=1,dc=foo', ldap.SCOPE_BASE)
+        self.assertEqual(con.log, [('add', 'uid=0,dc=foo'),
+                                   ('modify', 'uid=1,dc=foo'),
+                                   ('search', 'dc=foo'),
+                                   ('result', 'uid=0,dc=foo'),
+                                   ('modify', 'UID=0,dc=foo'),
+                                   ('result', 'uid=1,dc=foo'),
+                                   ('search', 'uid=1,dc=foo')])
+
+    def test_errors(self):
+        con = FakeAsyncLDAPConnection(failing=['uid=0,dc=foo', 'uid=2,dc=foo'])
+        p = LDAPPipeline(con)
+        for i in range(3):
+            p.delete_s('uid={},dc=foo'.format(i))
+        with self.assertRaises(LDAPBatchError) as cm:
+            p.flush()
+        self.assertEqual([dn for dn, e in cm.exception.errors],
+                         ['uid=0,dc=foo', 'uid=2,dc=foo'])
+        self.assertEqual(len(con.log), 6)
+
+
+class FakeEntriesLDAPConnection:
+    """ Serves entries from a dict dn -> attrs, records the searches """
+    def __init__(self, entries, controls=[]):
+        self.entries = entries
+        self.controls = controls
+        self.searches = []
+        self.modified = []
+        self.sent_controls = []
+        # msgid -> error of an asynchronous write
+        self.results = {}
+
+    def search_s(self, base, scope, query, attrlist=None):
+        import ldap
+        if base == '':
+            return [('', {'supportedControl': self.controls})]
+        self.searches.append((base, scope))
+        if scope == ldap.SCOPE_BASE:
+            if not base in self.entries:
+                raise ldap.NO_SUCH_OBJECT(base)
+            found = [base]
+        else:
+            found = [dn for dn in self.entries if dn.endswith(base)]
+        # the tests only use (attr=value) queries
+        attr, value = query.strip('()').split('=')
+        return [(dn, dict([(k, v) for k, v in self.entries[dn].items()
+                           if attrlist is None or k in attrlist]))
+                for dn in found if value in self.entries[dn].get(attr, [])]
+
+    def modify_s(self, dn, modlist):
+        self.modified.append(dn)
+
+    def modify_ext_s(self, dn, modlist, serverctrls=None):
+        import ldap
+        if not dn in self.entries:
+            raise ldap.NO_SUCH_OBJECT(dn)
+        self.modified.append(dn)
+        self.sent_controls.append(
+            [c.controlType for c in serverctrls or []])
+        permissive = bool(serverctrls)
+        attrs = self.entries[dn]
+        for op, attr, values in modlist:
+            current = attrs.setdefault(attr, [])
+            for v in values:
+                if op == ldap.MOD_ADD and v in current:
+                    if not permissive:
+                        raise ldap.TYPE_OR_VALUE_EXISTS(v)
+                elif op == ldap.MOD_ADD:
+                    current.append(v)
+                elif v in current:
+                    current.remove(v)
+                elif not permissive:
+                    raise ldap.NO_SUCH_ATTRIBUTE(v)
+
+    def modify_ext(self, dn, modlist, serverctrls=None):
+        import ldap
+        msgid = len(self.results) + 1
+        try:
+            self.modify_ext_s(dn, modlist, serverctrls)
+            self.results[msgid] = None
+        except ldap.LDAPError, e:
+            self.results[msgid] = e
+        return msgid
+
+    def result(self, msgid):
+        if self.results[msgid]:
+            raise self.results[msgid]
+
+
+class TestLDAPModel(TestCase):
+    def setUp(self):
+        self.model = LDAPModel('(uid={uid})', 'ou=users,dc=foo',
+                               'uid={uid},ou=users,dc=foo')
+        self.con = FakeEntriesLDAPConnection({
+                'uid=1,ou=users,dc=foo': {'uid': ['1'], 'mail': ['a@foo']},
+                'uid=2,ou=old,ou=users,dc=foo': {'uid': ['2'], 'mail': []}})
+
+    def test_get_by_dn(self):
+        import ldap
+        self.assertTrue(self.model.dn_is_computable())
+        self.assertEqual(self.model.get(self.con, {'uid': '1'})[0],
+                         'uid=1,ou=users,dc=foo')
+        self.assertEqual(self.con.searches,
+                         [('uid=1,ou=users,dc=foo', ldap.SCOPE_BASE)])
+
+        # not where the DN template puts it : searched
+        self.assertEqual(self.model.get(self.con, {'uid': '2'})[0],
+                         'uid=2,ou=old,ou=users,dc=foo')
+        self.assertEqual(self.con.searches[1:],
+                         [('uid=2,ou=users,dc=foo', ldap.SCOPE_BASE),
+                          ('ou=users,dc=foo', ldap.SCOPE_SUBTREE)])
+
+    def test_get_not_computable(self):
+        import ldap
+        model = LDAPModel('(mail={mail})', 'ou=users,dc=foo',
+                          'uid={uid},ou=users,dc=foo')
+        self.assertFalse(model.dn_is_computable())
+        model.get(self.con, {'mail': 'a@foo'})
+        self.assertEqual(self.con.searches,
+                         [('ou=users,dc=foo', ldap.SCOPE_SUBTREE)])
+
+    def test_cache(self):
+        # disabled until begin()
+        self.model.get(self.con, {'uid': '1'})
+        self.model.get(self.con, {'uid': '1'})
+        self.assertEqual(len(self.con.searches), 2)
+
+        self.model.cache.begin(1)
+        dn, attrs = self.model.get(self.con, {'uid': '1'})
+        attrs['mail'] = []
+        self.assertEqual(self.model.get(self.con, {'uid': '1'}),
+                         (dn, {'uid': ['1'], 'mail': ['a@foo']}))
+        self.assertEqual(len(self.con.searches), 3)
+
+        # writes update the cache
+        self.model.set_values(self.con, dn, 'mail', ['a@foo'], ['b@foo'])
+        self.assertEqual(self.model.get(self.con, {'uid': '1'})[1]['mail'],
+                         ['b@foo'])
+        self.assertEqual(len(self.con.searches), 3)
+
+        # unless they change what the query tests
+        self.model.set_values(self.con, dn, 'uid', ['1'], ['1', 'one'])
+        self.model.get(self.con, {'uid': '1'})
+        self.assertEqual(len(self.con.searches), 4)
+
+        # another transaction
+        self.model.cache.begin(2)
+        self.model.get(self.con, {'uid': '1'})
+        self.assertEqual(len(self.con.searches), 5)
+
+    def test_scope(self):
+        import ldap
+        model = LDAPModel('(mail={mail})', 'ou=users,dc=foo',
+                          'uid={uid},ou=users,dc=foo', scope='one')
+        model.get(self.con, {'mail': 'a@foo'})
+        self.assertEqual(self.con.searches,
+                         [('ou=users,dc=foo', ldap.SCOPE_ONELEVEL)])
+        self.assertEqual(model.to_dict()['scope'], 'one')
+
+        # computed DNs out of scope are not read
+        model = LDAPModel('(uid={uid})', 'ou=users,dc=foo',
+                          'uid={uid},ou=old,ou=users,dc=foo', scope='one')
+        self.assertFalse(model.dn_is_computable())
+        self.assertRaises(ValueError, LDAPModel, '(uid={uid})',
+                          'ou=users,dc=foo', 'uid={uid},ou=users,dc=foo',
+                          scope='sub')
+
+    def test_cache_attrlist(self):
+        self.model.cache.begin(1)
+        self.assertEqual(self.model.get(self.con, {'uid': '1'}, ['mail']),
+                         ('uid=1,ou=users,dc=foo', {'mail': ['a@foo']}))
+        self.model.get(self.con, {'uid': '1'}, ['MAIL'])
+        self.assertEqual(len(self.con.searches), 1)
+
+        # more attributes are needed
+        self.assertEqual(self.model.get(self.con, {'uid': '1'})[1],
+                         {'uid': ['1'], 'mail': ['a@foo']})
+        self.model.get(self.con, {'uid': '1'}, ['uid'])
+        self.model.get(self.con, {'uid': '1'}, NO_ATTRS)
+        self.assertEqual(len(self.con.searches), 2)
+
+    def test_modify_values(self):
+        import ldap
+        dn = self.model.modify_values(self.con, {'uid': '1'}, 'mail',
+                                      added=['a@foo', 'b@foo'],
+                                      removed=['c@foo'])
+        self.assertEqual(dn, 'uid=1,ou=users,dc=foo')
+        self.assertEqual(self.con.entries[dn]['mail'], ['a@foo', 'b@foo'])
+        # the entry is read by DN, not its values ; no control : sent again
+        # one by one, as "a@foo" is there and "c@foo" is not
+        self.assertEqual(self.con.searches, [(dn, ldap.SCOPE_BASE)])
+        self.assertEqual(self.con.sent_controls, [[]] * 4)
+
+        # not at the computed DN : searched for, never written there
+        self.model.remove_from_attr(self.con, {'uid': '2'}, 'mail', 'x@foo')
+        self.assertEqual(self.con.searches[1:],
+                         [('uid=2,ou=users,dc=foo', ldap.SCOPE_BASE),
+                          ('ou=users,dc=foo', ldap.SCOPE_SUBTREE)])
+        self.assertEqual(self.con.modified, [dn] * 4 +
+                         ['uid=2,ou=old,ou=users,dc=foo'] * 2)
+
+    def test_modify_values_pipeline(self):
+        pipeline = LDAPPipeline(self.con)
+        dn = self.model.modify_values(pipeline, {'uid': '1'}, 'mail',
+                                      added=['a@foo', 'b@foo'],
+                                      removed=['c@foo'])
+        # value by value, the errors of those already done are ignored
+        self.assertEqual(self.con.sent_controls, [[]] * 3)
+        pipeline.flush()
+        self.assertEqual(self.con.entries[dn]['mail'], ['a@foo', 'b@foo'])
+
+        # other errors are reported
+        self.con.controls = [PERMISSIVE_MODIFY_OID]
+        self.model._permissive_modify = True
+        self.model.send_values(pipeline, 'uid=3,ou=users,dc=foo', 'mail',
+                               ['a@foo'], [])
+        self.assertRaises(LDAPBatchError, pipeline.flush)
+
+    def test_set_values(self):
+        dn = 'uid=1,ou=users,dc=foo'
+        self.con.entries[dn]['mail'] = ['a@foo', 'b@foo', 'c@foo']
+        changed = self.model.set_values(
+            self.con, dn, 'mail', ['a@foo', 'b@foo', 'c@foo'],
+            iter(['d@foo', 'b@foo', 'c@foo']))
+        self.assertEqual(changed, 2)
+        self.assertEqual(sorted(self.con.entries[dn]['mail']),
+                         ['b@foo', 'c@foo', 'd@foo'])
+        # one operation, holding only the changes
+        self.assertEqual(len(self.con.modified), 1)
+
+    def test_modify_values_permissive(self):
+        self.con.controls = [PERMISSIVE_MODIFY_OID]
+        self.model.modify(self.con, {'uid': '1'}, {'mail': 'a@foo'},
+                          accumulate=True)
+        self.assertEqual(self.con.sent_controls, [[PERMISSIVE_MODIFY_OID]])
+        self.assertEqual(self.con.entries['uid=1,ou=users,dc=foo']['mail'],
+                         ['a@foo'])
+
+    def test_modify_values_cache(self):
+        self.model.cache.begin(1)
+        self.model.get(self.con, {'uid': '1'})
+        self.model.modify_values(self.con, {'uid': '1'}, 'mail',
+                                 added=['b@foo'])
+        self.assertEqual(self.model.get(self.con, {'uid': '1'})[1]['mail'],
+                         ['a@foo', 'b@foo'])
+        self.assertEqual(len(self.con.searches), 1)
+
+    def test_shared_cache(self):
+        """ A model sees the writes of another one through the same cache """
+        cache = LDAPConnections().cache(
+            {'host': 'ldap://localhost', 'bind_dn': 'cn=admin'})
+        cache.size = 10
+        cache.begin(1)
+        other = LDAPModel('(uid={uid})', 'ou=users,dc=foo',
+                          'uid={uid},ou=users,dc=foo')
+        self.model.cache = other.cache = cache
+        dn, _ = self.model.get(self.con, {'uid': '1'})
+        other.modify_values(self.con, {'uid': '1'}, 'mail', added=['b@foo'])
+        self.assertEqual(self.model.get(self.con, {'uid': '1'})[1]['mail'],
+                         ['a@foo', 'b@foo'])
+        self.assertEqual(len(self.con.searches), 1)
+
+    def test_cache_lazy_txid(self):
+        txids = []
+        def get_txid():
+            txids.append(1)
+            return 1
+        cache = LDAPEntryCache(size=2)
+        cache.begin(get_txid)
+        cache.forget('uid=0')
+        self.assertEqual(txids, [])
+        cache.put('(uid=0)', 'uid=0', {})
+        self.assertEqual(cache.get('(uid=0)'), ('uid=0', {}))
+        self.assertEqual(txids, [1])
+        # a new call, in the same transaction
+        cache.begin(get_txid)
+        self.assertEqual(cache.get('(uid=0)'), ('uid=0', {}))
+        self.assertEqual(txids, [1, 1])
+
+    def test_cache_size(self):
+        cache = LDAPEntryCache(size=2)
+        cache.begin(1)
+        for i in range(3):
+            cache.put('(uid={})'.format(i), 'uid={}'.format(i), {})
+        self.assertEqual(cache.get('(uid=0)'), None)
+        self.assertEqual(cache.get('(uid=2)'), ('uid=2', {}))
+        self.assertEqual(len(cache.entries), 2)
+
+
+import copiste.functions.ldapfuncs
+import copiste.ldapsync
+
+class TestLDAPFunctions(TestCase):
+    def setUp(self):
+        self.model = {'query': '(uid={uid})', 'base': 'ou=users,dc=foo,dc=bar',
+                      'dn': 'uid={uid},ou=users,dc=foo,dc=bar',
+                      'static_attrs': {}}
+        self.creds = {'host': 'ldap://localhost', 'bind_dn': 'cn=admin',
+                      'bind_pw': 'password'}
+
+    def test_copy2ldap_sql_columns(self):
+        f = copiste.functions.ldapfuncs.Copy2LDAP(
+            attrs_map = {'uid': 'id', 'mail': 'mail', 'cn': 'mail'},
+            dyn_attrs_map = {
+                'mail': "SELECT mail FROM unittest_alias WHERE user_id='{id}'",
+                'sn': "SELECT sn FROM unittest_names WHERE name='{name}'"},
+            ldap_model = self.model,
+            ldap_creds = self.creds)
+        self.assertEqual(f.sql_columns(), None)
+        f.args['dyn_attrs_map'] = {}
+        self.assertEqual(f.sql_columns(), ['id', 'mail'])
+
+    def test_accumulaterequest_sql_columns(self):
+        f = copiste.functions.ldapfuncs.AccumulateRequest2LDAPField(
+            ldap_field = 'mail',
+            keys_map   = {'uid': {'foreign_table': 'unittest_alias',
+                                  'foreign_field': 'user_id',
+                                  'join'         : ('alias_id', 'mail')}},
+            ldap_model = self.model,
+            ldap_creds = self.creds,
+            sql_request= "SELECT mail FROM unittest_subalias "+
+                         "WHERE alias_id='{alias_id}' OR id = {_foreign_id}")
+        self.assertEqual(f.sql_columns(), None)
+        self.assertEqual(f.handled_events(), ('INSERT', 'UPDATE'))
+
+    def test_reconnect(self):
+        import ldap
+        opened = []
+        connections = copiste.ldapsync.CONNECTIONS
+        copiste.ldapsync.CONNECTIONS = LDAPConnections(
+            lambda uri: FakeLDAPConnection(uri, opened))
+
+        handled = []
+        class Writer(copiste.functions.ldapfuncs.LDAPWriterFunction):
+            def handle(self, TD, plpy, ldap_c):
+                handled.append(ldap_c._con)
+                if len(handled) == 1:
+                    raise ldap.SERVER_DOWN()
+
+        class FakePlpy:
+            def log(self, msg):
+                pass
+            def prepare(self, query, types):
+                return query
+            def execute(self, plan, args):
+                return [{'txid': 1}]
+
+        try:
+            f = Writer(ldap_creds=self.creds, ldap_model=self.model)
+            f.call({'event': 'INSERT', 'new': {}}, FakePlpy())
+            f.call({'event': 'INSERT', 'new': {}}, FakePlpy())
+        finally:
+            copiste.ldapsync.CONNECTIONS = connections
+        self.assertEqual(len(opened), 2)
+        self.assertEqual(handled, [opened[0], opened[1], opened[1]])
+
+    def test_no_replay(self):
+        """ Writes already sent are not replayed on another connection """
+        import ldap
+        opened = []
+        connections = copiste.ldapsync.CONNECTIONS
+        copiste.ldapsync.CONNECTIONS = LDAPConnections(
+            lambda uri: FakeLDAPConnection(uri, opened))
+
+        class Writer(copiste.functions.ldapfuncs.LDAPWriterFunction):
+            def handle(self, TD, plpy, ldap_c):
+                ldap_c.add_s('uid=1,ou=users,dc=foo,dc=bar', [])
+                raise ldap.SERVER_DOWN()
+
+        class FakePlpy:
+            def execute(self, plan, args):
+                return [{'txid': 1}]
+
+        try:
+            f = Writer(ldap_creds=self.creds, ldap_model=self.model)
+            f.options['ldap_cache_size'] = 0
+            self.assertRaises(ldap.SERVER_DOWN, f.call,
+                              {'event': 'INSERT', 'new': {}}, FakePlpy())
+            # the dead connection is not handed out again
+            self.assertEqual(copiste.ldapsync.CONNECTIONS.connections, {})
+        finally:
+            copiste.ldapsync.CONNECTIONS = connections
+        self.assertEqual(len(opened), 1)
+        self.assertEqual(opened[0].calls[1:], [
+                ('add', 'uid=1,ou=users,dc=foo,dc=bar'), ('unbind',)])
+
+    def test_create_server_down(self):
+        import ldap
+        model = LDAPModel(**self.model)
+        con = FakeLDAPConnection('ldap://localhost', [],
+                                 fail_with=ldap.SERVER_DOWN())
+        self.assertRaises(ldap.SERVER_DOWN, model.create, con, {'uid': ['1']})
+
+    def test_copy2ldap_change_key(self):
+        f = copiste.functions.ldapfuncs.Copy2LDAP(
+            attrs_map = {'uid': 'id', 'mail': 'mail'},
+            ldap_model = self.model,
+            ldap_creds = self.creds)
+        self.assertEqual(f.change_key({'id': 1, 'mail': 'foo@bar.com'}),
+                         'uid=1,ou=users,dc=foo,dc=bar')
+
+
+from copiste.worker import PlpyAdapter, to_pyformat
+
+class TestWorker(TestCase):
+    def test_to_pyformat(self):
+        self.assertEqual(
+            to_pyformat("SELECT 1 WHERE a = $1 AND b LIKE '%x' OR c = $1"),
+            "SELECT 1 WHERE a = %(p1)s AND b LIKE '%%x' OR c = %(p1)s")
+
+    def test_adapter_plain_query(self):
+        """ Without parameters, psycopg2 does not unescape "%%" """
+        executed = []
+        class FakeConnection:
+            description = None
+            def cursor(self, cursor_factory=None):
+                return self
+            def execute(self, query, params=None):
+                executed.append((query, params))
+
+        plpy = PlpyAdapter(FakeConnection())
+        plpy.execute("SELECT 1 WHERE b LIKE 'x%' AND 7 % 2 = 1")
+        plpy.execute(plpy.prepare("SELECT 1 WHERE b LIKE 'x%' AND a = $1",
+                                  ['text']), ['foo'])
+        self.assertEqual(executed, [
+                ("SELECT 1 WHERE b LIKE 'x%' AND 7 % 2 = 1", None),
+                ("SELECT 1 WHERE b LIKE 'x%%' AND a = %(p1)s",
+                 {'p1': 'foo'})])
+
+
+from copiste.init import ClientSync, CopyRowReader, OnlineInit, \
+    ParallelInit, ProgressReport, Resync, decode_copy_field, sorted_externally
+
+class FakeCopyConnection:
+    """ Gives the table columns, and the COPY data by chunks """
+    def __init__(self, columns, data, chunk_size=7):
+        self.columns = columns
+        self.data = data
+        self.chunk_size = chunk_size
+        self.copied = []
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, args=None):
+        pass
+
+    def fetchall(self):
+        return self.columns
+
+    def copy_expert(self, sql, f):
+        self.copied.append(sql)
+        for i in range(0, len(self.data), self.chunk_size):
+            f.write(self.data[i:i+self.chunk_size])
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class TestClientSync(TestCase):
+    def test_decode_copy_field(self):
+        self.assertEqual(decode_copy_field('\\N'), None)
+        self.assertEqual(decode_copy_field('foo'), 'foo')
+        self.assertEqual(decode_copy_field('a\\tb\\\\c\\nd\\101\\x42'),
+                         'a\tb\\c\nd\x41\x42')
+
+    def test_reader(self):
+        rows = []
+        reader = CopyRowReader(
+            [('id', 'int4'), ('mail', 'varchar'), ('active', 'bool')],
+            rows.append)
+        for chunk in ('1\tfoo@ba', 'r\tt\n2\t\\N\t', 'f\n'):
+            reader.write(chunk)
+        self.assertEqual(rows, [{'id': 1, 'mail': 'foo@bar', 'active': True},
+                                {'id': 2, 'mail': None, 'active': False}])
+
+    def test_run(self):
+        batches = []
+        class Recorder(PlPythonFunction):
+            def sql_columns(self):
+                return ['id', 'mail']
+            def call_batch(self, changes, plpy):
+                batches.append([TD['new']['id'] for TD in changes])
+
+        copy_con = FakeCopyConnection(
+            [('id', 'int4'), ('name', 'text'), ('mail', 'text')],
+            ''.join(['{}\tuser{}@foo\n'.format(i, i) for i in range(5)]))
+        con = FakeCopyConnection([], '')
+        sync = ClientSync(con, copy_con, Recorder(), 'users', batch_size=2)
+        self.assertEqual(sync.run(), (5, 0))
+        self.assertEqual(copy_con.copied,
+                         ['COPY (SELECT "id", "mail" FROM users) TO STDOUT'])
+        self.assertEqual(batches, [[0, 1], [2, 3], [4]])
+        self.assertEqual(con.commits, 3)
+
+    def test_run_errors(self):
+        class Failing(PlPythonFunction):
+            def call_batch(self, changes, plpy):
+                raise LDAPBatchError([('uid=1,dc=foo', Exception('exists'))])
+
+        copy_con = FakeCopyConnection([('id', 'int4')], '1\n2\n')
+        con = FakeCopyConnection([], '')
+        sync = ClientSync(con, copy_con, Failing(), 'users')
+        self.assertEqual(sync.run(), (2, 1))
+        self.assertEqual(con.rollbacks, 1)
+
+    def test_sorted_externally(self):
+        records = [(i * 7 % 10, 'dn{}'.format(i)) for i in range(10)]
+        self.assertEqual(list(sorted_externally(records, chunk_size=3)),
+                         sorted(records))
+        self.assertEqual(list(sorted_externally([], chunk_size=3)), [])
+
+
+class FakePagedLDAPConnection(FakeAsyncLDAPConnection):
+    """ Serves entries by pages of 2, with the Simple Paged Results control """
+    def __init__(self, entries):
+        FakeAsyncLDAPConnection.__init__(self)
+        self.entries = entries
+        self.searches = {}
+
+    def search_ext(self, base, scope, filterstr, attrlist, serverctrls):
+        self.log.append(('search', filterstr))
+        start = int(serverctrls[0].cookie or 0)
+        self.searches[-len(self.searches) - 1] = start
+        return -len(self.searches)
+
+    def result3(self, msgid):
+        import ldap.controls
+        start = self.searches[msgid]
+        cookie = str(start + 2) if start + 2 < len(self.entries) else ''
+        return (None, self.entries[start:start+2], msgid,
+                [ldap.controls.SimplePagedResultsControl(cookie=cookie)])
+
+
+class TestResync(TestCase):
+    def setUp(self):
+        self.model = {'query': '(&(objectClass=person)(uid={uid}))',
+                      'base': 'ou=users,dc=foo',
+                      'dn': 'uid={uid},ou=users,dc=foo',
+                      'static_attrs': {'objectClass': ['person']}}
+        self.function = copiste.functions.ldapfuncs.Copy2LDAP(
+            attrs_map = {'uid': 'id', 'mail': 'mail'},
+            ldap_model = self.model,
+            ldap_creds = {})
+
+    def test_list_query(self):
+        model = LDAPModel(**self.model)
+        self.assertEqual(model.list_query(), '(&(objectClass=person)(uid=*))')
+        self.assertEqual(model.dn_fields(), ['uid'])
+
+    def resync(self, dry_run, delete=True):
+        ldap_c = FakePagedLDAPConnection([
+                ('uid=3,ou=users,dc=foo', {'uid': ['3'], 'mail': ['c@foo']}),
+                ('uid=1,ou=users,dc=foo', {'uid': ['1'], 'mail': ['old@foo']}),
+                ('uid=4,ou=users,dc=foo', {'uid': ['4'], 'mail': ['d@foo']}),
+                ('uid=0,ou=users,dc=foo', {'uid': ['0']})])
+        self.function.ldap_connect = lambda: ldap_c
+        # keys first, ordered
+        copy_con = FakeCopyConnection(
+            [('id', 'int4'), ('name', 'text'), ('mail', 'text')],
+            '1\t1\ta@foo\n2\t2\tb@foo\n3\t3\tc@foo\n')
+        resync = Resync(FakeCopyConnection([], ''), copy_con, self.function,
+                        'users', dry_run=dry_run, delete=delete,
+                        sort_chunk_size=2)
+        counts = resync.run()
+        self.assertEqual(copy_con.copied, [
+                'COPY (SELECT lower("id"::text COLLATE "C"), "id", "mail" '+
+                'FROM users WHERE "id" IS NOT NULL ORDER BY 1) TO STDOUT'])
+        self.assertEqual(counts, {'added': 1, 'modified': 1,
+                                  'deleted': delete and 2 or 0,
+                                  'orphans': not delete and 2 or 0,
+                                  'unchanged': 1, 'errors': 0})
+        return [op for op in ldap_c.log if op[0] != 'result']
+
+    def test_resync(self):
+        self.assertEqual(self.resync(dry_run=False), [
+                ('search', '(&(objectClass=person)(uid=*))'),
+                ('search', '(&(objectClass=person)(uid=*))'),
+                ('delete', 'uid=0,ou=users,dc=foo'),
+                ('modify', 'uid=1,ou=users,dc=foo'),
+                ('add', 'uid=2,ou=users,dc=foo'),
+                ('delete', 'uid=4,ou=users,dc=foo')])
+
+    def test_resync_no_delete(self):
+        self.assertEqual([op[0] for op in self.resync(False, delete=False)],
+                         ['search', 'search', 'modify', 'add'])
+
+    def test_resync_dry_run(self):
+        self.assertEqual(len(self.resync(dry_run=True)), 2)
+
+    def test_entry_key(self):
+        """ Only ASCII letters are lowercased, as by PostgreSQL in "C" """
+        resync = Resync(None, None, self.function, 'users')
+        self.assertEqual(
+            resync.entry_key('uid=\xc3\x89Ric,ou=users,dc=foo',
+                             {'UID': ['\xc3\x89Ric']}),
+            ('\xc3\x89ric',))
+        self.assertEqual(resync.entry_key('cn=foo,dc=foo', {}), None)
+
+
+class FakeRangeBinding:
+    """ A binding of some phase, which table has the given primary key """
+    def __init__(self, phase, keys):
+        self.phase = phase
+        self.keys = keys
+
+    def init_phase(self):
+        return self.phase
+
+    def primary_key(self, con):
+        return self.keys
+
+
+class TestParallelInit(TestCase):
+    def test_split_blocks(self):
+        import copiste.binding
+        class FakeConnection:
+            server_version = 140000
+            def cursor(self):
+                return self
+            def execute(self, query, args=None):
+                pass
+            def fetchone(self):
+                return (10,)
+
+        binding = copiste.binding.Bind(WriteTrigger('users', 'users'), Noop())
+        con = FakeConnection()
+        self.assertEqual(binding.split_blocks(con, 3),
+                         [(None, 4), (4, 8), (8, None)])
+        # no TID range scans : one part
+        con.server_version = 130000
+        self.assertEqual(binding.split_blocks(con, 3), [(None, None)])
+
+    def test_split_range_single(self):
+        import copiste.binding
+        binding = copiste.binding.Bind(WriteTrigger('users', 'users'), Noop())
+        # the table is not even read
+        self.assertEqual(binding.split_range(None, 1), [(None, None)])
+
+    def test_sync_range_snapshot(self):
+        """ Checkpoints and stats are written outside of the snapshot of
+        the chunks, which does not see those of the previous chunks """
+        import copiste.binding
+        class FakeConnection:
+            def __init__(self):
+                self.in_snapshot = False
+                self.log = []
+                self.ends = [('2',), ('4',), None]
+                self.rows = [2, 2, 1]
+            def cursor(self):
+                return self
+            def execute(self, query, args=None):
+                if query.startswith('SET TRANSACTION SNAPSHOT'):
+                    self.in_snapshot = True
+                self.query = query
+                self.log.append((query.split()[0], self.in_snapshot))
+            def fetchall(self):
+                return [('id',)]
+            def fetchone(self):
+                if 'OFFSET' in self.query:
+                    return self.ends.pop(0)
+                return (self.rows.pop(0),)
+            def commit(self):
+                self.in_snapshot = False
+
+        binding = copiste.binding.Bind(WriteTrigger('users', 'users'), Noop())
+        con = FakeConnection()
+        self.assertEqual(binding.sync_range(con, 2, snapshot='snap', part=0),
+                         5)
+        updates = [q for q in con.log if q[0] == 'UPDATE']
+        self.assertEqual(updates, [('UPDATE', False)] * 3)
+        flushes = [q for q in con.log if q[0] == 'SELECT' and not q[1]]
+        # the primary key, then a flush per chunk
+        self.assertEqual(len(flushes), 4)
+
+    def test_init_phase(self):
+        import copiste.binding
+        import copiste.functions.ldapfuncs
+        trigger = WriteTrigger('users', 'users')
+        self.assertEqual(copiste.binding.Bind(trigger, Noop()).init_phase(), 0)
+        accumulate = copiste.functions.ldapfuncs.Accumulate2LDAPField(
+            'memberUid', {'cn': 'name'}, {'query': '', 'base': '', 'dn': ''},
+            {})
+        self.assertEqual(
+            copiste.binding.Bind(trigger, accumulate).init_phase(), 1)
+        self.assertEqual(
+            copiste.binding.Bind(trigger, accumulate, phase=0).init_phase(), 0)
+
+    def test_tasks(self):
+        bindings = [
+            FakeRangeBinding(1, ['id']),
+            FakeRangeBinding(0, []),
+            FakeRangeBinding(0, ['id'])]
+        parts = [
+            [(0, None, ('5',), 5, True), (1, ('7',), None, 2, False)],
+            [(0, None, 10, 0, False), (1, 10, None, 0, False)],
+            [(0, None, None, 0, False)]]
+        init = ParallelInit({}, bindings, 2)
+        self.assertEqual(init.phases(), [[1, 2], [0]])
+        self.assertEqual(init.tasks(None, [1, 2], parts, 'snap'), [
+                (1, 'blocks', 0, None, 10, 'snap'),
+                (1, 'blocks', 1, 10, None, 'snap'),
+                (2, 'range', 0, None, None, 'snap')])
+        self.assertEqual(init.tasks(None, [0], parts, 'snap'), [
+                (0, 'range', 1, ('7',), None, 'snap')])
+
+
+class FakeQueueWorker:
+    """ Gives queued changes by batches, logging what happens on its
+    connection """
+    def __init__(self, function, batches):
+        self.functions = {function.func_name(): function}
+        self.batches = batches
+        self.plpy = None
+        self.con = self
+        self.log = []
+
+    def dequeue(self, func_name):
+        self.log.append('dequeue')
+        if self.batches:
+            return self.batches.pop(0)
+        return []
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, args=None):
+        self.log.append(query)
+
+    def commit(self):
+        self.log.append('commit')
+
+    def rollback(self):
+        self.log.append('rollback')
+
+
+class FakeQueueConnection:
+    """ Gives the same queued rows to each dequeue, logging the queries """
+    def __init__(self, rows):
+        self.rows = rows
+        self.log = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, args=None):
+        self.log.append(query.split(' (')[0])
+        if query.startswith('INSERT'):
+            self.log.append(args)
+
+    def fetchone(self):
+        return (True,)
+
+    def fetchall(self):
+        return self.rows
+
+    def commit(self):
+        self.log.append('commit')
+
+    def rollback(self):
+        self.log.append('rollback')
+
+
+class TestQueueWorker(TestCase):
+    def setUp(self):
+        import copiste.worker
+        class Failing(PlPythonFunction):
+            error = ValueError('already exists')
+            def call_batch(self, changes, plpy):
+                if [c for c in changes if c['new']['id'] == 1]:
+                    raise self.error
+            def is_transient(self, error):
+                return isinstance(error, IOError)
+        self.function = Failing()
+        self.con = FakeQueueConnection([
+                (1, 'INSERT', 'users', None, '{"id": 1}'),
+                (2, 'INSERT', 'users', None, '{"id": 2}')])
+        self.worker = copiste.worker.QueueWorker(
+            self.con, {'copiste__failing': self.function}, max_failures=2)
+        self.worker.flush_stats = lambda func_name: None
+
+    def test_dead_letter(self):
+        self.assertEqual(self.worker.process_batch(), 0)
+        self.assertEqual(self.worker.process_batch(), 0)
+        self.assertEqual(self.worker.failed, {'copiste__failing': 2})
+        self.assertEqual(self.con.log.count('rollback'), 2)
+
+        # handled apart, the failing change is moved aside
+        del self.con.log[:]
+        self.assertEqual(self.worker.process_batch(), 2)
+        self.assertEqual(self.con.log[2:], [
+                'SAVEPOINT copiste_change',
+                'ROLLBACK TO SAVEPOINT copiste_change',
+                'INSERT INTO copiste_queue_failed(id, funcname, event, '+
+                'table_name, old_row, new_row, error) VALUES',
+                [1, 'copiste__failing', 'INSERT', 'users', None, '{"id": 1}',
+                 'already exists'],
+                'RELEASE SAVEPOINT copiste_change',
+                'SAVEPOINT copiste_change',
+                'RELEASE SAVEPOINT copiste_change',
+                'commit'])
+        self.assertEqual(self.worker.failed, {})
+
+    def test_transient(self):
+        self.function.error = IOError('server down')
+        for i in range(3):
+            self.assertEqual(self.worker.process_batch(), 0)
+        self.assertEqual(self.worker.failures, 1)
+        self.assertNotIn('INSERT INTO copiste_queue_failed', self.con.log)
+        self.assertEqual(self.con.log[-1], 'rollback')
+
+
+class TestOnlineInit(TestCase):
+    def test_capture_trigger(self):
+        import copiste.binding
+        binding = copiste.binding.Bind(
+            BufferedWriteTrigger('users', 'users'), Noop())
+        trigger = binding.capture_trigger()
+        self.assertTrue(isinstance(trigger, QueueWriteTrigger))
+        self.assertEqual(trigger.db_names(), [
+                'copiste__users__capture', 'copiste__users__capture__update'])
+
+    def test_catch_up(self):
+        import copiste.binding
+        handled = []
+        class Recorder(PlPythonFunction):
+            def call_batch(self, changes, plpy):
+                handled.append(changes)
+
+        binding = copiste.binding.Bind(
+            WriteTrigger('users', 'users'), Recorder())
+        binding.switch_capture = lambda con: con.log.append('switch')
+        worker = FakeQueueWorker(binding.function,
+                                 [['a', 'b'], ['c'], ['d'], []])
+        OnlineInit({}, [binding], batch_size=2, lock_timeout=100).catch_up(
+            worker, binding)
+        self.assertEqual(handled, [['a', 'b'], ['c'], ['d']])
+        # drained until a batch is not full, the rest replayed under lock
+        self.assertEqual(worker.log, [
+                'dequeue', 'commit', 'dequeue', 'commit', 'commit',
+                'SET LOCAL lock_timeout = 100',
+                'LOCK TABLE users IN SHARE ROW EXCLUSIVE MODE',
+                'switch', 'dequeue', 'dequeue', 'commit'])
+
+    def test_catch_up_locked(self):
+        import copiste.binding
+        import copiste.worker
+        binding = copiste.binding.Bind(WriteTrigger('users', 'users'), Noop())
+        worker = FakeQueueWorker(binding.function, [])
+        def execute(query, args=None):
+            if query.startswith('LOCK'):
+                raise FakeLockError()
+        worker.execute = execute
+        init = OnlineInit({}, [binding], lock_deadline=0)
+        self.assertRaises(copiste.worker.Error,
+                          init.catch_up, worker, binding)
+        self.assertEqual(worker.log, ['dequeue', 'commit', 'commit',
+                                      'rollback'])
+
+    def test_catch_up_busy(self):
+        import copiste.binding
+        import copiste.worker
+        binding = copiste.binding.Bind(WriteTrigger('users', 'users'), Noop())
+        worker = FakeQueueWorker(binding.function, [None])
+        self.assertRaises(copiste.worker.Error,
+                          OnlineInit({}, [binding]).catch_up, worker, binding)
+
+
+class FakeProgressConnection:
+    """ Gives the loaded rows, and the stats of the INIT event """
+    def __init__(self):
+        self.rows = 0
+        self.ops = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, args=None):
+        self.query = query
+
+    def fetchone(self):
+        if 'reltuples' in self.query:
+            return (1000,)
+        return (self.rows,)
+
+    def fetchall(self):
+        return [('INIT', 1, 0, 0., 0., 0., 0., 0, self.ops)]
+
+    def commit(self):
+        pass
+
+
+class TestProgressReport(TestCase):
+    def report(self, resume):
+        import StringIO
+        import copiste.binding
+        con = FakeProgressConnection()
+        con.rows, con.ops = 100, 50
+        out = StringIO.StringIO()
+        binding = copiste.binding.Bind(WriteTrigger('users', 'users'), Noop())
+        report = ProgressReport(con, binding, resume, out=out)
+        report.started -= 10
+        con.rows, con.ops = 300, 250
+        report.report()
+        self.assertEqual(out.getvalue(), '')
+        report.report(force=True)
+        return out.getvalue()
+
+    def test_report(self):
+        self.assertIn('300 row(s), 30 rows/s, 20 LDAP ops/s, ETA 0:00:23',
+                      self.report(resume=False))
+
+    def test_report_resume(self):
+        self.assertIn('300 row(s), 20 rows/s, 20 LDAP ops/s, ETA 0:00:35',
+                      self.report(resume=True))